@@ -0,0 +1,100 @@
+"""
+benchmark_autocontour.py
+
+Description: Times the periosteal and endosteal masks of AutocontourKnee on
+             a synthetic two-bone phantom, with and without cropping the
+             later steps to the region of interest (roi_crop), for both
+             morphology backends, and checks that the masks are identical.
+             Then times the periosteal masks of both bones, one call per
+             bone against one get_periosteal_masks call that shares step 1
+             and contours the bones in a thread pool. Last, compares the
+             pyramid mode (pyramid_factor) with the full resolution masks.
+
+Usage:
+  python benchmarks/benchmark_autocontour.py
+  python benchmarks/benchmark_autocontour.py --size 200 --fill 0.4
+"""
+
+import time
+import argparse
+import numpy as np
+import SimpleITK as sitk
+
+from benchmark_morphology import knee_phantom
+from ormir_xct.autocontour.AutocontourKnee import AutocontourKnee
+
+
+def masks(auto_contour, image):
+    peri = auto_contour.get_periosteal_mask(image, 1)
+    return peri, auto_contour.get_endosteal_mask(image, peri)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=160, help="Phantom edge length")
+    parser.add_argument(
+        "--fill", type=float, default=0.4, help="Bone diameter over image width"
+    )
+    parser.add_argument("--morphology", nargs="+", default=["ball", "edt"])
+    parser.add_argument("--pyramid_factors", type=int, nargs="+", default=[2, 4])
+    args = parser.parse_args()
+
+    image = knee_phantom(args.size, fill=args.fill)
+
+    # compile the numba kernels before timing
+    AutocontourKnee(morphology="edt")._dilate(sitk.Image([4] * 3, sitk.sitkUInt8), 1)
+
+    print(f"{'morphology':<12}{'roi_crop':>10}{'time (s)':>10}{'equal':>8}")
+    for morphology in args.morphology:
+        reference = None
+        for roi_crop in [False, True]:
+            auto_contour = AutocontourKnee(morphology=morphology, roi_crop=roi_crop)
+            start = time.perf_counter()
+            result = [sitk.GetArrayFromImage(m) for m in masks(auto_contour, image)]
+            seconds = time.perf_counter() - start
+            reference = reference or result
+            equal = all(np.array_equal(a, b) for a, b in zip(reference, result))
+            print(f"{morphology:<12}{str(roi_crop):>10}{seconds:>10.2f}{str(equal):>8}")
+
+    print(f"\n{'morphology':<12}{'two bones':<32}{'time (s)':>10}{'equal':>8}")
+    for morphology in args.morphology:
+        auto_contour = AutocontourKnee(morphology=morphology)
+        calls = {
+            "get_periosteal_mask x 2": lambda: [
+                auto_contour.get_periosteal_mask(image, c) for c in [1, 2]
+            ],
+            "get_periosteal_masks, 1 thread": lambda: (
+                auto_contour.get_periosteal_masks(image, [1, 2], n_threads=1)
+            ),
+            "get_periosteal_masks": lambda: (
+                auto_contour.get_periosteal_masks(image, [1, 2])
+            ),
+        }
+        reference = None
+        for name, call in calls.items():
+            start = time.perf_counter()
+            result = [sitk.GetArrayFromImage(m) for m in call()]
+            seconds = time.perf_counter() - start
+            reference = reference or result
+            equal = all(np.array_equal(a, b) for a, b in zip(reference, result))
+            print(f"{morphology:<12}{name:<32}{seconds:>10.2f}{str(equal):>8}")
+
+    print(
+        f"\n{'morphology':<12}{'pyramid':>8}{'mask':>12}{'time (s)':>10}"
+        f"{'full (s)':>10}{'dice':>8}{'mean dist':>11}{'hausdorff':>11}"
+    )
+    for morphology in args.morphology:
+        for factor in args.pyramid_factors:
+            auto_contour = AutocontourKnee(morphology=morphology, pyramid_factor=factor)
+            report = auto_contour.evaluate_pyramid(image, [1])
+            times = report["time"]
+            for mask, measures in report[1].items():
+                print(
+                    f"{morphology:<12}{factor:>8}{mask:>12}{times['pyramid']:>10.2f}"
+                    f"{times['full']:>10.2f}{measures['dice']:>8.4f}"
+                    f"{measures['mean_distance']:>11.2f}{measures['hausdorff']:>11.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
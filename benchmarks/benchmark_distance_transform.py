@@ -0,0 +1,99 @@
+"""
+benchmark_distance_transform.py
+
+Description: Compares the numba distance transform in
+             ormir_xct.util.distance_transform with scipy's
+             distance_transform_edt and SimpleITK's
+             SignedMaurerDistanceMap on the phantoms from generate_shapes.
+
+Usage:
+  python benchmarks/benchmark_distance_transform.py
+  python benchmarks/benchmark_distance_transform.py --size 200 --n_threads 1 4
+"""
+
+import time
+import argparse
+import numpy as np
+import SimpleITK as sitk
+from scipy.ndimage import distance_transform_edt
+
+from ormir_xct.util.generate_shapes import create_shape
+from ormir_xct.util.distance_transform import euclidean_distance_transform
+
+
+def best_time(function, repeats):
+    """
+    Best wall time of `repeats` calls of `function`.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=150, help="Phantom edge length")
+    parser.add_argument("--voxel_width", type=float, default=0.0607)
+    parser.add_argument("--n_threads", type=int, nargs="+", default=[1])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    voxel_width = np.array([args.voxel_width] * 3)
+    shape = tuple([args.size] * 3)
+    thickness = args.voxel_width * args.size * 0.6
+
+    # compile the numba kernels before timing
+    for dtype in [np.float64, np.float32]:
+        euclidean_distance_transform(np.ones((3, 3, 3)), voxel_width, dtype=dtype)
+
+    print(f"{'phantom':<10}{'method':<32}{'time (s)':>10}{'max diff':>12}")
+    for shape_type in ["sphere", "cylinder", "plate"]:
+        mask = create_shape(shape, voxel_width, thickness, shape_type) > 0
+        reference = distance_transform_edt(mask, voxel_width)
+        rows = [
+            (
+                "scipy distance_transform_edt",
+                best_time(
+                    lambda: distance_transform_edt(mask, voxel_width), args.repeats
+                ),
+                0.0,
+            )
+        ]
+
+        image = sitk.GetImageFromArray(mask.astype(np.uint8))
+        image.SetSpacing(voxel_width.tolist())
+        rows.append(
+            (
+                "sitk SignedMaurerDistanceMap",
+                best_time(
+                    lambda: sitk.SignedMaurerDistanceMap(
+                        image, squaredDistance=False, useImageSpacing=True
+                    ),
+                    args.repeats,
+                ),
+                np.nan,
+            )
+        )
+
+        for n_threads in args.n_threads:
+            for dtype in [np.float64, np.float32]:
+                edt = lambda: euclidean_distance_transform(
+                    mask, voxel_width, dtype=dtype, n_threads=n_threads
+                )
+                rows.append(
+                    (
+                        f"numba {np.dtype(dtype).name} ({n_threads} threads)",
+                        best_time(edt, args.repeats),
+                        np.abs(edt() - reference).max(),
+                    )
+                )
+
+        for method, seconds, diff in rows:
+            print(f"{shape_type:<10}{method:<32}{seconds:>10.3f}{diff:>12.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+benchmark_import_time.py
+
+Description: Measures the import time of the package entry points with
+             `python -X importtime`, each in a fresh process, and lists the
+             heavy backends (ITK, VTK, numba, scikit-image, scipy.ndimage)
+             that importing them loads. The times can be saved as a baseline
+             and later runs compared against it to catch regressions.
+
+Usage:
+  python benchmarks/benchmark_import_time.py
+  python benchmarks/benchmark_import_time.py --save import_times.json
+  python benchmarks/benchmark_import_time.py --compare import_times.json --tolerance 0.25
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+
+ENTRY_POINTS = [
+    "ormir_xct",
+    "ormir_xct.util.file_reader",
+    "ormir_xct.util.file_converter",
+    "ormir_xct.util.sitk_vtk",
+    "ormir_xct.util.segmentation_evaluation",
+    "ormir_xct.util.hildebrand_thickness",
+    "ormir_xct.bone_mineral_density.bmd",
+    "ormir_xct.bone_mineral_density.bmd_masked",
+    "ormir_xct.joint_space_analysis.jsw_morphometry",
+    "ormir_xct.autocontour.AutocontourKnee",
+    "ormir_xct.segmentation.ipl_seg",
+]
+HEAVY_BACKENDS = ["itk", "vtk", "numba", "skimage", "scipy.ndimage"]
+
+
+def import_time(entry_point, repeats):
+    """
+    Best cumulative import time in seconds of `entry_point` over `repeats`
+    fresh processes, and the heavy backends it loads.
+    """
+    code = (
+        f"import sys, {entry_point}\n"
+        f"print(*[m for m in {HEAVY_BACKENDS} if m in sys.modules])\n"
+    )
+    seconds = []
+    for _ in range(repeats):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        # lines look like "import time: self [us] | cumulative | imported package",
+        # with the package indented by its nesting depth. Importing a dotted
+        # name imports each of its parent packages at the top level first.
+        cumulative = 0
+        for line in result.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) != 3 or fields[2].startswith("  "):
+                continue
+            name = fields[2].strip()
+            if entry_point == name or entry_point.startswith(name + "."):
+                cumulative += int(fields[1])
+        seconds.append(cumulative * 1e-6)
+    return min(seconds), result.stdout.split()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entry_points", nargs="+", default=ENTRY_POINTS)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--save", help="Write the import times to this JSON file")
+    parser.add_argument("--compare", help="Compare with a JSON file from --save")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Relative slowdown over the baseline that counts as a regression",
+    )
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    times, regressions = {}, []
+    print(f"{'entry point':<48}{'time (s)':>10}{'baseline':>10}  heavy backends")
+    for entry_point in args.entry_points:
+        seconds, backends = import_time(entry_point, args.repeats)
+        times[entry_point] = seconds
+        reference = baseline.get(entry_point)
+        flag = ""
+        if reference is not None and seconds > reference * (1 + args.tolerance):
+            regressions.append(entry_point)
+            flag = "  REGRESSION"
+        reference = f"{reference:>10.3f}" if reference is not None else f"{'-':>10}"
+        print(
+            f"{entry_point:<48}{seconds:>10.3f}{reference}  "
+            f"{', '.join(backends) or '-'}{flag}"
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(times, f, indent=2)
+    if regressions:
+        sys.exit(f"Import time regressions: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
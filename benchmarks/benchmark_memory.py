@@ -0,0 +1,102 @@
+"""
+benchmark_memory.py
+
+Description: Measures the peak memory of the periosteal and endosteal masks
+             of AutocontourKnee on a synthetic two-bone phantom, computed by
+             chaining get_periosteal_masks and get_endosteal_mask against one
+             get_masks call, each in its own process. The peak is the peak
+             resident set size above the one after the phantom was created
+             (Linux only). Then lists the stages of get_masks with the
+             largest peaks.
+
+Usage:
+  python benchmarks/benchmark_memory.py
+  python benchmarks/benchmark_memory.py --size 300 --morphology edt
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+
+WORKER = """
+import sys, json, time
+import SimpleITK as sitk
+sys.path.insert(0, sys.argv[4])
+from benchmark_morphology import knee_phantom
+from ormir_xct.autocontour.AutocontourKnee import AutocontourKnee
+from ormir_xct.autocontour.stage_graph import get_rss, get_peak_rss, reset_peak_rss
+
+case, size, morphology = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+image = knee_phantom(size, fill=0.6)
+auto_contour = AutocontourKnee(morphology=morphology)
+
+# compile the numba kernels before measuring
+auto_contour._dilate(sitk.Image([4] * 3, sitk.sitkUInt8), 1)
+
+rss = get_rss()
+reset_peak_rss()
+start = time.perf_counter()
+report = None
+if case == "chain":
+    peris = auto_contour.get_periosteal_masks(image, [1, 2], n_threads=1)
+    endos = [auto_contour.get_endosteal_mask(image, peri) for peri in peris]
+elif case == "get_masks":
+    masks = auto_contour.get_masks(image, [1, 2])
+else:
+    masks, report = auto_contour.get_masks(image, [1, 2], return_report=True)
+seconds = time.perf_counter() - start
+peak = report["peak_rss"] if report else get_peak_rss()
+print(json.dumps({"seconds": seconds, "peak": peak - rss, "base": rss, "report": report}))
+"""
+
+
+def run_worker(case, size, morphology):
+    """
+    Run the worker in a fresh process.
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", WORKER, case, str(size), morphology, sys.path[0]],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=200, help="Phantom edge length")
+    parser.add_argument("--morphology", nargs="+", default=["ball", "edt"])
+    parser.add_argument(
+        "--stages", type=int, default=5, help="Number of stages to list"
+    )
+    args = parser.parse_args()
+
+    megabytes = 2**20
+    print(f"{'morphology':<12}{'case':<12}{'time (s)':>10}{'peak (MB)':>12}")
+    for morphology in args.morphology:
+        for case in ["chain", "get_masks"]:
+            result = run_worker(case, args.size, morphology)
+            print(
+                f"{morphology:<12}{case:<12}{result['seconds']:>10.2f}"
+                f"{result['peak'] / megabytes:>12.0f}"
+            )
+
+    for morphology in args.morphology:
+        result = run_worker("report", args.size, morphology)
+        stages = sorted(
+            result["report"]["stages"], key=lambda s: s["peak_rss"], reverse=True
+        )
+        print(f"\n{morphology}: stages of get_masks with the largest peaks")
+        print(f"{'stage':<24}{'time (s)':>10}{'peak (MB)':>12}{'held (MB)':>12}")
+        for stage in stages[: args.stages]:
+            print(
+                f"{stage['stage']:<24}{stage['seconds']:>10.2f}"
+                f"{(stage['peak_rss'] - result['base']) / megabytes:>12.0f}"
+                f"{stage['held_bytes'] / megabytes:>12.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
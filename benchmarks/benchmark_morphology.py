@@ -0,0 +1,86 @@
+"""
+benchmark_morphology.py
+
+Description: Times the binary morphology of AutocontourKnee with the
+             SimpleITK ball kernels and with the distance transform
+             backend (ormir_xct.util.edt_morphology), per radius and for a
+             whole autocontour run on a synthetic two-bone phantom, and
+             checks that both give the same masks.
+
+Usage:
+  python benchmarks/benchmark_morphology.py
+  python benchmarks/benchmark_morphology.py --size 200 --radii 5 16 35 50
+"""
+
+import time
+import argparse
+import numpy as np
+import SimpleITK as sitk
+
+from ormir_xct.autocontour.AutocontourKnee import AutocontourKnee
+
+
+def knee_phantom(size, seed=0, fill=0.8):
+    """
+    Two noisy bones, cylinders with a cortical shell and a sparse trabecular
+    interior, separated by a joint space, as a density image. The diameter of
+    the bones is `fill` times the width of the image.
+    """
+    rng = np.random.default_rng(seed)
+    shape = (size, size, size)
+    z, y, x = np.indices(shape)
+    radius = np.hypot(y - size / 2, x - size / 2)
+    gap = size // 2
+    outer, inner = fill / 2 * size, 0.4 * fill * size
+    bone = (radius < outer) & (z > 3) & (z < size - 4) & (np.abs(z - gap) > 3)
+    marrow = (radius < inner) & (z > 6) & (z < size - 7) & (np.abs(z - gap) > 6)
+
+    array = np.where(bone & ~marrow, 1200.0, 0.0)
+    array[marrow & (rng.random(shape) < 0.3)] = 900.0
+    array += rng.normal(0, 50, shape)
+    return sitk.GetImageFromArray(array.astype(np.float32))
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=120, help="Phantom edge length")
+    parser.add_argument("--radii", type=int, nargs="+", default=[5, 15, 35, 50])
+    args = parser.parse_args()
+
+    image = knee_phantom(args.size)
+    backends = {m: AutocontourKnee(morphology=m) for m in ["ball", "edt"]}
+    mask = backends["ball"]._gaussian_and_threshold(image, 1.5, 1, 350, 10000)
+
+    # compile the numba kernels before timing
+    backends["edt"]._dilate(mask, 1)
+
+    print(f"{'operation':<28}{'ball (s)':>10}{'edt (s)':>10}{'equal':>8}")
+    for radius in args.radii:
+        for operation in ["_dilate", "_erode", "_opening", "_closing"]:
+            results, times = zip(
+                *[timed(getattr(b, operation), mask, radius) for b in backends.values()]
+            )
+            equal = np.array_equal(*map(sitk.GetArrayViewFromImage, results))
+            name = f"{operation[1:]} r={radius}"
+            print(f"{name:<28}{times[0]:>10.2f}{times[1]:>10.2f}{str(equal):>8}")
+
+    def autocontour(auto_contour):
+        peri = auto_contour.get_periosteal_mask(image, 1)
+        return peri, auto_contour.get_endosteal_mask(image, peri)
+
+    results, times = zip(*[timed(autocontour, b) for b in backends.values()])
+    equal = all(
+        np.array_equal(sitk.GetArrayViewFromImage(a), sitk.GetArrayViewFromImage(b))
+        for a, b in zip(*results)
+    )
+    print(f"{'peri + endo masks':<28}{times[0]:>10.2f}{times[1]:>10.2f}{str(equal):>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+benchmark_ridge_modes.py
+
+Description: Times the ridge modes of the local thickness computation and
+             compares their mean thickness with IPL on the phantoms of the
+             manuscript (manuscript/notebooks/csv). The phantoms are rebuilt
+             from their file names the same way generate_shapes creates them.
+
+Usage:
+  python benchmarks/benchmark_ridge_modes.py
+  python benchmarks/benchmark_ridge_modes.py --phantoms F_SPH PLATE --cases 50
+"""
+
+import os
+import re
+import time
+import argparse
+import numpy as np
+import pandas
+
+from ormir_xct.util.generate_shapes import create_shape
+from ormir_xct.util.hildebrand_thickness import calc_structure_thickness_statistics
+
+CSV_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "manuscript", "notebooks", "csv"
+)
+PHANTOMS = ["F_SPH", "H_SPH", "F_CYL", "H_CYL", "PLATE"]
+RIDGE_MODES = ["skeleton", "local_max", "hildebrand"]
+
+
+def phantom_from_name(name, padding=10):
+    """
+    Rebuild a phantom from its name, e.g. `H_CYL_OUTR_11_INR_1_LEN_102`.
+    """
+    params = {key: int(value) for key, value in re.findall(r"([A-Z]+)_(\d+)", name)}
+    if name.startswith("PLATE"):
+        shape = tuple([params["LEN"] * 2] * 3)
+        mask = create_shape(shape, (1, 1, 1), params["WIDTH"], "plate")
+    else:
+        radius = params["OUTR"]
+        if "_SPH_" in name:
+            shape_type, shape = "sphere", tuple([radius * 2] * 3)
+        else:
+            shape_type, shape = "cylinder", (radius * 2, radius * 2, params["LEN"] * 2)
+        mask = create_shape(shape, (1, 1, 1), radius, shape_type)
+        if name.startswith("H_"):
+            mask = mask - create_shape(shape, (1, 1, 1), params["INR"], shape_type)
+    return np.pad(mask, padding) > 0
+
+
+def phantom_name(filename):
+    """
+    Strip the suffixes the IPL and Python csv files add to the phantom names.
+    """
+    return re.split(r"_DT_JSW|_OVERSAMPLE|\.LOG", filename)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--phantoms", nargs="+", default=PHANTOMS, choices=PHANTOMS)
+    parser.add_argument(
+        "--cases", type=int, default=20, help="Number of phantoms drawn per type"
+    )
+    parser.add_argument("--n_threads", type=int, default=None)
+    args = parser.parse_args()
+
+    # compile the numba kernels before timing
+    warmup = phantom_from_name("F_SPH_OUTR_6")
+    for ridge in RIDGE_MODES:
+        calc_structure_thickness_statistics(warmup, 1, 0, ridge=ridge)
+
+    print(
+        f"{'phantoms':<10}{'ridge':<12}{'cases':>7}{'time (s)':>10}"
+        f"{'|mean - IPL|':>14}{'max':>8}{'|mean - paper|':>16}"
+    )
+    for phantom in args.phantoms:
+        ipl = pandas.read_csv(os.path.join(CSV_DIR, f"{phantom}_JSW_THICKNESS_IPL.csv"))
+        ipl = dict(zip(ipl["Filename"].map(phantom_name), ipl["BG Th V3"]))
+        paper = pandas.read_csv(
+            os.path.join(CSV_DIR, f"{phantom}_OVERSAMPLE_SKEL_DT_THICKNESS_PY.csv")
+        )
+        paper = dict(zip(paper["Filename"].map(phantom_name), paper["main_th"]))
+        names = sorted(set(ipl) & set(paper))
+        names = np.random.default_rng(0).choice(
+            names, min(args.cases, len(names)), replace=False
+        )
+
+        for ridge in RIDGE_MODES:
+            seconds, ipl_diff, paper_diff = 0.0, [], []
+            for name in names:
+                mask = phantom_from_name(name)
+                start = time.perf_counter()
+                mean = calc_structure_thickness_statistics(
+                    mask, 1, 0, ridge=ridge, n_threads=args.n_threads
+                )[0]
+                seconds += time.perf_counter() - start
+                ipl_diff.append(abs(mean - ipl[name]))
+                paper_diff.append(abs(mean - paper[name]))
+            print(
+                f"{phantom:<10}{ridge:<12}{len(names):>7}{seconds:>10.2f}"
+                f"{np.mean(ipl_diff):>14.3f}{np.max(ipl_diff):>8.2f}"
+                f"{np.mean(paper_diff):>16.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+benchmark_slab_streaming.py
+
+Description: Measures the time and the peak memory of the periosteal and
+             endosteal masks of AutocontourKnee on a tall synthetic scan,
+             a two-bone phantom stretched along z so that the bones run
+             through many slices like in a multi-stack acquisition,
+             computed on the whole image against slab by slab
+             with `slab_size`, from the image in memory and from its file.
+             Each case runs in its own process, and the peak is the peak
+             resident set size above the one before the contouring (Linux
+             only). Also checks that the masks are identical.
+
+Usage:
+  python benchmarks/benchmark_slab_streaming.py
+  python benchmarks/benchmark_slab_streaming.py --size 160 --stretch 8 --slabs 128 256
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+import SimpleITK as sitk
+
+from benchmark_morphology import knee_phantom
+
+WORKER = """
+import sys, json, time, hashlib
+import SimpleITK as sitk
+from ormir_xct.autocontour.AutocontourKnee import AutocontourKnee
+from ormir_xct.autocontour.stage_graph import get_rss, get_peak_rss, reset_peak_rss
+
+fn, slab_size, from_file, morphology = sys.argv[1:5]
+slab_size = int(slab_size) or None
+auto_contour = AutocontourKnee(morphology=morphology, slab_size=slab_size)
+
+# compile the numba kernels before measuring
+auto_contour._dilate(sitk.Image([4] * 3, sitk.sitkUInt8), 1)
+
+image = fn if from_file == "1" else sitk.ReadImage(fn, sitk.sitkFloat32)
+rss = get_rss()
+reset_peak_rss()
+start = time.perf_counter()
+masks = auto_contour.get_masks(image, [1, 2])
+seconds = time.perf_counter() - start
+peak = get_peak_rss()
+
+digest = hashlib.sha1()
+for mask in [mask for pair in masks for mask in pair]:
+    digest.update(sitk.GetArrayViewFromImage(mask).tobytes())
+print(json.dumps({"seconds": seconds, "peak": peak - rss, "masks": digest.hexdigest()}))
+"""
+
+
+def run_worker(fn, slab_size, from_file, morphology):
+    """
+    Run the worker in a fresh process.
+    """
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            WORKER,
+            fn,
+            str(slab_size or 0),
+            "1" if from_file else "0",
+            morphology,
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=120, help="Phantom edge length")
+    parser.add_argument(
+        "--stretch", type=int, default=6, help="Number of copies of every slice"
+    )
+    parser.add_argument("--slabs", type=int, nargs="+", default=[120, 240])
+    parser.add_argument("--morphology", default="edt")
+    args = parser.parse_args()
+
+    phantom = sitk.GetArrayFromImage(knee_phantom(args.size, fill=0.6))
+    image = sitk.GetImageFromArray(np.repeat(phantom, args.stretch, axis=0))
+    print(f"scan of {image.GetSize()} voxels, {args.morphology} morphology")
+
+    with tempfile.TemporaryDirectory() as directory:
+        fn = os.path.join(directory, "scan.nii")
+        sitk.WriteImage(image, fn)
+        del image
+
+        cases = [("whole image", None, False)]
+        for slab_size in args.slabs:
+            cases.append((f"slabs of {slab_size}", slab_size, False))
+            cases.append((f"slabs of {slab_size}, file", slab_size, True))
+
+        megabytes = 2**20
+        print(f"{'case':<24}{'time (s)':>10}{'peak (MB)':>12}{'equal':>8}")
+        expected = None
+        for name, slab_size, from_file in cases:
+            result = run_worker(fn, slab_size, from_file, args.morphology)
+            expected = expected or result["masks"]
+            print(
+                f"{name:<24}{result['seconds']:>10.2f}"
+                f"{result['peak'] / megabytes:>12.0f}"
+                f"{str(result['masks'] == expected):>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+benchmark_slice_components.py
+
+Description: Times keeping the largest connected component of every slice of
+             a mask, with filter_slice_components against a loop calling
+             SimpleITK on every slice, and checks that the masks are
+             identical.
+
+Usage:
+  python benchmarks/benchmark_slice_components.py
+  python benchmarks/benchmark_slice_components.py --shapes 168x500x500
+"""
+
+import time
+import argparse
+import numpy as np
+import SimpleITK as sitk
+from scipy.ndimage import gaussian_filter
+
+from ormir_xct.util.slice_connected_components import filter_slice_components
+
+
+def sitk_slice_loop(mask):
+    result = np.empty_like(mask)
+    for k, mask_slice in enumerate(mask):
+        labels = sitk.ConnectedComponent(
+            sitk.GetImageFromArray(mask_slice.astype(np.uint8)), True
+        )
+        largest = sitk.RelabelComponent(labels, sortByObjectSize=True) == 1
+        result[k] = sitk.GetArrayViewFromImage(largest) > 0
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--shapes", nargs="+", default=["64x256x256", "168x500x500", "400x300x300"]
+    )
+    parser.add_argument("--n_threads", type=int, default=None)
+    args = parser.parse_args()
+
+    # compile the numba kernels before timing
+    filter_slice_components(np.ones((2, 4, 4), dtype=bool), fully_connected=True)
+
+    print(f"{'shape':<14}{'sitk loop (s)':>14}{'numba (s)':>11}{'equal':>8}")
+    for shape in args.shapes:
+        shape = tuple(int(n) for n in shape.split("x"))
+        rng = np.random.default_rng(0)
+        mask = gaussian_filter(rng.random(shape, dtype=np.float32), 2) > 0.5
+
+        start = time.perf_counter()
+        expected = sitk_slice_loop(mask)
+        loop_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        result = filter_slice_components(
+            mask, fully_connected=True, n_threads=args.n_threads
+        )
+        numba_seconds = time.perf_counter() - start
+
+        equal = np.array_equal(expected, result)
+        name = "x".join(str(n) for n in shape)
+        print(f"{name:<14}{loop_seconds:>14.3f}{numba_seconds:>11.3f}{str(equal):>8}")
+
+
+if __name__ == "__main__":
+    main()
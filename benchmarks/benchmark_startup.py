@@ -0,0 +1,87 @@
+"""
+benchmark_startup.py
+
+Description: Measures what a fresh worker process pays before its first
+             local thickness result: importing hildebrand_thickness, the
+             optional ormir_xct.warmup() call, and the first and second
+             calc_structure_thickness_statistics call on a small JSW-like
+             mask. Each case runs in its own process, first with an empty
+             numba cache (NUMBA_CACHE_DIR) and then with the cache the
+             first run wrote.
+
+Usage:
+  python benchmarks/benchmark_startup.py
+  python benchmarks/benchmark_startup.py --ridge local_max --oversample
+"""
+
+import os
+import sys
+import json
+import tempfile
+import argparse
+import subprocess
+
+WORKER = """
+import sys, json, time
+import numpy as np
+
+ridge, oversample, warmup = sys.argv[1], sys.argv[2] == "1", sys.argv[3] == "1"
+times = {}
+
+start = time.perf_counter()
+from ormir_xct.util.hildebrand_thickness import calc_structure_thickness_statistics
+times["import"] = time.perf_counter() - start
+
+start = time.perf_counter()
+if warmup:
+    import ormir_xct
+    ormir_xct.warmup()
+times["warmup"] = time.perf_counter() - start
+
+# a joint space like slab
+mask = np.zeros((80, 80, 80), dtype=bool)
+mask[35:45, 10:70, 10:70] = True
+for call in ["first call", "second call"]:
+    start = time.perf_counter()
+    calc_structure_thickness_statistics(
+        mask, 0.0607, 0, oversample=oversample, ridge=ridge
+    )
+    times[call] = time.perf_counter() - start
+
+print(json.dumps(times))
+"""
+
+
+def run_worker(cache_dir, ridge, oversample, warmup):
+    """
+    Run the worker in a fresh process with the given numba cache directory.
+    """
+    env = dict(os.environ, NUMBA_CACHE_DIR=cache_dir)
+    output = subprocess.run(
+        [sys.executable, "-c", WORKER, ridge, str(int(oversample)), str(int(warmup))],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ridge", default="hildebrand")
+    parser.add_argument("--oversample", action="store_true")
+    args = parser.parse_args()
+
+    columns = ["import", "warmup", "first call", "second call"]
+    print(f"{'case':<28}" + "".join(f"{c + ' (s)':>16}" for c in columns))
+    for warmup in [False, True]:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for cache in ["cold cache", "warm cache"]:
+                times = run_worker(cache_dir, args.ridge, args.oversample, warmup)
+                case = f"{cache}{', warmup()' if warmup else ''}"
+                print(f"{case:<28}" + "".join(f"{times[c]:>16.3f}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+benchmark_sweep.py
+
+Description: Times a parameter sweep of AutocontourKnee on a synthetic
+             two-bone phantom, computing every combination with get_masks
+             against one sweep call that memoizes the stage outputs, and
+             checks that the masks are identical.
+
+Usage:
+  python benchmarks/benchmark_sweep.py
+  python benchmarks/benchmark_sweep.py --size 200 --morphology edt
+"""
+
+import time
+import argparse
+import itertools
+import numpy as np
+import SimpleITK as sitk
+
+from benchmark_morphology import knee_phantom
+from ormir_xct.autocontour.AutocontourKnee import AutocontourKnee
+from ormir_xct.autocontour.stage_graph import StageCache
+
+# the periosteal closing, and two parameters of the endosteal mask only
+GRID = {
+    "peri_s4_close_radius": [12, 16],
+    "endo_min_number": [500, 1000],
+    "endo_close_radius": [30, 40, 50],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=120, help="Phantom edge length")
+    parser.add_argument("--morphology", default="edt")
+    args = parser.parse_args()
+
+    image = knee_phantom(args.size, fill=0.6)
+    auto_contour = AutocontourKnee(morphology=args.morphology)
+
+    # compile the numba kernels before timing
+    AutocontourKnee(morphology="edt")._dilate(sitk.Image([4] * 3, sitk.sitkUInt8), 1)
+
+    start = time.perf_counter()
+    expected = []
+    for values in itertools.product(*GRID.values()):
+        setting = AutocontourKnee(morphology=args.morphology)
+        setting.set_parameters(**dict(zip(GRID, values)))
+        expected.append(setting.get_masks(image))
+    loop_seconds = time.perf_counter() - start
+
+    cache = StageCache()
+    start = time.perf_counter()
+    results = auto_contour.sweep(image, GRID, cache=cache)
+    sweep_seconds = time.perf_counter() - start
+
+    equal = all(
+        np.array_equal(sitk.GetArrayViewFromImage(a), sitk.GetArrayViewFromImage(b))
+        for (_, masks), reference in zip(results, expected)
+        for pair, reference_pair in zip(masks, reference)
+        for a, b in zip(pair, reference_pair)
+    )
+    print(f"{len(results)} combinations of {', '.join(GRID)}")
+    print(f"get_masks loop: {loop_seconds:.2f} s")
+    print(f"sweep:          {sweep_seconds:.2f} s, equal: {equal}")
+    print(
+        f"stages run: {cache.misses}, from the cache: {cache.hits}, "
+        f"cached images: {cache.nbytes / 2**20:.0f} MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
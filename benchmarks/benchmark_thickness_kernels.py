@@ -0,0 +1,105 @@
+"""
+benchmark_thickness_kernels.py
+
+Description: Compares the original cube-scanning sphere-filling kernel with
+             the stencil-based kernel on the phantoms from generate_shapes.
+
+Usage:
+  python benchmarks/benchmark_thickness_kernels.py
+  python benchmarks/benchmark_thickness_kernels.py --size 120 --oversample
+"""
+
+import time
+import argparse
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+from ormir_xct.util.generate_shapes import create_shape
+from ormir_xct.util.hildebrand_thickness import (
+    build_sphere_stencils,
+    compute_local_thickness_from_sorted_distances,
+    compute_local_thickness_from_sorted_distances_parallel,
+    oversampling_distance_transform,
+)
+from ormir_xct.util.distance_transform import numba_threads
+
+
+def sorted_distance_ridge(mask, voxel_width, oversample):
+    """
+    Full-mask sorted distance ridge of a phantom.
+    """
+    if oversample:
+        mask_dist = oversampling_distance_transform(mask, voxel_width)
+    else:
+        mask_dist = mask * distance_transform_edt(mask, voxel_width)
+    indices = np.stack(np.nonzero(mask_dist), axis=1)
+    dists = mask_dist[tuple(indices.T)]
+    order = np.argsort(dists, kind="stable")
+    return dists[order], indices[order]
+
+
+def time_kernels(mask, voxel_width, oversample, n_threads, repeats):
+    """
+    Time both kernels on a mask, returning the best of `repeats` runs.
+    """
+    rd_extra = 0.5 if oversample else 0
+    dists, indices = sorted_distance_ridge(mask, voxel_width, oversample)
+
+    cube_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        cube = compute_local_thickness_from_sorted_distances(
+            np.zeros(mask.shape), dists, indices, voxel_width, rd_extra
+        )
+        cube_times.append(time.perf_counter() - start)
+
+    stencil_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        stencils = build_sphere_stencils(dists, voxel_width, rd_extra)
+        with numba_threads(n_threads):
+            stencil = compute_local_thickness_from_sorted_distances_parallel(
+                np.zeros(mask.shape), dists, indices, voxel_width, *stencils
+            )
+        stencil_times.append(time.perf_counter() - start)
+
+    if not np.array_equal(cube, stencil):
+        raise RuntimeError("stencil kernel does not reproduce the cube kernel")
+
+    return len(dists), len(np.unique(dists)), min(cube_times), min(stencil_times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=80, help="Phantom edge length")
+    parser.add_argument("--voxel_width", type=float, default=1.0)
+    parser.add_argument("--oversample", action="store_true")
+    parser.add_argument("--n_threads", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    voxel_width = np.array([args.voxel_width] * 3)
+    shape = tuple([args.size] * 3)
+    thickness = args.voxel_width * args.size * 0.6
+
+    # compile both kernels before timing
+    warmup = create_shape((8, 8, 8), voxel_width, 6 * args.voxel_width)
+    time_kernels(warmup, voxel_width, args.oversample, args.n_threads, 1)
+
+    print(
+        f"{'phantom':<10}{'spheres':>10}{'radii':>8}{'cube (s)':>12}"
+        f"{'stencil (s)':>14}{'speedup':>10}"
+    )
+    for shape_type in ["sphere", "cylinder", "plate"]:
+        mask = create_shape(shape, voxel_width, thickness, shape_type) > 0
+        num_spheres, num_radii, cube_time, stencil_time = time_kernels(
+            mask, voxel_width, args.oversample, args.n_threads, args.repeats
+        )
+        print(
+            f"{shape_type:<10}{num_spheres:>10}{num_radii:>8}{cube_time:>12.3f}"
+            f"{stencil_time:>14.3f}{cube_time / stencil_time:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
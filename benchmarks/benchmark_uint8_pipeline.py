@@ -0,0 +1,135 @@
+"""
+benchmark_uint8_pipeline.py
+
+Description: Measures the time and the peak memory of get_masks of
+             AutocontourKnee on the test AIM, or on a synthetic two-bone
+             phantom when this ITK cannot read AIMs, for this checkout and,
+             with --baseline, for another one, e.g. a git worktree of the
+             commit before the binary intermediates and the labels were kept
+             in uint8. Each run is in its own process, and the peak is the
+             peak resident set size above the one before the contouring
+             (Linux only), and the held memory the size of the images that
+             the stage graph holds after labelling the bones, the label image
+             and the input. Also checks that the masks are identical.
+
+Usage:
+  python benchmarks/benchmark_uint8_pipeline.py
+  git worktree add /tmp/baseline HEAD~1
+  python benchmarks/benchmark_uint8_pipeline.py --baseline /tmp/baseline --size 200
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+import SimpleITK as sitk
+
+from benchmark_morphology import knee_phantom
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKER = """
+import sys, json, time, hashlib
+sys.path.insert(0, sys.argv[1])
+import SimpleITK as sitk
+from ormir_xct.autocontour.AutocontourKnee import AutocontourKnee
+from ormir_xct.autocontour.stage_graph import get_rss, reset_peak_rss
+
+fn, morphology = sys.argv[2:4]
+image = sitk.ReadImage(fn, sitk.sitkFloat32)
+auto_contour = AutocontourKnee(morphology=morphology)
+
+# compile the numba kernels before measuring
+auto_contour._dilate(sitk.Image([4] * 3, sitk.sitkUInt8), 1)
+
+rss = get_rss()
+reset_peak_rss()
+start = time.perf_counter()
+masks, report = auto_contour.get_masks(image, [1, 2], return_report=True)
+seconds = time.perf_counter() - start
+held = next(s["held_bytes"] for s in report["stages"] if s["stage"] == "labels")
+
+digest = hashlib.sha1()
+for mask in [mask for pair in masks for mask in pair]:
+    digest.update(sitk.GetArrayViewFromImage(mask).tobytes())
+result = {"seconds": seconds, "peak": report["peak_rss"] - rss, "held": held}
+print(json.dumps({**result, "masks": digest.hexdigest()}))
+"""
+
+
+def read_test_image(path, size):
+    """
+    The test AIM, or the phantom if it cannot be read.
+    """
+    try:
+        from ormir_xct.util.file_reader import file_reader
+
+        image = file_reader(path)
+    except Exception:
+        image = None
+    if image is None:
+        print(f"cannot read {path}, using a phantom of {size}^3 voxels")
+        return knee_phantom(size, fill=0.6)
+    return sitk.Cast(image, sitk.sitkFloat32)
+
+
+def run_worker(root, fn, morphology):
+    """
+    Run the worker in a fresh process, with the package of the checkout at
+    `root`.
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", WORKER, root, fn, morphology],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--image", default=os.path.join(ROOT, "tests", "data", "test_aim.AIM")
+    )
+    parser.add_argument(
+        "--size", type=int, default=160, help="Phantom edge length, without AIM"
+    )
+    parser.add_argument("--baseline", help="Checkout to compare with")
+    parser.add_argument("--morphology", nargs="+", default=["ball", "edt"])
+    args = parser.parse_args()
+
+    image = read_test_image(args.image, args.size)
+    print(f"scan of {image.GetSize()} voxels")
+    checkouts = [("current", ROOT)]
+    if args.baseline:
+        checkouts.insert(0, ("baseline", os.path.abspath(args.baseline)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        fn = os.path.join(directory, "scan.nii")
+        sitk.WriteImage(image, fn)
+        del image
+
+        megabytes = 2**20
+        print(
+            f"{'morphology':<12}{'checkout':<10}{'time (s)':>10}"
+            f"{'peak (MB)':>12}{'held (MB)':>12}{'equal':>8}"
+        )
+        for morphology in args.morphology:
+            expected = None
+            for name, root in checkouts:
+                result = run_worker(root, fn, morphology)
+                expected = expected or result["masks"]
+                print(
+                    f"{morphology:<12}{name:<10}{result['seconds']:>10.2f}"
+                    f"{result['peak'] / megabytes:>12.0f}"
+                    f"{result['held'] / megabytes:>12.0f}"
+                    f"{str(result['masks'] == expected):>8}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+profile_autocontour.py
+
+Description: Profiles the periosteal and endosteal masks of AutocontourKnee,
+             computed with get_masks on a synthetic two-bone phantom or on
+             an image file, and lists the stages with the most self time.
+             Writes the profile as JSON and as a Chrome trace if asked to.
+             Also times get_masks with profiling switched off and on, to
+             check the overhead of the instrumentation.
+
+Usage:
+  python benchmarks/profile_autocontour.py --trace trace.json
+  python benchmarks/profile_autocontour.py --image knee.nii --json profile.json
+"""
+
+import time
+import argparse
+import SimpleITK as sitk
+
+from benchmark_morphology import knee_phantom
+from ormir_xct.autocontour.AutocontourKnee import AutocontourKnee
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", help="Image to contour instead of the phantom")
+    parser.add_argument("--size", type=int, default=160, help="Phantom edge length")
+    parser.add_argument("--morphology", default="ball")
+    parser.add_argument("--json", help="Write the profile to this JSON file")
+    parser.add_argument("--trace", help="Write a Chrome trace to this file")
+    parser.add_argument(
+        "--stages", type=int, default=15, help="Number of stages to list"
+    )
+    args = parser.parse_args()
+
+    if args.image:
+        image = sitk.ReadImage(args.image)
+    else:
+        image = knee_phantom(args.size, fill=0.6)
+
+    # compile the numba kernels before timing
+    AutocontourKnee(morphology="edt")._dilate(sitk.Image([4] * 3, sitk.sitkUInt8), 1)
+
+    seconds = {}
+    for profile in [False, True]:
+        auto_contour = AutocontourKnee(morphology=args.morphology, profile=profile)
+        start = time.perf_counter()
+        auto_contour.get_masks(image, [1, 2])
+        seconds[profile] = time.perf_counter() - start
+    profiler = auto_contour.profiler
+
+    print(f"get_masks: {seconds[False]:.2f} s, profiled: {seconds[True]:.2f} s")
+    print(f"\n{'stage':<48}{'calls':>6}{'self (s)':>10}{'total (s)':>11}{'MB':>8}")
+    for stage in profiler.summary()[: args.stages]:
+        print(
+            f"{stage['name']:<48}{stage['calls']:>6}{stage['self_seconds']:>10.2f}"
+            f"{stage['seconds']:>11.2f}{stage['output_bytes'] / 2**20:>8.1f}"
+        )
+
+    if args.json:
+        profiler.save_json(args.json)
+    if args.trace:
+        profiler.save_chrome_trace(args.trace)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+# __init__.py
+
+
+def warmup():
+    """
+    Compile the numba kernels used for morphometry, or load them from numba's on-disk cache, so that the first call
+    to e.g. `calc_structure_thickness_statistics` does not pay for compilation. Call this once at the start of a
+    worker process. The first process on a machine compiles and caches the kernels, which takes tens of seconds;
+    later processes only load them. Set `NUMBA_CACHE_DIR` to choose where the cache is written.
+    """
+    from ormir_xct.util.hildebrand_thickness import warmup_kernels
+
+    warmup_kernels()
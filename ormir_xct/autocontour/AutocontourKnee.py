@@ -1,6 +1,120 @@
+import copy
+import time
+import inspect
+import itertools
+import threading
+import numpy as np
 import SimpleITK as sitk
-
-# import yaml
+from concurrent.futures import ThreadPoolExecutor
+
+from ormir_xct.util.lazy_import import lazy_import
+from ormir_xct.autocontour.pyramid import (
+    compare_masks,
+    downsample,
+    pyramid_morphology,
+    upsample,
+)
+from ormir_xct.autocontour.stage_graph import StageGraph, StageCache, value_key
+from ormir_xct.autocontour.profiling import (
+    Profiler,
+    profiled,
+    profile_from_environment,
+)
+from ormir_xct.util.slab_streaming import (
+    SlabLabels,
+    blank_image,
+    gaussian_radius,
+    image_geometry,
+    largest_connected_component,
+    map_slabs,
+    read_region,
+)
+
+# the distance transform pulls in numba, only load it for the "edt" backend
+edt_morphology = lazy_import("ormir_xct.util.edt_morphology")
+slice_connected_components = lazy_import("ormir_xct.util.slice_connected_components")
+yaml = lazy_import("yaml")
+
+# the ways the binary morphology can be computed, see `AutocontourKnee`
+MORPHOLOGY_BACKENDS = ("ball", "edt")
+
+# the attributes that the stages of the masks read, for the keys of
+# `StageCache`: those that all stages read, and those of each step, so that a
+# parameter sweep only reruns the steps whose parameters changed
+COMMON_PARAMETERS = (
+    "in_value",
+    "out_value",
+    "morphology",
+    "pyramid_factor",
+    "pyramid_min_radius",
+    "slab_size",
+    "DEFAULT_MAX_ERROR",
+    "USE_SPACING",
+)
+STEP_PARAMETERS = {
+    "_label_bones": (
+        "peri_s1_sigma",
+        "peri_s1_support",
+        "peri_s1_lower",
+        "peri_s1_upper",
+    ),
+    "_periosteal_step1": ("peri_s1_radius",),
+    "_periosteal_roi": (
+        "roi_crop",
+        "_sweep_radii",
+        "peri_s2_radius",
+        "peri_s3_radius",
+        "peri_s4_open_radius",
+        "peri_s4_close_radius",
+        "peri_s2_lower",
+        "peri_s2_upper",
+        "peri_s3_lower",
+        "peri_s3_upper",
+    ),
+    "_periosteal_step2": (
+        "peri_s2_sigma",
+        "peri_s2_support",
+        "peri_s2_lower",
+        "peri_s2_upper",
+        "peri_s2_radius",
+    ),
+    "_periosteal_step3": (
+        "peri_s3_sigma",
+        "peri_s3_support",
+        "peri_s3_lower",
+        "peri_s3_upper",
+        "peri_s3_radius",
+    ),
+    "_periosteal_step4": ("peri_s4_open_radius", "peri_s4_close_radius"),
+    "_endosteal_roi": (
+        "roi_crop",
+        "_sweep_radii",
+        "endo_min_cort_th",
+        "endo_open_radius",
+        "endo_open_close_radius",
+        "endo_corner_open_radius",
+        "endo_close_radius",
+        "endo_lower",
+        "endo_upper",
+    ),
+    "_endosteal_cortex": ("endo_sigma", "endo_support", "endo_lower", "endo_upper"),
+    "_endosteal_trabecular": ("endo_open_radius", "endo_open_close_radius"),
+    "_endosteal_corners": (
+        "endo_open_close_radius",
+        "endo_corner_open_radius",
+        "endo_min_number",
+    ),
+    "_endosteal_cortex_from_trabecular": (
+        "endo_close_radius",
+        "endo_slice_cl",
+        "endo_slice_cl_min_size",
+    ),
+}
+
+# each numba kernel already uses all threads, and numba's workqueue threading
+# layer must not be entered by several threads at once, so the bones contoured
+# concurrently by `get_periosteal_masks` take turns
+NUMBA_LOCK = threading.Lock()
 
 
 class AutocontourKnee:
@@ -64,6 +178,23 @@ class AutocontourKnee:
 
     endo_close_radius : int
 
+    morphology : str
+
+    roi_crop : bool
+
+    pyramid_factor : int
+
+    pyramid_min_radius : int
+
+    endo_slice_cl : bool
+
+    endo_slice_cl_min_size : int
+
+    slab_size : int
+
+    profiler : Profiler
+        The profiler that records every stage if profiling is on, else None.
+
     DEFAULT_MAX_ERROR : float
         Needed for the procedural interface of the sitk gaussian filter.
 
@@ -72,19 +203,95 @@ class AutocontourKnee:
 
     Methods
     -------
+    _check_parameters(morphology, pyramid_factor, slab_size=None)
+
+    get_parameters()
+
+    set_parameters(**parameters)
+
     _gaussian_and_threshold(img, sigma, support, lower, upper)
 
-    _get_largest_connected_component(img)
+    _get_largest_connected_component(img, roi=None)
 
     _inert_binary_image(img)
 
-    _close_with_connected_components(img, radius)
+    _close_with_connected_components(img, radius, roi=None)
+
+    _get_roi(mask, radius, thresholds)
+
+    _roi_radius(*names)
+
+    _crop(img, roi)
+
+    _paste(img, roi, reference)
+
+    _dilate(img, radius)
+
+    _erode(img, radius)
+
+    _opening(img, radius)
+
+    _closing(img, radius)
+
+    _morphology(img, operation, radius, pyramid=True)
+
+    _morphology_backend(img, operation, radius)
+
+    _downsample(img)
+
+    _upsample(img, reference)
+
+    _pyramid_morphology(img, operation, radius)
+
+    _slice_connected_components(img, min_size=None)
+
+    _label_bones(img)
+
+    _add_stage(graph, name, function, inputs, binary=False, **parameters)
+
+    _add_periosteal_step1_stage(graph, component)
+
+    _add_periosteal_stages(graph, component)
+
+    _periosteal_step1(img_conn, component)
+
+    _periosteal_roi(img_segmented_s1)
 
-    get_periosteal_mask(img)
+    _periosteal_step2(img, img_segmented_s1, roi)
+
+    _periosteal_step3(img, img_segmented_s2, roi)
+
+    _periosteal_step4(img_segmented_s1, img_segmented_s2, img_segmented_s3)
+
+    _add_endosteal_stages(graph, component)
+
+    _endosteal_roi(peri)
+
+    _endosteal_cortex(img, peri, peri_eroded, roi)
+
+    _endosteal_trabecular(peri, cort)
+
+    _endosteal_corners(trab)
+
+    _endosteal_cortex_from_trabecular(peri, peri_eroded, trab)
+
+    get_periosteal_mask(img, component)
+
+    get_periosteal_masks(img, components, n_threads)
 
     get_endosteal_mask(img, peri)
 
-    get_masks(img)
+    get_masks(img, components, return_report=False)
+
+    _add_mask_stages(graph, components)
+
+    sweep(img, grid, components=(1, 2), cache=None)
+
+    evaluate_pyramid(img, components)
+
+    save_parameters_to_yaml(fn)
+
+    load_parameters_from_yaml(fn)
 
     """
 
@@ -118,6 +325,14 @@ class AutocontourKnee:
         endo_open_close_radius=15,
         endo_corner_open_radius=3,
         endo_close_radius=50,
+        morphology="ball",
+        roi_crop=True,
+        pyramid_factor=1,
+        pyramid_min_radius=15,
+        endo_slice_cl=False,
+        endo_slice_cl_min_size=None,
+        slab_size=None,
+        profile=None,
     ):
         """
         Initialization method.
@@ -231,7 +446,70 @@ class AutocontourKnee:
 
         endo_close_radius : int
 
+        morphology : str
+            How the dilations, erosions, openings and closings are computed.
+            "ball" uses the SimpleITK filters with a `sitk.sitkBall` kernel,
+            whose cost grows with the radius. "edt" thresholds an exact
+            Euclidean distance transform instead, which costs the same for
+            any radius and gives identical masks. Default is "ball".
+
+        roi_crop : bool
+            Set this to True to run the steps of the periosteal mask after the
+            first rough mask, and all steps of the endosteal mask, on the
+            bounding box of the current mask padded by the largest radius still
+            to come, instead of on the whole image. The masks are identical
+            either way when `pyramid_factor` is 1. Default is True.
+
+        pyramid_factor : int
+            Set this to 2 or 4 to compute the dilations, erosions, openings and
+            closings with a radius of at least `pyramid_min_radius` on the
+            image downsampled by this factor, refining only a band of
+            `pyramid_factor` voxels around the boundary at full resolution.
+            This is much faster for the large radii of the periosteal and
+            endosteal masks, but only approximates them, see
+            `evaluate_pyramid`. Default is 1, which computes every operation at
+            full resolution.
+
+        pyramid_min_radius : int
+            Smallest radius, in voxels, of the operations that are computed
+            coarse to fine when `pyramid_factor` is more than 1. Default is 15
+            voxels.
+
+        endo_slice_cl : bool
+            Set this to True to keep only the largest connected component of
+            the trabecular mask in every slice, before the endosteal mask is
+            computed from it, like the slice-wise component labelling step of
+            the IPL script. Default is False.
+
+        endo_slice_cl_min_size : int
+            If given, keep the components of the trabecular mask with at least
+            this many voxels in their slice instead of only the largest one
+            when `endo_slice_cl` is True. Default is None.
+
+        slab_size : int
+            Set this to a number of z slices to compute the masks of long
+            multi-stack scans a slab of that many slices at a time. The
+            filters read each slab padded with the slices they reach beyond
+            it, and the connected components of the slabs are merged across
+            the slabs with union-find, so the masks are identical to those of
+            the whole image, while only one slab of the gaussian filtered
+            image, of the distance transforms and of the component labels is
+            in memory at a time. The gray-scale image can then also be given
+            as the path of an image file, which is read a slab or a region of
+            interest at a time. The slabs should be thicker than twice the
+            largest radius, which the closings read on both sides. Needs
+            `pyramid_factor` 1. Default is None, which processes the whole
+            image at once.
+
+        profile : bool
+            Set this to True to record the wall time and the size of the
+            output of every stage in `profiler`, see
+            `ormir_xct.autocontour.profiling`. If None, profiling is on when
+            the environment variable ORMIR_XCT_PROFILE is set to 1. Default is
+            None.
+
         """
+        self._check_parameters(morphology, pyramid_factor, slab_size)
 
         self.in_value = in_value
         self.out_value = 0  # this should only be zero
@@ -268,9 +546,86 @@ class AutocontourKnee:
         self.endo_corner_open_radius = endo_corner_open_radius
         self.endo_close_radius = endo_close_radius
 
+        self.morphology = morphology
+        self.roi_crop = roi_crop
+        self.pyramid_factor = int(pyramid_factor)
+        self.pyramid_min_radius = pyramid_min_radius
+
+        self.endo_slice_cl = endo_slice_cl
+        self.endo_slice_cl_min_size = endo_slice_cl_min_size
+
+        self.slab_size = slab_size
+
+        if profile is None:
+            profile = profile_from_environment()
+        self.profiler = Profiler() if profile else None
+
         self.DEFAULT_MAX_ERROR = 0.01
         self.USE_SPACING = False
 
+        # the largest radius of each radius parameter of a sweep, as (name,
+        # radius) pairs, see `_roi_radius`
+        self._sweep_radii = ()
+
+    @staticmethod
+    def _check_parameters(morphology, pyramid_factor, slab_size=None):
+        """
+        Raise a ValueError if the morphology backend, the pyramid factor or the
+        slab size are not valid.
+        """
+        if morphology not in MORPHOLOGY_BACKENDS:
+            raise ValueError(f"morphology must be one of {MORPHOLOGY_BACKENDS}")
+        if int(pyramid_factor) != pyramid_factor or pyramid_factor < 1:
+            raise ValueError("pyramid_factor must be a positive integer")
+        if slab_size is not None:
+            if int(slab_size) != slab_size or slab_size < 1:
+                raise ValueError("slab_size must be a positive integer")
+            # the coarse voxels of the pyramid would not line up with the slabs
+            if pyramid_factor != 1:
+                raise ValueError("slab_size needs pyramid_factor 1")
+
+    def get_parameters(self):
+        """
+        The parameters of the contouring, with the names of the arguments of
+        `__init__`.
+
+        Returns
+        -------
+        dict
+            The value of every parameter, by name.
+        """
+
+        names = list(inspect.signature(AutocontourKnee.__init__).parameters)
+        return {
+            name: getattr(self, name)
+            for name in names
+            if name not in ("self", "profile")
+        }
+
+    def set_parameters(self, **parameters):
+        """
+        Change some of the parameters of the contouring.
+
+        Parameters
+        ----------
+        **parameters
+            The new values, by the names of the arguments of `__init__`.
+        """
+
+        current = self.get_parameters()
+        unknown = sorted(set(parameters) - set(current))
+        if unknown:
+            raise ValueError(f"unknown parameters: {unknown}")
+        current.update(parameters)
+        self._check_parameters(
+            current["morphology"], current["pyramid_factor"], current["slab_size"]
+        )
+
+        for name, value in parameters.items():
+            setattr(self, name, value)
+        self.pyramid_factor = int(self.pyramid_factor)
+
+    @profiled("gauss")
     def _gaussian_and_threshold(self, img, sigma, support, lower, upper):
         """
         Gaussian smooth and then binarize an image using a threshold filter.
@@ -278,7 +633,7 @@ class AutocontourKnee:
         Parameters
         ----------
         img : sitk.Image
-            The input image.
+            The input image, or the path of an image file.
 
         sigma : float
             Variance for the gaussian filtering.
@@ -298,22 +653,35 @@ class AutocontourKnee:
             The binarized image.
         """
 
-        # gaussian filtering
-        # Suppress warnings from the Gaussian function about kernel size
-        sitk.ProcessObject_SetGlobalWarningDisplay(False)
-        img_gauss = sitk.DiscreteGaussian(
-            img, sigma, support, self.DEFAULT_MAX_ERROR, self.USE_SPACING
-        )
-        sitk.ProcessObject_SetGlobalWarningDisplay(True)
-
-        # binary segmentation
-        img_segmented = sitk.BinaryThreshold(
-            img_gauss, lower, upper, self.in_value, self.out_value
+        def gaussian_and_threshold(img):
+            # gaussian filtering
+            # Suppress warnings from the Gaussian function about kernel size
+            sitk.ProcessObject_SetGlobalWarningDisplay(False)
+            img_gauss = sitk.DiscreteGaussian(
+                img, sigma, support, self.DEFAULT_MAX_ERROR, self.USE_SPACING
+            )
+            sitk.ProcessObject_SetGlobalWarningDisplay(True)
+
+            # binary segmentation
+            return sitk.BinaryThreshold(
+                img_gauss, lower, upper, self.in_value, self.out_value
+            )
+
+        if self.slab_size is None and isinstance(img, sitk.Image):
+            return gaussian_and_threshold(img)
+
+        # the slabs are padded with the slices that the kernel reaches
+        halo = gaussian_radius(
+            sigma,
+            support,
+            self.DEFAULT_MAX_ERROR,
+            self.USE_SPACING,
+            image_geometry(img)[2][2],
         )
+        return map_slabs(gaussian_and_threshold, [img], self.slab_size, halo)
 
-        return img_segmented
-
-    def _get_largest_connected_component(self, img):
+    @profiled("largest_cc")
+    def _get_largest_connected_component(self, img, roi=None):
         """
         Get the largest connected component in a binary image.
 
@@ -322,6 +690,12 @@ class AutocontourKnee:
         img : sitk.Image
             The binary image to filter.
 
+        roi : tuple
+            If the image was cropped with `_crop` from a larger image in which
+            all voxels outside of the crop are foreground, the `roi` it was
+            cropped with. The largest component is then chosen as it would be
+            in the larger image, see `largest_connected_component`.
+
         Returns
         -------
         sitk.Image
@@ -329,11 +703,7 @@ class AutocontourKnee:
             the input image.
         """
 
-        img_conn = sitk.ConnectedComponent(img, img, True)
-        img_conn = sitk.RelabelComponent(img_conn, sortByObjectSize=True)
-        img_conn = self.in_value * (img_conn == 1)
-
-        return img_conn
+        return largest_connected_component(img, self.slab_size, roi, self.in_value)
 
     def _invert_binary_image(self, img):
         """
@@ -350,64 +720,73 @@ class AutocontourKnee:
             The inverted binary image.
         """
 
-        return self.in_value * (img != self.in_value)
+        return sitk.BinaryThreshold(
+            img, self.in_value, self.in_value, self.out_value, self.in_value
+        )
 
-    def _close_with_connected_components(self, img, radius):
+    def _select_label(self, img, label):
         """
-        Perform a morphological closing operation on a binary image, except
-        with a connected component filtering step to keep only the largest
-        connected component of the background interposed between the dilation
-        and the erosion.
+        The voxels of a label image with one label, as a binary image. Unlike
+        `self.in_value * (img == label)`, no image with the pixel type of the
+        labels is allocated.
 
         Parameters
         ----------
         img : sitk.Image
-            The binary image to filter.
+            The label image.
 
-        radius : int
-            The radius to use for the dilation and erosion.
+        label : int
+            The label to select.
 
         Returns
         -------
         sitk.Image
-            The filtered image.
+            The binary uint8 image of the voxels with the label.
         """
 
-        # dilate to close holes in cortex
-        img = sitk.BinaryDilate(
-            img, [radius] * 3, sitk.sitkBall, self.out_value, self.in_value
-        )
+        return sitk.BinaryThreshold(img, label, label, self.in_value, self.out_value)
 
-        # invert the image to switch to background
-        img = self._invert_binary_image(img)
+    def _and_not(self, img, mask):
+        """
+        The foreground of a binary image that is not in the foreground of
+        another one, like `self.in_value * sitk.And(img, sitk.Not(mask))` but
+        in one pass, without the intermediate images.
 
-        # perform connected components on background
-        img = self._get_largest_connected_component(img)
+        Parameters
+        ----------
+        img : sitk.Image
+            The binary image.
 
-        # reinvert to get back to foreground
-        img = self._invert_binary_image(img)
+        mask : sitk.Image
+            The binary image to remove from it.
 
-        # erode back the dilated bone volume
-        img = sitk.BinaryErode(
-            img, [radius] * 3, sitk.sitkBall, self.out_value, self.in_value
-        )
+        Returns
+        -------
+        sitk.Image
+            The binary image.
+        """
 
-        return img
+        return sitk.MaskNegated(img, mask, self.out_value, self.out_value)
 
-    def _open_with_connected_components(self, img, radius):
+    def _edt_morphology(self, img, operation, radius):
         """
-        Perform a morphological opening operation on a binary image, except
-        with a connected component filtering step to keep only the largest
-        connected component of the background interposed between the erosion
-        and the dilation.
+        Apply one of the binary operations of `edt_morphology` to the
+        foreground voxels of an image. Voxels that become foreground are set
+        to `in_value`, foreground voxels that are removed are set to
+        `out_value`, and all other voxels are left unchanged, like the
+        SimpleITK binary filters do.
 
         Parameters
         ----------
         img : sitk.Image
             The binary image to filter.
 
+        operation : function
+            One of `binary_dilation`, `binary_erosion`, `binary_opening` and
+            `binary_closing` from `edt_morphology`.
+
         radius : int
-            The radius to use for the dilation and erosion.
+            The radius of the ball in voxels.
 
         Returns
         -------
@@ -415,196 +794,965 @@ class AutocontourKnee:
             The filtered image.
         """
 
-        # erode back the dilated bone volume
-        img = sitk.BinaryErode(
-            img, [radius] * 3, sitk.sitkBall, self.out_value, self.in_value
-        )
-
-        # perform connected components on background
-        img = self._get_largest_connected_component(img)
+        array = sitk.GetArrayFromImage(img)
+        foreground = array == self.in_value
+        with NUMBA_LOCK:
+            result = operation(foreground, radius)
+        array[result] = self.in_value
+        array[foreground & ~result] = self.out_value
 
-        # dilate to close holes in cortex
-        img = sitk.BinaryDilate(
-            img, [radius] * 3, sitk.sitkBall, self.out_value, self.in_value
-        )
+        img_filtered = sitk.GetImageFromArray(array)
+        img_filtered.CopyInformation(img)
 
-        return img
+        return img_filtered
 
-    def _extract_large_regions(self, img, num_voxels):
+    @profiled(lambda img, operation, radius, pyramid=True: f"{operation}_{radius}")
+    def _morphology(self, img, operation, radius, pyramid=True):
         """
-        Take a binary image and use connected components and label stats to
-        keep only connected regions above a certain size.
+        Apply a binary morphological operation with a ball of the given radius
+        in voxels, computed with the `morphology` backend. If `pyramid_factor`
+        is more than 1, operations with a radius of at least
+        `pyramid_min_radius` are computed coarse to fine by
+        `_pyramid_morphology` instead. If `slab_size` is set, the operation is
+        computed slab by slab.
 
         Parameters
         ----------
         img : sitk.Image
-            A binary image to be filtered.
+            The binary image to filter.
 
-        num_voxels : int
-            The minimum number of voxels a region needs to have to be kept.
+        operation : str
+            One of "dilate", "erode", "opening" and "closing".
+
+        radius : int
+            The radius of the ball in voxels.
+
+        pyramid : bool
+            Set this to False to always compute the operation at the
+            resolution of the image.
 
         Returns
         -------
         sitk.Image
-            The filtered binary image.
+            The filtered image.
         """
 
-        # create an image of zeros as a base
-        img_cl = sitk.ConnectedComponent(img, img, True)
-        img_cl_min = sitk.RelabelComponent(img_cl, num_voxels, True)
+        if pyramid and self.pyramid_factor > 1 and radius >= self.pyramid_min_radius:
+            return self._pyramid_morphology(img, operation, radius)
 
-        return self.in_value * (img_cl_min > 0)
+        if self.slab_size is not None:
+            # an opening or a closing reaches twice as far as its ball
+            halo = radius if operation in ("dilate", "erode") else 2 * radius
+            return map_slabs(
+                lambda slab: self._morphology_backend(slab, operation, radius),
+                [img],
+                self.slab_size,
+                halo,
+            )
 
-    def get_periosteal_mask(self, img, component):
+        return self._morphology_backend(img, operation, radius)
+
+    def _morphology_backend(self, img, operation, radius):
         """
-        Compute the periosteal mask from an input image.
+        Apply a binary morphological operation with a ball of the given radius
+        in voxels to the whole image, computed with the `morphology` backend.
 
         Parameters
         ----------
         img : sitk.Image
-            The gray-scale AIM. Currently this is written for images in HU,
-            if you want to input a density image then you'll need to modify
-            the lower and upper thresholds to be in the correct units.
+            The binary image to filter.
+
+        operation : str
+            One of "dilate", "erode", "opening" and "closing".
+
+        radius : int
+            The radius of the ball in voxels.
 
         Returns
         -------
         sitk.Image
-            A binary image that is the periosteal mask.
+            The filtered image.
         """
 
-        # STEP 1: Mask out the largest bone only
-
-        img_segmented = self._gaussian_and_threshold(
-            img,
-            self.peri_s1_sigma,
-            self.peri_s1_support,
-            self.peri_s1_lower,
-            self.peri_s1_upper,
+        if self.morphology == "edt":
+            function = {
+                "dilate": edt_morphology.binary_dilation,
+                "erode": edt_morphology.binary_erosion,
+                "opening": edt_morphology.binary_opening,
+                "closing": edt_morphology.binary_closing,
+            }[operation]
+            return self._edt_morphology(img, function, radius)
+
+        if operation == "dilate":
+            return sitk.BinaryDilate(
+                img, [radius] * 3, sitk.sitkBall, self.out_value, self.in_value
+            )
+        if operation == "erode":
+            return sitk.BinaryErode(
+                img, [radius] * 3, sitk.sitkBall, self.out_value, self.in_value
+            )
+        if operation == "opening":
+            return sitk.BinaryMorphologicalOpening(
+                img, [radius] * 3, sitk.sitkBall, self.out_value, self.in_value
+            )
+        return sitk.BinaryMorphologicalClosing(
+            img, [radius] * 3, sitk.sitkBall, self.in_value
         )
 
-        # component labelling to keep only largest region
-        img_conn = sitk.ConnectedComponent(img_segmented, img_segmented, True)
-        img_conn = sitk.RelabelComponent(img_conn, sortByObjectSize=True)
-        img_segmented = self.in_value * (img_conn == component)
-        # img_segmented = self._get_largest_connected_component(img_segmented)
-
-        # dilation
-        # !!!NOTE: I'm using a Euclidean metric for the structirng element,
-        # the IPL implementation uses the 3-4-5 chamfer metric. Feel free to
-        # swap out the code if you can figure out how to get the 3-4-5
-        # chamfer metric in SimpleITK
-
-        img_segmented = sitk.BinaryDilate(
-            img_segmented,
-            [self.peri_s1_radius] * 3,
-            sitk.sitkBall,
-            self.out_value,
-            self.in_value,
-        )
+    def _dilate(self, img, radius):
+        """
+        Binary dilation with a ball of the given radius in voxels, see
+        `_morphology`.
 
-        # invert the image to get the background
-        img_segmented = self._invert_binary_image(img_segmented)
+        Parameters
+        ----------
+        img : sitk.Image
+            The binary image to filter.
 
-        # connected components on the background
-        img_segmented = self._get_largest_connected_component(img_segmented)
+        radius : int
+            The radius of the ball in voxels.
 
-        # invert back to foreground
-        img_segmented = self._invert_binary_image(img_segmented)
+        Returns
+        -------
+        sitk.Image
+            The dilated image.
+        """
 
-        # mask the original image using this segmentation
-        img_masked = sitk.Mask(img, img_segmented)
+        return self._morphology(img, "dilate", radius)
 
-        # and save the segmentation to use later
-        img_segmented_s1 = img_segmented
+    def _erode(self, img, radius):
+        """
+        Binary erosion with a ball of the given radius in voxels, see
+        `_morphology`.
 
-        # STEP 2: create a mask with a low threshold
+        Parameters
+        ----------
+        img : sitk.Image
+            The binary image to filter.
 
-        # threshold using low threshold
-        img_segmented = self._gaussian_and_threshold(
-            img_masked,
-            self.peri_s2_sigma,
-            self.peri_s2_support,
-            self.peri_s2_lower,
-            self.peri_s2_upper,
-        )
+        radius : int
+            The radius of the ball in voxels.
 
-        # keep only largest component
-        img_segmented = self._get_largest_connected_component(img_segmented)
+        Returns
+        -------
+        sitk.Image
+            The eroded image.
+        """
 
-        # dilate/conn comp/erode to close holes in cortex
-        img_segmented = self._close_with_connected_components(
-            img_segmented, self.peri_s2_radius
-        )
+        return self._morphology(img, "erode", radius)
 
-        # now mask the image using the latest segmentation
-        img_masked = sitk.Mask(img, img_segmented)
+    def _opening(self, img, radius):
+        """
+        Binary morphological opening with a ball of the given radius in voxels, see
+        `_morphology`.
 
-        # save the final segmentation from step 2
-        img_segmented_s2 = img_segmented
+        Parameters
+        ----------
+        img : sitk.Image
+            The binary image to filter.
 
-        # STEP 3: create another mask with a slightly higher threshold
+        radius : int
+            The radius of the ball in voxels.
 
-        # gaussian blur and segment with higher threshold
-        img_segmented = self._gaussian_and_threshold(
-            img_masked,
-            self.peri_s3_sigma,
-            self.peri_s3_support,
-            self.peri_s3_lower,
-            self.peri_s3_upper,
-        )
+        Returns
+        -------
+        sitk.Image
+            The opened image.
+        """
 
-        # dilate/conn comp/erode to close holes in cortex
-        img_segmented = self._close_with_connected_components(
-            img_segmented, self.peri_s3_radius
-        )
+        return self._morphology(img, "opening", radius)
 
-        # again, mask the image with the new segmentation
-        img_masked = sitk.Mask(img, img_segmented)
+    def _closing(self, img, radius):
+        """
+        Binary morphological closing with a ball of the given radius in voxels, see
+        `_morphology`.
 
-        # save the final segmentation from step 3
-        img_segmented_s3 = img_segmented
+        Parameters
+        ----------
+        img : sitk.Image
+            The binary image to filter.
 
-        # STEP 4: Create the final segmentation using the segmentations from
-        # steps 2 and 3
+        radius : int
+            The radius of the ball in voxels.
 
-        # find where the two masks are different
-        img_segmented_diff = self.in_value * (
-            (img_segmented_s2 == self.in_value) != (img_segmented_s3 == self.in_value)
-        )
+        Returns
+        -------
+        sitk.Image
+            The closed image.
+        """
 
-        # do an opening on the diff
-        img_segmented_diff_open = sitk.BinaryMorphologicalOpening(
-            img_segmented_diff,
-            [self.peri_s4_open_radius] * 3,
-            sitk.sitkBall,
-            self.out_value,
-            self.in_value,
-        )
+        return self._morphology(img, "closing", radius)
 
-        # combine this with the segmentation from step 3
-        peri_mask = self.in_value * sitk.Or(
-            img_segmented_s3 == self.in_value, img_segmented_diff_open == self.in_value
-        )
+    @profiled("downsample")
+    def _downsample(self, img):
+        """
+        Downsample a binary image by `pyramid_factor`, see `downsample`.
 
-        # perform a smoothening close
-        # !!NOTE: This operation is in the original script but it seems to do
-        # more harm than good on the knee scans: the bone surface is not convex
-        # so ending with a high-radius close smooths the mask over concave
-        # surface features. Qualitatively, it seems to me like a candidate for
-        # improving the algorithm would be to replace this with an opening
-        peri_mask = sitk.BinaryMorphologicalClosing(
-            peri_mask, [self.peri_s4_close_radius] * 3, sitk.sitkBall, self.in_value
-        )
+        Parameters
+        ----------
+        img : sitk.Image
+            The binary image.
 
-        # mask the final peri mask using the first rough mask we created in
-        # step 1
-        peri_mask = sitk.Mask(peri_mask, img_segmented_s1)
+        Returns
+        -------
+        sitk.Image
+            The coarse binary image.
+        """
 
-        return peri_mask
+        return downsample(img, self.pyramid_factor, self.in_value, self.out_value)
 
-    def get_endosteal_mask(self, img, peri):
+    @profiled("upsample")
+    def _upsample(self, img, reference):
         """
-        Compute the endosteal mask from the image and periosteal mask.
+        Upsample a coarse binary image from `_downsample` to the grid of the
+        image it was downsampled from, see `upsample`.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The coarse binary image.
+
+        reference : sitk.Image
+            The image that was downsampled.
+
+        Returns
+        -------
+        sitk.Image
+            The binary image on the grid of `reference`.
+        """
+
+        return upsample(img, reference, self.out_value)
+
+    def _pyramid_morphology(self, img, operation, radius):
+        """
+        Approximate a large radius morphological operation coarse to fine,
+        with `pyramid_factor` as the factor, see `pyramid_morphology`.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The binary image to filter.
+
+        operation : str
+            One of "dilate", "erode", "opening" and "closing".
+
+        radius : int
+            The radius of the ball in voxels.
+
+        Returns
+        -------
+        sitk.Image
+            The filtered image.
+        """
+
+        return pyramid_morphology(
+            img,
+            operation,
+            radius,
+            self.pyramid_factor,
+            lambda img, operation, radius: self._morphology(
+                img, operation, radius, pyramid=False
+            ),
+            self._downsample,
+            self._upsample,
+        )
+
+    def _get_roi(self, mask, radius, thresholds):
+        """
+        Region of interest for the steps that follow a mask: the bounding box
+        of the mask, padded by `radius` + 1 voxels and clipped to the image.
+        When those steps only dilate by up to `radius`, all their foreground
+        stays inside of it, and they give the same result on the cropped
+        images as on the whole images.
+
+        Parameters
+        ----------
+        mask : sitk.Image
+            The binary mask that the following steps are restricted to.
+
+        radius : int
+            The largest radius of the following morphological operations.
+
+        thresholds : list
+            The (lower, upper) thresholds of the following steps. The images
+            they threshold are zero outside of the mask, so cropping is only
+            exact when zero is outside of all of these ranges.
+
+        Returns
+        -------
+        tuple
+            The index and size of the region, and the size of the image, in
+            SimpleITK's (x, y, z) order. None if cropping is switched off or
+            not exact, the mask is empty, or the region is the whole image.
+        """
+
+        if not self.roi_crop or any(lower <= 0 <= upper for lower, upper in thresholds):
+            return None
+
+        array = sitk.GetArrayViewFromImage(mask) == self.in_value
+        if not array.any():
+            return None
+
+        # the coarse voxels of the pyramid reach up to `pyramid_factor` voxels
+        # further, and so can the full resolution refinement
+        if self.pyramid_factor > 1:
+            radius += 2 * self.pyramid_factor
+
+        image_size = mask.GetSize()
+        index, size = [], []
+        for axis in range(3):
+            # sitk axis 0 is numpy axis 2
+            other_axes = tuple(a for a in range(3) if a != 2 - axis)
+            nonzero = np.flatnonzero(array.any(axis=other_axes))
+            lower = max(int(nonzero[0]) - radius - 1, 0)
+            upper = min(int(nonzero[-1]) + radius + 2, image_size[axis])
+            index.append(lower)
+            size.append(upper - lower)
+
+        if tuple(size) == image_size:
+            return None
+
+        return index, size, image_size
+
+    def _roi_radius(self, *names):
+        """
+        The largest of some radius parameters, to pad a region of interest
+        with. A parameter sweep pads the regions of interest for the largest
+        value of each radius in its grid instead, `_sweep_radii`, so that
+        they do not change with the radius, and the stages on the crops are
+        found in its cache. Cropping is exact either way, unless the pyramid
+        mode approximates the large radius operations.
+
+        Parameters
+        ----------
+        *names : str
+            The names of the radius parameters.
+
+        Returns
+        -------
+        int
+            The radius in voxels.
+        """
+
+        sweep_radii = dict(self._sweep_radii) if self.pyramid_factor == 1 else {}
+        return max(max(getattr(self, n), sweep_radii.get(n, 0)) for n in names)
+
+    def _crop(self, img, roi):
+        """
+        Crop an image to a region of interest from `_get_roi`.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The image to crop, or the path of an image file, of which only the
+            region is read.
+
+        roi : tuple
+            The region of interest, or None to return the image as is.
+
+        Returns
+        -------
+        sitk.Image
+            The cropped image, with the origin of the region.
+        """
+
+        if roi is None:
+            return read_region(img)
+        return read_region(img, roi[0], roi[1])
+
+    def _paste(self, img, roi, reference):
+        """
+        Paste a binary image cropped with `_crop` back into an image of the
+        size of the original one, with `out_value` outside of the region.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The cropped binary image.
+
+        roi : tuple
+            The region of interest it was cropped with, or None to return the
+            image as is.
+
+        reference : sitk.Image
+            The image that was cropped, or the path of its image file.
+
+        Returns
+        -------
+        sitk.Image
+            The binary image with the size and geometry of `reference`.
+        """
+
+        if roi is None:
+            return img
+        img_full = blank_image(reference, img.GetPixelID())
+        return sitk.Paste(img_full, img, img.GetSize(), [0, 0, 0], roi[0])
+
+    @profiled("close_cc")
+    def _close_with_connected_components(self, img, radius, roi=None):
+        """
+        Perform a morphological closing operation on a binary image, except
+        with a connected component filtering step to keep only the largest
+        connected component of the background interposed between the dilation
+        and the erosion.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The binary image to filter.
+
+        radius : int
+            The radius to use for the dilation and erosion.
+
+        roi : tuple
+            If the image was cropped with `_crop` from a larger image that is
+            background outside of the crop, the `roi` it was cropped with.
+
+        Returns
+        -------
+        sitk.Image
+            The filtered image.
+        """
+
+        # dilate to close holes in cortex
+        img = self._dilate(img, radius)
+
+        # invert the image to switch to background
+        img = self._invert_binary_image(img)
+
+        # perform connected components on background
+        img = self._get_largest_connected_component(img, roi)
+
+        # reinvert to get back to foreground
+        img = self._invert_binary_image(img)
+
+        # erode back the dilated bone volume
+        img = self._erode(img, radius)
+
+        return img
+
+    @profiled("slice_cl")
+    def _slice_connected_components(self, img, min_size=None):
+        """
+        Keep the largest connected component, or the connected components of
+        at least a given size, in every z slice of a binary image, with the
+        same full connectivity as `_get_largest_connected_component`. Unlike
+        calling `sitk.ConnectedComponent` slice by slice, all slices are
+        labelled in one call, in parallel.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The binary image to filter.
+
+        min_size : int
+            If None, keep the largest component of every slice. Otherwise,
+            keep the components with at least this many voxels.
+
+        Returns
+        -------
+        sitk.Image
+            The filtered image.
+        """
+
+        array = sitk.GetArrayFromImage(img)
+        with NUMBA_LOCK:
+            keep = slice_connected_components.filter_slice_components(
+                array == self.in_value, min_size, fully_connected=True
+            )
+        array[~keep] = self.out_value
+
+        img_filtered = sitk.GetImageFromArray(array)
+        img_filtered.CopyInformation(img)
+
+        return img_filtered
+
+    @profiled("open_cc")
+    def _open_with_connected_components(self, img, radius):
+        """
+        Perform a morphological opening operation on a binary image, except
+        with a connected component filtering step to keep only the largest
+        connected component of the background interposed between the erosion
+        and the dilation.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The binary image to filter.
+
+        radius : int
+            The radius to use for the dilation and erosion.
+
+        Returns
+        -------
+        sitk.Image
+            The filtered image.
+        """
+
+        # erode back the dilated bone volume
+        img = self._erode(img, radius)
+
+        # perform connected components on background
+        img = self._get_largest_connected_component(img)
+
+        # dilate to close holes in cortex
+        img = self._dilate(img, radius)
+
+        return img
+
+    @profiled("large_regions")
+    def _extract_large_regions(self, img, num_voxels):
+        """
+        Take a binary image and use connected components and label stats to
+        keep only connected regions above a certain size.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            A binary image to be filtered.
+
+        num_voxels : int
+            The minimum number of voxels a region needs to have to be kept.
+
+        Returns
+        -------
+        sitk.Image
+            The filtered binary image.
+        """
+
+        # the components of at least num_voxels voxels, like
+        # `sitk.RelabelComponent` keeps, mapped straight from the labels to a
+        # uint8 image
+        labels = SlabLabels(img, self.slab_size)
+        values = np.where(
+            labels.sizes >= num_voxels, self.in_value, self.out_value
+        ).astype(np.uint8)
+        values[0] = self.out_value
+
+        return labels.map(values)
+
+    def _label_bones(self, img):
+        """
+        The part of step 1 of the periosteal mask that is the same for all
+        bones: threshold the smoothed image and label its connected
+        components from the largest to the smallest.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The gray-scale AIM, or the path of its image file.
+
+        Returns
+        -------
+        sitk.Image
+            The uint8 label image, with label 1 for the largest component.
+            Only the 255 largest components are labelled, the smaller ones
+            are background.
+        """
+
+        img_segmented = self._gaussian_and_threshold(
+            img,
+            self.peri_s1_sigma,
+            self.peri_s1_support,
+            self.peri_s1_lower,
+            self.peri_s1_upper,
+        )
+
+        # the ranks of the labels by size, on ties by label, like
+        # `sitk.RelabelComponent`, mapped straight to a uint8 image instead of
+        # relabelling the uint32 labels
+        labels = SlabLabels(img_segmented, self.slab_size)
+        order = np.lexsort((np.arange(1, labels.sizes.size), -labels.sizes[1:]))
+        ranks = np.zeros(labels.sizes.size, dtype=np.uint8)
+        largest = order[: np.iinfo(np.uint8).max]
+        ranks[largest + 1] = np.arange(1, largest.size + 1)
+
+        return labels.map(ranks)
+
+    def _add_stage(self, graph, name, function, inputs, binary=False, **parameters):
+        """
+        Add a step to a stage graph, with the parameters of this object that
+        it reads, `COMMON_PARAMETERS` and its `STEP_PARAMETERS`, as the
+        settings of the stage.
+
+        Parameters
+        ----------
+        graph : StageGraph
+            The graph to add the stage to.
+
+        name : str
+            The name of the stage.
+
+        function : callable
+            A method of this object.
+
+        inputs : list
+            The names of the values to pass to `function`.
+
+        binary : bool
+            Whether the output is a binary image.
+
+        **parameters
+            Keyword arguments for `function`.
+
+        Returns
+        -------
+        str
+            `name`.
+        """
+
+        names = COMMON_PARAMETERS + STEP_PARAMETERS.get(function.__name__, ())
+        settings = {name: getattr(self, name) for name in names}
+        return graph.add_stage(name, function, inputs, binary, settings, **parameters)
+
+    def get_periosteal_mask(self, img, component):
+        """
+        Compute the periosteal mask from an input image.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The gray-scale AIM. Currently this is written for images in HU,
+            if you want to input a density image then you'll need to modify
+            the lower and upper thresholds to be in the correct units.
+
+        component : int
+            Which bone to contour, by size: 1 for the largest bone, 2 for the
+            second largest, and so on.
+
+        Returns
+        -------
+        sitk.Image
+            A binary image that is the periosteal mask.
+        """
+
+        graph = StageGraph(self.profiler)
+        self._add_stage(graph, "labels", self._label_bones, ["img"])
+        self._add_periosteal_step1_stage(graph, component)
+        peri = self._add_periosteal_stages(graph, component)
+
+        return graph.run({"img": img}, [peri])[0]
+
+    def get_periosteal_masks(self, img, components=(1, 2), n_threads=None):
+        """
+        Compute the periosteal masks of several bones in an image. The first
+        part of step 1 is shared by all bones, and the rest runs for each
+        bone concurrently. The masks are the same as those of
+        `get_periosteal_mask`.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The gray-scale AIM. Currently this is written for images in HU,
+            if you want to input a density image then you'll need to modify
+            the lower and upper thresholds to be in the correct units.
+
+        components : list
+            Which bones to contour, by size: 1 for the largest bone, 2 for the
+            second largest, and so on. Default is (1, 2).
+
+        n_threads : int
+            Number of bones to contour at the same time. The SimpleITK filters
+            release the GIL and are multithreaded themselves. If None, all
+            bones are contoured at the same time; 1 contours them one after
+            the other.
+
+        Returns
+        -------
+        list
+            The periosteal masks, in the order of `components`.
+        """
+
+        graph = StageGraph(self.profiler)
+        self._add_stage(graph, "labels", self._label_bones, ["img"])
+        img_conn = graph.run({"img": img}, ["labels"])[0]
+
+        def periosteal_mask(component):
+            graph = StageGraph(self.profiler)
+            self._add_periosteal_step1_stage(graph, component)
+            peri = self._add_periosteal_stages(graph, component)
+            return graph.run({"img": img, "labels": img_conn}, [peri])[0]
+
+        if n_threads == 1 or len(components) < 2:
+            return [periosteal_mask(component) for component in components]
+        with ThreadPoolExecutor(n_threads or len(components)) as executor:
+            return list(executor.map(periosteal_mask, components))
+
+    def _add_periosteal_step1_stage(self, graph, component):
+        """
+        Add step 1 of the periosteal mask of a bone to a stage graph. The
+        stage reads the labels of `_label_bones`, "labels".
+
+        Parameters
+        ----------
+        graph : StageGraph
+            The graph to add the stage to.
+
+        component : int
+            Which bone to contour, by size: 1 for the largest bone.
+
+        Returns
+        -------
+        str
+            The name of the mask of step 1, "peri_<component>_s1".
+        """
+
+        return self._add_stage(
+            graph,
+            f"peri_{component}_s1",
+            self._periosteal_step1,
+            ["labels"],
+            binary=True,
+            component=component,
+        )
+
+    def _add_periosteal_stages(self, graph, component):
+        """
+        Add the stages of the periosteal mask of a bone after step 1 to a
+        stage graph. The stages read the gray-scale image "img" and the mask
+        of `_add_periosteal_step1_stage`.
+
+        Parameters
+        ----------
+        graph : StageGraph
+            The graph to add the stages to.
+
+        component : int
+            Which bone to contour, by size: 1 for the largest bone.
+
+        Returns
+        -------
+        str
+            The name of the periosteal mask, "peri_<component>".
+        """
+
+        name = f"peri_{component}"
+        roi = self._add_stage(
+            graph, f"{name}_roi", self._periosteal_roi, [f"{name}_s1"]
+        )
+        img = self._add_stage(graph, f"{name}_img", self._crop, ["img", roi])
+        s1 = self._add_stage(
+            graph, f"{name}_s1_crop", self._crop, [f"{name}_s1", roi], binary=True
+        )
+        s2 = self._add_stage(
+            graph, f"{name}_s2", self._periosteal_step2, [img, s1, roi], binary=True
+        )
+        s3 = self._add_stage(
+            graph, f"{name}_s3", self._periosteal_step3, [img, s2, roi], binary=True
+        )
+        s4 = self._add_stage(
+            graph, f"{name}_s4", self._periosteal_step4, [s1, s2, s3], binary=True
+        )
+
+        return self._add_stage(graph, name, self._paste, [s4, roi, "img"], binary=True)
+
+    def _periosteal_step1(self, img_conn, component):
+        """
+        Step 1 of the periosteal mask: a rough mask of one bone, from the
+        labels of `_label_bones`.
+
+        Parameters
+        ----------
+        img_conn : sitk.Image
+            The labels of the bones from `_label_bones`.
+
+        component : int
+            Which bone to contour, by size: 1 for the largest bone.
+
+        Returns
+        -------
+        sitk.Image
+            The rough binary mask of the bone.
+        """
+
+        # Mask out the largest bone only
+        img_segmented = self._select_label(img_conn, component)
+        # img_segmented = self._get_largest_connected_component(img_segmented)
+
+        # dilation
+        # !!!NOTE: I'm using a Euclidean metric for the structirng element,
+        # the IPL implementation uses the 3-4-5 chamfer metric. Feel free to
+        # swap out the code if you can figure out how to get the 3-4-5
+        # chamfer metric in SimpleITK
+
+        img_segmented = self._dilate(img_segmented, self.peri_s1_radius)
+
+        # invert the image to get the background
+        img_segmented = self._invert_binary_image(img_segmented)
+
+        # connected components on the background
+        img_segmented = self._get_largest_connected_component(img_segmented)
+
+        # invert back to foreground
+        img_segmented = self._invert_binary_image(img_segmented)
+
+        return img_segmented
+
+    def _periosteal_roi(self, img_segmented_s1):
+        """
+        The remaining steps of the periosteal mask only see the image inside
+        of the mask of step 1, so run them on its bounding box.
+
+        Parameters
+        ----------
+        img_segmented_s1 : sitk.Image
+            The mask of step 1.
+
+        Returns
+        -------
+        tuple
+            The region of interest, see `_get_roi`.
+        """
+
+        return self._get_roi(
+            img_segmented_s1,
+            self._roi_radius(
+                "peri_s2_radius",
+                "peri_s3_radius",
+                "peri_s4_open_radius",
+                "peri_s4_close_radius",
+            ),
+            [
+                (self.peri_s2_lower, self.peri_s2_upper),
+                (self.peri_s3_lower, self.peri_s3_upper),
+            ],
+        )
+
+    def _periosteal_step2(self, img, img_segmented_s1, roi):
+        """
+        Step 2 of the periosteal mask: a mask with a low threshold.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The gray-scale AIM, cropped to `roi`.
+
+        img_segmented_s1 : sitk.Image
+            The mask of step 1, cropped to `roi`.
+
+        roi : tuple
+            The region of interest of `_periosteal_roi`.
+
+        Returns
+        -------
+        sitk.Image
+            The binary mask of step 2.
+        """
+
+        # mask the original image using the segmentation of step 1
+        img_masked = sitk.Mask(img, img_segmented_s1)
+
+        # threshold using low threshold
+        img_segmented = self._gaussian_and_threshold(
+            img_masked,
+            self.peri_s2_sigma,
+            self.peri_s2_support,
+            self.peri_s2_lower,
+            self.peri_s2_upper,
+        )
+
+        # keep only largest component
+        img_segmented = self._get_largest_connected_component(img_segmented)
+
+        # dilate/conn comp/erode to close holes in cortex
+        img_segmented = self._close_with_connected_components(
+            img_segmented, self.peri_s2_radius, roi
+        )
+
+        return img_segmented
+
+    def _periosteal_step3(self, img, img_segmented_s2, roi):
+        """
+        Step 3 of the periosteal mask: another mask with a slightly higher
+        threshold.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The gray-scale AIM, cropped to `roi`.
+
+        img_segmented_s2 : sitk.Image
+            The mask of step 2.
+
+        roi : tuple
+            The region of interest of `_periosteal_roi`.
+
+        Returns
+        -------
+        sitk.Image
+            The binary mask of step 3.
+        """
+
+        # now mask the image using the segmentation of step 2
+        img_masked = sitk.Mask(img, img_segmented_s2)
+
+        # gaussian blur and segment with higher threshold
+        img_segmented = self._gaussian_and_threshold(
+            img_masked,
+            self.peri_s3_sigma,
+            self.peri_s3_support,
+            self.peri_s3_lower,
+            self.peri_s3_upper,
+        )
+
+        # dilate/conn comp/erode to close holes in cortex
+        img_segmented = self._close_with_connected_components(
+            img_segmented, self.peri_s3_radius, roi
+        )
+
+        return img_segmented
+
+    def _periosteal_step4(self, img_segmented_s1, img_segmented_s2, img_segmented_s3):
+        """
+        Step 4 of the periosteal mask: the final segmentation from the masks
+        of steps 2 and 3.
+
+        Parameters
+        ----------
+        img_segmented_s1 : sitk.Image
+            The mask of step 1, cropped to the region of interest.
+
+        img_segmented_s2 : sitk.Image
+            The mask of step 2.
+
+        img_segmented_s3 : sitk.Image
+            The mask of step 3.
+
+        Returns
+        -------
+        sitk.Image
+            The periosteal mask, cropped to the region of interest.
+        """
+
+        # find where the two masks are different, the masks being in_value or
+        # out_value
+        img_segmented_diff = sitk.Xor(img_segmented_s2, img_segmented_s3)
+
+        # do an opening on the diff
+        img_segmented_diff_open = self._opening(
+            img_segmented_diff, self.peri_s4_open_radius
+        )
+
+        # combine this with the segmentation from step 3
+        peri_mask = sitk.Or(img_segmented_s3, img_segmented_diff_open)
+
+        # perform a smoothening close
+        # !!NOTE: This operation is in the original script but it seems to do
+        # more harm than good on the knee scans: the bone surface is not convex
+        # so ending with a high-radius close smooths the mask over concave
+        # surface features. Qualitatively, it seems to me like a candidate for
+        # improving the algorithm would be to replace this with an opening
+        peri_mask = self._closing(peri_mask, self.peri_s4_close_radius)
+
+        # mask the final peri mask using the first rough mask we created in
+        # step 1
+        peri_mask = sitk.Mask(peri_mask, img_segmented_s1)
+
+        return peri_mask
+
+    def get_endosteal_mask(self, img, peri):
+        """
+        Compute the endosteal mask from the image and periosteal mask.
 
         Parameters
         ----------
@@ -622,6 +1770,129 @@ class AutocontourKnee:
             A binary image that is the endosteal mask.
         """
 
+        graph = StageGraph(self.profiler)
+        endo = self._add_endosteal_stages(graph, 1)
+
+        return graph.run({"img": img, "peri_1": peri}, [endo])[0]
+
+    def _add_endosteal_stages(self, graph, component):
+        """
+        Add the stages of the endosteal mask of a bone to a stage graph. The
+        stages read the gray-scale image "img" and the periosteal mask
+        "peri_<component>".
+
+        Parameters
+        ----------
+        graph : StageGraph
+            The graph to add the stages to.
+
+        component : int
+            The bone, as in `_add_periosteal_stages`.
+
+        Returns
+        -------
+        str
+            The name of the endosteal mask, "endo_<component>".
+        """
+
+        name = f"endo_{component}"
+
+        # all steps only see the image inside of the periosteal mask, so run
+        # them on its bounding box
+        roi = self._add_stage(
+            graph, f"{name}_roi", self._endosteal_roi, [f"peri_{component}"]
+        )
+        img = self._add_stage(graph, f"{name}_img", self._crop, ["img", roi])
+        peri = self._add_stage(
+            graph, f"{name}_peri", self._crop, [f"peri_{component}", roi], binary=True
+        )
+
+        # erode the peri mask to get the minimum cortical thickness
+        peri_eroded = self._add_stage(
+            graph,
+            f"{name}_peri_eroded",
+            self._erode,
+            [peri],
+            binary=True,
+            radius=self.endo_min_cort_th,
+        )
+        cort = self._add_stage(
+            graph,
+            f"{name}_cort",
+            self._endosteal_cortex,
+            [img, peri, peri_eroded, roi],
+            binary=True,
+        )
+        trab = self._add_stage(
+            graph, f"{name}_trab", self._endosteal_trabecular, [peri, cort], binary=True
+        )
+        trab = self._add_stage(
+            graph, f"{name}_trab_corners", self._endosteal_corners, [trab], binary=True
+        )
+        cort = self._add_stage(
+            graph,
+            f"{name}_cort_final",
+            self._endosteal_cortex_from_trabecular,
+            [peri, peri_eroded, trab],
+            binary=True,
+        )
+
+        return self._add_stage(
+            graph, name, self._paste, [cort, roi, "img"], binary=True
+        )
+
+    def _endosteal_roi(self, peri):
+        """
+        All steps of the endosteal mask only see the image inside of the
+        periosteal mask, so run them on its bounding box.
+
+        Parameters
+        ----------
+        peri : sitk.Image
+            The periosteal mask.
+
+        Returns
+        -------
+        tuple
+            The region of interest, see `_get_roi`.
+        """
+
+        return self._get_roi(
+            peri,
+            self._roi_radius(
+                "endo_min_cort_th",
+                "endo_open_radius",
+                "endo_open_close_radius",
+                "endo_corner_open_radius",
+                "endo_close_radius",
+            ),
+            [(self.endo_lower, self.endo_upper)],
+        )
+
+    def _endosteal_cortex(self, img, peri, peri_eroded, roi):
+        """
+        A first cortical mask of the endosteal mask.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The gray-scale AIM, cropped to `roi`.
+
+        peri : sitk.Image
+            The periosteal mask, cropped to `roi`.
+
+        peri_eroded : sitk.Image
+            The periosteal mask eroded by the minimum cortical thickness.
+
+        roi : tuple
+            The region of interest of `_endosteal_roi`.
+
+        Returns
+        -------
+        sitk.Image
+            The binary cortical mask.
+        """
+
         # first, mask the image with the periosteal mask
         img_masked = sitk.Mask(img, peri)
 
@@ -634,18 +1905,9 @@ class AutocontourKnee:
             self.endo_upper,
         )
 
-        # erode the peri mask to get the minimum cortical thickness
-        peri_eroded = sitk.BinaryErode(
-            peri,
-            [self.endo_min_cort_th] * 3,
-            sitk.sitkBall,
-            self.out_value,
-            self.in_value,
-        )
-
         # get an endosteal mask first guess by subtracting the cortical mask
         # from the periosteal mask
-        endo = self.in_value * sitk.And(peri, sitk.Not(cort))
+        endo = self._and_not(peri, cort)
 
         # now mask the endo mask using the eroded peri mask
         endo = sitk.Mask(endo, peri_eroded)
@@ -654,14 +1916,35 @@ class AutocontourKnee:
         cort = self._invert_binary_image(endo)
 
         # get rid of disconnected background inside of bone
-        cort = self._get_largest_connected_component(cort)
+        cort = self._get_largest_connected_component(cort, roi)
 
         # mask out the regions outside of periosteal contour to keep
         # only the cortical bone region
         cort = sitk.Mask(cort, peri)
 
+        return cort
+
+    def _endosteal_trabecular(self, peri, cort):
+        """
+        The trabecular region of the endosteal mask, cleaned up with openings
+        and closings.
+
+        Parameters
+        ----------
+        peri : sitk.Image
+            The periosteal mask, cropped to the region of interest.
+
+        cort : sitk.Image
+            The cortical mask of `_endosteal_cortex`.
+
+        Returns
+        -------
+        sitk.Image
+            The binary trabecular mask.
+        """
+
         # get the trab region as the whole bone less the cortex
-        trab = self.in_value * sitk.And(peri, sitk.Not(cort))
+        trab = self._and_not(peri, cort)
 
         # keep only the largest connected region of trab
         trab = self._get_largest_connected_component(trab)
@@ -670,41 +1953,39 @@ class AutocontourKnee:
         # get rid of Tb speckles not connected to trab region
         trab = self._open_with_connected_components(trab, self.endo_open_radius)
 
-        trab = sitk.BinaryMorphologicalClosing(
-            trab, [self.endo_open_close_radius] * 3, sitk.sitkBall, self.in_value
-        )
+        trab = self._closing(trab, self.endo_open_close_radius)
 
         trab = sitk.Mask(trab, peri)
 
-        trab_open = sitk.BinaryMorphologicalOpening(
-            trab,
-            [self.endo_open_close_radius] * 3,
-            sitk.sitkBall,
-            self.out_value,
-            self.in_value,
-        )
+        return trab
+
+    def _endosteal_corners(self, trab):
+        """
+        Add the large corners that the opening of the trabecular mask removes
+        back to it.
+
+        Parameters
+        ----------
+        trab : sitk.Image
+            The trabecular mask of `_endosteal_trabecular`.
+
+        Returns
+        -------
+        sitk.Image
+            The binary trabecular mask with its corners.
+        """
+
+        trab_open = self._opening(trab, self.endo_open_close_radius)
 
         # find where the inverse of trab and trab_open are not the same and call
         # it the corner mask
-        corners = self.in_value * sitk.And(trab, sitk.Not(trab_open))
-
-        corners = sitk.BinaryErode(
-            corners,
-            [self.endo_corner_open_radius] * 3,
-            sitk.sitkBall,
-            self.out_value,
-            self.in_value,
-        )
+        corners = self._and_not(trab, trab_open)
+
+        corners = self._erode(corners, self.endo_corner_open_radius)
 
         corners = self._extract_large_regions(corners, self.endo_min_number)
 
-        corners = sitk.BinaryDilate(
-            corners,
-            [self.endo_corner_open_radius] * 3,
-            sitk.sitkBall,
-            self.out_value,
-            self.in_value,
-        )
+        corners = self._dilate(corners, self.endo_corner_open_radius)
 
         corners = self._extract_large_regions(corners, self.endo_min_number)
 
@@ -715,43 +1996,253 @@ class AutocontourKnee:
         trab = sitk.Or(trab, trab_open)
         trab = sitk.Or(trab, corners)
 
-        trab = sitk.BinaryMorphologicalClosing(
-            trab, [self.endo_close_radius] * 3, sitk.sitkBall, self.in_value
-        )
+        return trab
+
+    def _endosteal_cortex_from_trabecular(self, peri, peri_eroded, trab):
+        """
+        The final cortical mask of the endosteal mask: the periosteal mask
+        less the closed trabecular mask.
+
+        Parameters
+        ----------
+        peri : sitk.Image
+            The periosteal mask, cropped to the region of interest.
+
+        peri_eroded : sitk.Image
+            The periosteal mask eroded by the minimum cortical thickness.
+
+        trab : sitk.Image
+            The trabecular mask of `_endosteal_corners`.
+
+        Returns
+        -------
+        sitk.Image
+            The endosteal mask, cropped to the region of interest.
+        """
+
+        trab = self._closing(trab, self.endo_close_radius)
 
         # mask the trab mask with the eroded peri mask to ensure a minimum
         # cortical thickness
         trab = sitk.Mask(trab, peri_eroded)
 
         # In the IPL script there is a slicewise component labelling filter
-        # step here but you can't do that efficiently in SITK, and also it
-        # doesnt really make sense to me to do that on a knee anyways
+        # step here. It doesnt really make sense to me to do that on a knee,
+        # so it is optional
+        if self.endo_slice_cl:
+            trab = self._slice_connected_components(trab, self.endo_slice_cl_min_size)
 
-        cort = self.in_value * sitk.And(peri, sitk.Not(trab))
+        cort = self._and_not(peri, trab)
 
         ##### NOTE: NOT FINISHED
         # left off at line 338 of IPLV6_AUTOK_ENDO_KNEE.COM
 
         return cort
 
-    def get_masks(self, img):
+    def get_masks(self, img, components=(1, 2), return_report=False):
         """
-        Combined method to compute both the periosteal and endosteal masks.
+        Compute the periosteal and endosteal masks of several bones in one
+        stage graph: step 1 of the periosteal masks of all bones, then the
+        rest of the periosteal masks and the endosteal masks bone by bone.
+        Every intermediate image is released as soon as the last stage that
+        uses it has run, so the peak memory is lower than that of calling
+        `get_periosteal_masks` and `get_endosteal_mask`. The masks are the
+        same.
 
         Parameters
         ----------
         img : sitk.Image
             The gray-scale AIM. Currently this is written for images in HU,
             if you want to input a density image then you'll need to modify
-            the lower and upper thresholds to be in the correct units.
+            the lower and upper thresholds to be in the correct units. Can
+            also be the path of an image file, see `slab_size`.
+
+        components : list
+            Which bones to contour, by size: 1 for the largest bone, 2 for the
+            second largest, and so on. Default is (1, 2).
+
+        return_report : bool
+            Set this to True to also return a report of the run: a dict with
+            the largest resident set size of the process during the run,
+            "peak_rss" in bytes (Linux only, None elsewhere), and the
+            "stages", see `StageGraph.report`.
+
+        Returns
+        -------
+        list
+            One (sitk.Image, sitk.Image) tuple per bone, in the order of
+            `components`: the periosteal mask and the endosteal mask. If
+            `return_report` is True, also the report.
+        """
+
+        graph = StageGraph(self.profiler)
+        names = self._add_mask_stages(graph, components)
+        masks = graph.run({"img": img}, names, record_memory=return_report)
+        masks = list(zip(masks[::2], masks[1::2]))
+
+        if return_report:
+            return masks, {"peak_rss": graph.peak_rss(), "stages": graph.report}
+        return masks
+
+    def _add_mask_stages(self, graph, components):
+        """
+        Add the stages of the periosteal and endosteal masks of several bones
+        to a stage graph: step 1 of the periosteal masks of all bones, then
+        the rest of the periosteal masks and the endosteal masks bone by bone.
+        The stages read the gray-scale image "img".
+
+        Parameters
+        ----------
+        graph : StageGraph
+            The graph to add the stages to.
+
+        components : list
+            Which bones to contour, by size: 1 for the largest bone.
+
+        Returns
+        -------
+        list
+            The names of the periosteal and the endosteal mask of every bone,
+            in the order of `components`.
+        """
+
+        self._add_stage(graph, "labels", self._label_bones, ["img"])
+        for component in components:
+            self._add_periosteal_step1_stage(graph, component)
+
+        # the periosteal mask of a bone is only needed until its endosteal
+        # mask is done, so contour the bones one after the other
+        names = []
+        for component in components:
+            names.append(self._add_periosteal_stages(graph, component))
+            names.append(self._add_endosteal_stages(graph, component))
+
+        return names
+
+    def sweep(self, img, grid, components=(1, 2), cache=None):
+        """
+        Compute the periosteal and endosteal masks for every combination of
+        values in a grid of parameters. The output of every stage is memoized
+        by its inputs and the parameters it reads (see `STEP_PARAMETERS`), so
+        only the stages that read a parameter that changed, and the stages
+        after them, run again. E.g. sweeping `endo_close_radius` reuses the
+        periosteal masks, and also all steps of the endosteal masks but the
+        last one when their region of interest does not change with it.
+
+        The combinations run in the order of `itertools.product`, the first
+        parameter of the grid changing the slowest. With a cache limited to a
+        number of bytes, list the parameters of the earliest steps first, so
+        that the outputs shared by the most combinations stay cached.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The gray-scale AIM, see `get_periosteal_mask`.
+
+        grid : dict or str
+            The values to try, as a list by parameter name. The other
+            parameters are those of this object. Or a YAML file with such a
+            mapping, in which a single value is the same as a list of one.
+
+        components : list
+            Which bones to contour, by size: 1 for the largest bone, 2 for the
+            second largest, and so on. Default is (1, 2).
+
+        cache : StageCache
+            The memoized stage outputs, which can be shared between sweeps of
+            the same image. If None, a cache without a size limit is used,
+            which holds every intermediate image of the sweep.
+
+        Returns
+        -------
+        list
+            One (AutocontourKnee, list) tuple per combination: an object with
+            the parameters of the combination, which can be saved with
+            `save_parameters_to_yaml`, and its masks as returned by
+            `get_masks`.
+        """
+
+        if isinstance(grid, str):
+            with open(grid) as f:
+                grid = yaml.safe_load(f) or {}
+        grid = {
+            name: values if isinstance(values, (list, tuple)) else [values]
+            for name, values in grid.items()
+        }
+        cache = StageCache() if cache is None else cache
+
+        # pad the regions of interest for the largest radii of the grid, of
+        # which `_roi_radius` reads the largest values of the numeric
+        # parameters
+        sweep_radii = tuple(
+            (name, max(values))
+            for name, values in sorted(grid.items())
+            if all(isinstance(value, (int, float)) for value in values)
+        )
+
+        # hash the image only once
+        keys = {"img": value_key(img)}
+
+        results = []
+        for values in itertools.product(*grid.values()):
+            auto_contour = copy.copy(self)
+            auto_contour.set_parameters(**dict(zip(grid, values)))
+            auto_contour._sweep_radii = sweep_radii
+
+            graph = StageGraph(auto_contour.profiler)
+            names = auto_contour._add_mask_stages(graph, components)
+            masks = graph.run({"img": img}, names, cache=cache, keys=keys)
+            results.append((auto_contour, list(zip(masks[::2], masks[1::2]))))
+
+        return results
+
+    def evaluate_pyramid(self, img, components=(1, 2)):
+        """
+        Compare the masks of the pyramid mode with the masks computed at full
+        resolution, with the same parameters otherwise.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The gray-scale AIM, see `get_periosteal_mask`.
+
+        components : list
+            The labels of the bones to contour, see `get_periosteal_masks`.
 
         Returns
         -------
-        (sitk.Image, sitk.Image)
-            Tuple of two binary images. The first image is the periosteal mask
-            and the second image is the endosteal mask.
+        dict
+            For each bone, the "periosteal" and "endosteal" mask comparisons
+            with the Dice coefficient ("dice"), Jaccard index ("jaccard"), the
+            mean and Hausdorff symmetric surface distance ("mean_distance" and
+            "hausdorff", in the units of the image spacing), and the number of
+            voxels that differ ("different_voxels"). The key "time" holds the
+            run time in seconds of the "pyramid" and "full" resolution masks.
         """
-        pass
+
+        full_resolution = copy.copy(self)
+        full_resolution.pyramid_factor = 1
+
+        masks, times = {}, {}
+        for name, autocontour in [("pyramid", self), ("full", full_resolution)]:
+            start = time.perf_counter()
+            peris = autocontour.get_periosteal_masks(img, components, n_threads=1)
+            endos = [autocontour.get_endosteal_mask(img, peri) for peri in peris]
+            times[name] = time.perf_counter() - start
+            masks[name] = list(zip(peris, endos))
+
+        report = {"time": times}
+        for component, pyramid_masks, full_masks in zip(
+            components, masks["pyramid"], masks["full"]
+        ):
+            report[component] = {
+                mask_name: compare_masks(seg, ref, img.GetSpacing())
+                for mask_name, seg, ref in zip(
+                    ["periosteal", "endosteal"], pyramid_masks, full_masks
+                )
+            }
+
+        return report
 
     def __str__(self):
         return f"Autocontour object (--str to be implemented--)."
@@ -761,12 +2252,28 @@ class AutocontourKnee:
 
     def save_parameters_to_yaml(self, fn):
         """
-        To be implemented
+        Save the parameters of the contouring to a YAML file.
+
+        Parameters
+        ----------
+        fn : str
+            The path of the file.
         """
-        pass
+
+        with open(fn, "w") as f:
+            yaml.safe_dump(self.get_parameters(), f, sort_keys=False)
 
     def load_parameters_from_yaml(self, fn):
         """
-        To be implemented
+        Load parameters of the contouring from a YAML file written by
+        `save_parameters_to_yaml`. Parameters missing from the file keep their
+        current value.
+
+        Parameters
+        ----------
+        fn : str
+            The path of the file.
         """
-        pass
+
+        with open(fn) as f:
+            self.set_parameters(**(yaml.safe_load(f) or {}))
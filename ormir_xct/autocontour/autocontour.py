@@ -7,15 +7,20 @@ from ormir_xct.util.scanco_rescale import convert_hu_to_bmd
 
 
 def autocontour(
-    img, mu_water=0.2409, rescale_slope=1603.51904, rescale_intercept=-391.209015
+    img,
+    mu_water=0.2409,
+    rescale_slope=1603.51904,
+    rescale_intercept=-391.209015,
+    auto_contour=None,
 ):
     # Mu_Water, Rescale_Slope, and Rescale_Intercept are hard coded
     # To-Do: get directly from the image, if possible, or from the user
     img = convert_hu_to_bmd(img, mu_water, rescale_slope, rescale_intercept)
 
-    auto_contour = AutocontourKnee()
-    prx_mask = auto_contour.get_periosteal_mask(img, 1)
-    dst_mask = auto_contour.get_periosteal_mask(img, 2)
+    # an AutocontourKnee with other parameters can be passed in
+    if auto_contour is None:
+        auto_contour = AutocontourKnee()
+    prx_mask, dst_mask = auto_contour.get_periosteal_masks(img, [1, 2])
 
     # Create a mask for the entire joint
     mask = prx_mask + dst_mask
@@ -23,6 +28,58 @@ def autocontour(
     return dst_mask, prx_mask, mask
 
 
+def image_basename(image_path):
+    """
+    The file name of an image without its extension, also for compound
+    extensions such as .nii.gz.
+
+    Parameters
+    ----------
+    image_path : string
+        The image (path + filename).
+
+    Returns
+    -------
+    string
+        The file name without the extension.
+    """
+
+    basename = os.path.basename(image_path)
+    if basename.lower().endswith(".gz"):
+        basename = basename[: -len(".gz")]
+    return os.path.splitext(basename)[0]
+
+
+def output_paths(image_path, output_dir=None):
+    """
+    The paths of the masks written for an image: the image name with the
+    suffixes _PRX_MASK, _DST_MASK and _MASK, as NIfTI files.
+
+    Parameters
+    ----------
+    image_path : string
+        The image (path + filename).
+
+    output_dir : string
+        The directory of the masks. Default is the directory of the image.
+
+    Returns
+    -------
+    dict
+        The paths of the "prx_mask", "dst_mask" and "mask".
+    """
+
+    if output_dir is None:
+        output_dir = os.path.dirname(image_path)
+    basename = image_basename(image_path)
+
+    return {
+        "prx_mask": os.path.join(output_dir, basename + "_PRX_MASK.nii"),
+        "dst_mask": os.path.join(output_dir, basename + "_DST_MASK.nii"),
+        "mask": os.path.join(output_dir, basename + "_MASK.nii"),
+    }
+
+
 def main():
     # Parse input arguments
     parser = argparse.ArgumentParser()
@@ -55,13 +112,11 @@ def main():
     rescale_slope = args.rescale_slope
     rescale_intercept = args.rescale_intercept
 
-    # Create a new folder to hold the output images
-    image_dir = os.path.dirname(image_path)
-    basename = os.path.splitext(os.path.basename(image_path))[0]
-
-    prx_mask_path = os.path.join(image_dir, basename + "_PRX_MASK.nii")
-    dst_mask_path = os.path.join(image_dir, basename + "_DST_MASK.nii")
-    mask_path = os.path.join(image_dir, basename + "_MASK.nii")
+    # The output images are written next to the input image
+    paths = output_paths(image_path)
+    prx_mask_path = paths["prx_mask"]
+    dst_mask_path = paths["dst_mask"]
+    mask_path = paths["mask"]
 
     # Read in images as floats to increase precision
     image = sitk.ReadImage(image_path, sitk.sitkFloat32)
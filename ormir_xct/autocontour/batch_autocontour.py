@@ -0,0 +1,487 @@
+"""
+batch_autocontour.py
+
+Description: Contours many knee scans with `autocontour` in a pool of worker
+             processes, so that Python, SimpleITK and the contouring are
+             loaded once per worker instead of once per scan. The scans are
+             the images in a directory or the rows of a manifest CSV file.
+             Scans whose _PRX_MASK and _DST_MASK images are newer than the
+             scan are skipped, so an interrupted batch can be resumed. Every
+             scan gets a log file, a scan that fails does not stop the batch,
+             and a summary table of the run time and the mask volumes of
+             every scan is written as CSV.
+
+Usage:
+  python -m ormir_xct.autocontour.batch_autocontour scans/ --workers 4
+  python -m ormir_xct.autocontour.batch_autocontour manifest.csv --threads 2
+"""
+
+import os
+import csv
+import sys
+import time
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import SimpleITK as sitk
+
+from ormir_xct.autocontour.autocontour import (
+    autocontour,
+    image_basename,
+    output_paths,
+)
+from ormir_xct.autocontour.AutocontourKnee import AutocontourKnee
+
+# the images of a directory that are contoured, by extension
+IMAGE_EXTENSIONS = (".nii", ".nii.gz", ".mha", ".mhd", ".nrrd")
+
+# the images written by the contouring, which are not scans
+MASK_SUFFIXES = ("_PRX_MASK", "_DST_MASK", "_MASK")
+
+# the calibration of the conversion from HU to BMD, see `autocontour`
+CALIBRATION = {
+    "mu_water": 0.2409,
+    "rescale_slope": 1603.51904,
+    "rescale_intercept": -391.209015,
+}
+
+SUMMARY_COLUMNS = [
+    "image_path",
+    "status",
+    "seconds",
+    "prx_voxels",
+    "dst_voxels",
+    "prx_volume",
+    "dst_volume",
+    "error",
+    "log_path",
+]
+
+# the contouring runs threads of its own, and forking a process with running
+# threads can deadlock the child, so the workers are started from scratch
+MP_CONTEXT = multiprocessing.get_context("spawn")
+
+
+def find_scans(path, **calibration):
+    """
+    The scans to contour: the images in a directory, or the rows of a
+    manifest CSV file.
+
+    Parameters
+    ----------
+    path : string
+        A directory, whose images with one of `IMAGE_EXTENSIONS` that are
+        not masks are the scans, or a CSV file with an "image_path" column.
+        Relative image paths are relative to the CSV file. The columns
+        "mu_water", "rescale_slope" and "rescale_intercept" give the
+        calibration of a scan where they are not empty.
+
+    **calibration
+        The calibration of the scans without one in the manifest, see
+        `CALIBRATION` for the names and the default values.
+
+    Returns
+    -------
+    list
+        One dict per scan with its "image_path" and calibration, sorted by
+        path for a directory and in the order of the rows for a manifest.
+    """
+
+    calibration = {**CALIBRATION, **calibration}
+
+    if os.path.isdir(path):
+        scans = []
+        for filename in sorted(os.listdir(path)):
+            if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            if image_basename(filename).endswith(MASK_SUFFIXES):
+                continue
+            scans.append({"image_path": os.path.join(path, filename), **calibration})
+        return scans
+
+    scans = []
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        if "image_path" not in (reader.fieldnames or []):
+            raise ValueError(f"the manifest {path} has no image_path column")
+        for row in reader:
+            scan = {
+                "image_path": os.path.join(
+                    os.path.dirname(os.path.abspath(path)), row["image_path"]
+                )
+            }
+            for name, default in calibration.items():
+                value = (row.get(name) or "").strip()
+                scan[name] = float(value) if value else default
+            scans.append(scan)
+    return scans
+
+
+def log_path(image_path, output_dir=None):
+    """
+    The path of the log file of a scan, next to its masks: the image name with
+    the suffix _AUTOCONTOUR.log.
+    """
+    if output_dir is None:
+        output_dir = os.path.dirname(image_path)
+    return os.path.join(output_dir, image_basename(image_path) + "_AUTOCONTOUR.log")
+
+
+def is_up_to_date(image_path, output_dir=None):
+    """
+    Whether the _PRX_MASK and _DST_MASK images of a scan exist and are newer
+    than the scan.
+    """
+    paths = output_paths(image_path, output_dir)
+    try:
+        modified = os.path.getmtime(image_path)
+        return all(
+            os.path.getmtime(paths[name]) > modified
+            for name in ["prx_mask", "dst_mask"]
+        )
+    except OSError:
+        return False
+
+
+def _write_image(image, fn):
+    """
+    Write an image to a temporary file of the worker process in the same
+    directory and move it into place, so that a worker killed while writing
+    does not leave a truncated image under the final name. The temporary name
+    keeps the mask suffix, so a leftover temporary file is not taken for a
+    scan.
+    """
+    directory, basename = os.path.split(fn)
+    temporary = os.path.join(directory, f".{os.getpid()}_{basename}")
+    try:
+        sitk.WriteImage(image, temporary)
+        os.replace(temporary, fn)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def contour_scan(scan, output_dir=None, parameters=None):
+    """
+    Contour one scan and write its masks and log file. Errors are caught and
+    reported in the returned row, so that the batch goes on.
+
+    Parameters
+    ----------
+    scan : dict
+        The "image_path" of the scan and its calibration, see `find_scans`.
+
+    output_dir : string
+        The directory of the masks. Default is the directory of the scan.
+
+    parameters : string
+        A YAML file of AutocontourKnee parameters, see
+        `AutocontourKnee.load_parameters_from_yaml`. Default is None, which
+        uses the default parameters.
+
+    Returns
+    -------
+    dict
+        The row of the scan in the summary, see `SUMMARY_COLUMNS`. The status
+        is "done" or "failed", the volumes are in the units of the image
+        spacing.
+    """
+
+    image_path = scan["image_path"]
+    row = {name: "" for name in SUMMARY_COLUMNS}
+    row.update(
+        image_path=image_path,
+        status="failed",
+        log_path=log_path(image_path, output_dir),
+    )
+    log = [f"image: {image_path}", f"started: {time.ctime()}"]
+
+    start = time.perf_counter()
+    try:
+        calibration = {name: scan[name] for name in CALIBRATION}
+        log.append(f"calibration: {calibration}")
+        auto_contour = AutocontourKnee()
+        if parameters:
+            auto_contour.load_parameters_from_yaml(parameters)
+            log.append(f"parameters: {parameters}")
+
+        image = sitk.ReadImage(image_path, sitk.sitkFloat32)
+        log.append(f"size: {image.GetSize()}, spacing: {image.GetSpacing()}")
+
+        dst_mask, prx_mask, mask = autocontour(
+            image, auto_contour=auto_contour, **calibration
+        )
+
+        # the masks are written atomically, and the _DST_MASK last, so that
+        # `is_up_to_date` only holds once every mask is complete
+        paths = output_paths(image_path, output_dir)
+        _write_image(mask, paths["mask"])
+        _write_image(prx_mask, paths["prx_mask"])
+        _write_image(dst_mask, paths["dst_mask"])
+
+        voxel_volume = float(np.prod(image.GetSpacing()))
+        for name, bone_mask in [("prx", prx_mask), ("dst", dst_mask)]:
+            voxels = int(np.count_nonzero(sitk.GetArrayViewFromImage(bone_mask)))
+            row[f"{name}_voxels"] = voxels
+            row[f"{name}_volume"] = voxels * voxel_volume
+            log.append(f"{name} mask: {voxels} voxels, {paths[f'{name}_mask']}")
+        row["status"] = "done"
+    except Exception as error:
+        row["error"] = f"{type(error).__name__}: {error}"
+        log.append(traceback.format_exc().rstrip())
+
+    row["seconds"] = round(time.perf_counter() - start, 3)
+    log.append(f"status: {row['status']}, {row['seconds']} s")
+    try:
+        with open(row["log_path"], "w") as f:
+            f.write("\n".join(log) + "\n")
+    except OSError:
+        row["log_path"] = ""
+
+    return row
+
+
+def _initialize_worker(sitk_threads):
+    """
+    Set the number of threads of the SimpleITK filters of a worker process.
+    """
+    if sitk_threads:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(sitk_threads)
+
+
+def _contour_in_new_process(scan, output_dir, parameters, sitk_threads):
+    """
+    Contour one scan in a process of its own, to find out whether it is the
+    scan that crashed a worker process.
+    """
+    try:
+        with ProcessPoolExecutor(
+            1,
+            mp_context=MP_CONTEXT,
+            initializer=_initialize_worker,
+            initargs=(sitk_threads,),
+        ) as pool:
+            return pool.submit(contour_scan, scan, output_dir, parameters).result()
+    except BrokenProcessPool:
+        row = {name: "" for name in SUMMARY_COLUMNS}
+        row.update(
+            image_path=scan["image_path"],
+            status="failed",
+            error="the worker process died",
+            log_path="",
+        )
+        return row
+
+
+def write_summary(rows, fn):
+    """
+    Write the summary rows of `batch_autocontour` to a CSV file.
+
+    Parameters
+    ----------
+    rows : list
+        The rows, see `SUMMARY_COLUMNS`.
+
+    fn : string
+        The path of the CSV file.
+    """
+    with open(fn, "w", newline="") as f:
+        writer = csv.DictWriter(f, SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def batch_autocontour(
+    scans,
+    output_dir=None,
+    n_workers=1,
+    sitk_threads=None,
+    parameters=None,
+    force=False,
+    summary_path=None,
+    verbose=True,
+):
+    """
+    Contour a batch of scans in a pool of worker processes.
+
+    Parameters
+    ----------
+    scans : list
+        The scans, see `find_scans`.
+
+    output_dir : string
+        The directory of the masks and logs. Default is the directory of each
+        scan.
+
+    n_workers : int
+        The number of worker processes. Default is 1.
+
+    sitk_threads : int
+        The number of threads of the SimpleITK filters in each worker. Set
+        this to about the number of cores over `n_workers`. Default is None,
+        which keeps the SimpleITK default of all cores.
+
+    parameters : string
+        A YAML file of AutocontourKnee parameters. Default is None.
+
+    force : bool
+        Set this to True to contour the scans whose masks are up to date too.
+        Default is False.
+
+    summary_path : string
+        If given, write the summary to this CSV file, see `write_summary`.
+
+    verbose : bool
+        Set this to False to not print a line per scan. Default is True.
+
+    Returns
+    -------
+    list
+        The summary: one row per scan, in the order of `scans`, see
+        `SUMMARY_COLUMNS`. The status of a row is "done", "skipped" or
+        "failed".
+    """
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    rows = [None] * len(scans)
+    todo = []
+    for index, scan in enumerate(scans):
+        if not force and is_up_to_date(scan["image_path"], output_dir):
+            rows[index] = {name: "" for name in SUMMARY_COLUMNS}
+            rows[index].update(image_path=scan["image_path"], status="skipped")
+        else:
+            todo.append(index)
+
+    def report(index):
+        if verbose:
+            row = rows[index]
+            done = sum(row is not None for row in rows)
+            print(
+                f"[{done}/{len(scans)}] {row['status']:<8}{row['seconds'] or '':>9}"
+                f"  {row['image_path']}"
+            )
+
+    for index in range(len(scans)):
+        if rows[index] is not None:
+            report(index)
+
+    crashed = []
+    if todo:
+        with ProcessPoolExecutor(
+            n_workers,
+            mp_context=MP_CONTEXT,
+            initializer=_initialize_worker,
+            initargs=(sitk_threads,),
+        ) as pool:
+            futures = {
+                pool.submit(contour_scan, scans[i], output_dir, parameters): i
+                for i in todo
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    rows[index] = future.result()
+                except BrokenProcessPool:
+                    # a worker died, which breaks the pool for all scans
+                    # that were not done yet
+                    crashed.append(index)
+                    continue
+                report(index)
+
+    # contour the scans of a broken pool one by one, so that only the scan
+    # that crashes fails
+    for index in sorted(crashed):
+        rows[index] = _contour_in_new_process(
+            scans[index], output_dir, parameters, sitk_threads
+        )
+        report(index)
+
+    if summary_path:
+        write_summary(rows, summary_path)
+
+    return rows
+
+
+def main():
+    # Parse input arguments
+    parser = argparse.ArgumentParser(
+        description="Contour the knee scans in a directory or manifest CSV file."
+    )
+    parser.add_argument(
+        "input", type=str, help="Directory of images, or CSV file with image_path"
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=None,
+        help="Directory of the masks (default = next to each image)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of worker processes"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Number of SimpleITK threads per worker (default = all cores)",
+    )
+    parser.add_argument(
+        "--parameters", type=str, default=None, help="YAML file of parameters"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Contour scans with up to date masks"
+    )
+    parser.add_argument(
+        "--summary",
+        type=str,
+        default=None,
+        help="Summary CSV file (default = autocontour_summary.csv in the output "
+        "directory or the input directory)",
+    )
+    for name, default in CALIBRATION.items():
+        parser.add_argument(
+            f"--{name}", type=float, default=default, help=f"(default = {default})"
+        )
+    args = parser.parse_args()
+
+    scans = find_scans(
+        args.input, **{name: getattr(args, name) for name in CALIBRATION}
+    )
+
+    summary_path = args.summary
+    if summary_path is None:
+        summary_dir = args.output_dir or (
+            args.input if os.path.isdir(args.input) else os.path.dirname(args.input)
+        )
+        summary_path = os.path.join(summary_dir, "autocontour_summary.csv")
+
+    rows = batch_autocontour(
+        scans,
+        output_dir=args.output_dir,
+        n_workers=args.workers,
+        sitk_threads=args.threads,
+        parameters=args.parameters,
+        force=args.force,
+        summary_path=summary_path,
+    )
+
+    counts = {
+        status: sum(row["status"] == status for row in rows)
+        for status in ["done", "skipped", "failed"]
+    }
+    print(
+        f"{counts['done']} done, {counts['skipped']} skipped, "
+        f"{counts['failed']} failed, summary: {summary_path}"
+    )
+    sys.exit(1 if counts["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
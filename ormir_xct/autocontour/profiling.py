@@ -0,0 +1,283 @@
+"""
+profiling.py
+
+Description: Per-stage profiling of AutocontourKnee. A `Profiler` records the
+             wall time, the number of voxels and the memory of the output of
+             every named stage, nested like the calls that run them, and
+             exports them as JSON or as a Chrome trace (chrome://tracing or
+             https://ui.perfetto.dev). Profiling is switched on with the
+             `profile` option of AutocontourKnee or the environment variable
+             ORMIR_XCT_PROFILE, and costs one attribute check per stage
+             otherwise.
+"""
+
+import os
+import json
+import time
+import functools
+import threading
+import SimpleITK as sitk
+
+from ormir_xct.autocontour.stage_graph import image_nbytes
+
+# set this environment variable to 1 to profile every AutocontourKnee
+PROFILE_ENVIRONMENT_VARIABLE = "ORMIR_XCT_PROFILE"
+
+
+def profile_from_environment():
+    """
+    Whether the environment variable ORMIR_XCT_PROFILE asks for profiling:
+    any value other than "", "0", "false" and "no".
+    """
+    value = os.environ.get(PROFILE_ENVIRONMENT_VARIABLE, "")
+    return value.strip().lower() not in ("", "0", "false", "no")
+
+
+def profiled(name):
+    """
+    Decorator for methods of objects with a `profiler` attribute, that
+    records every call as a stage of the profiler when it is not None.
+
+    Parameters
+    ----------
+    name : str or callable
+        The name of the stage, or a function of the arguments of the method
+        that returns it.
+
+    Returns
+    -------
+    function
+        The decorator.
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.profiler is None:
+                return method(self, *args, **kwargs)
+            stage_name = name(*args, **kwargs) if callable(name) else name
+            with self.profiler.stage(stage_name) as event:
+                output = method(self, *args, **kwargs)
+                event["output"] = output
+            return output
+
+        return wrapper
+
+    return decorator
+
+
+class Profiler:
+    """
+    Records the stages of a pipeline. Stages that run inside of another stage
+    of the same thread are its children, and are named by the path of names
+    from the outermost stage, e.g. "peri_1_s2/close_cc/dilate".
+
+    Attributes
+    ----------
+    events : list
+        One dict per stage that ran, in the order they finished: its "name"
+        (the path), its "start" in seconds since the profiler was created,
+        its wall time in "seconds", the "self_seconds" not spent in its
+        children, the "thread" it ran on (0 for the first thread seen), and
+        the number of "voxels" and "output_bytes" of its output if that is a
+        SimpleITK image (else None and 0).
+
+    Methods
+    -------
+    stage(name)
+
+    summary()
+
+    to_json()
+
+    to_chrome_trace()
+
+    save_json(fn)
+
+    save_chrome_trace(fn)
+
+    clear()
+    """
+
+    def __init__(self):
+        self.events = []
+        self._origin = time.perf_counter()
+        self._local = threading.local()
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def _thread(self):
+        with self._lock:
+            return self._threads.setdefault(threading.get_ident(), len(self._threads))
+
+    def stage(self, name):
+        """
+        A context manager that records the code it wraps as a stage. Store
+        the output of the stage in the "output" key of the dict it returns
+        to record its size.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+
+        Returns
+        -------
+        _Stage
+            The context manager.
+        """
+        return _Stage(self, name)
+
+    def summary(self):
+        """
+        The stages aggregated by name, from the most to the least self time.
+
+        Returns
+        -------
+        list
+            One dict per name with the "name", the number of "calls", the
+            total "seconds" and "self_seconds", and the largest "voxels" and
+            "output_bytes" of its calls.
+        """
+        stages = {}
+        for event in self.events:
+            stage = stages.setdefault(
+                event["name"],
+                {
+                    "name": event["name"],
+                    "calls": 0,
+                    "seconds": 0.0,
+                    "self_seconds": 0.0,
+                    "voxels": None,
+                    "output_bytes": 0,
+                },
+            )
+            stage["calls"] += 1
+            stage["seconds"] += event["seconds"]
+            stage["self_seconds"] += event["self_seconds"]
+            if event["voxels"] is not None:
+                stage["voxels"] = max(stage["voxels"] or 0, event["voxels"])
+            stage["output_bytes"] = max(stage["output_bytes"], event["output_bytes"])
+
+        return sorted(stages.values(), key=lambda s: s["self_seconds"], reverse=True)
+
+    def to_json(self):
+        """
+        The events and their summary as a JSON serializable dict.
+
+        Returns
+        -------
+        dict
+            The "events" and the "summary".
+        """
+        return {"events": list(self.events), "summary": self.summary()}
+
+    def to_chrome_trace(self):
+        """
+        The events in the Chrome trace event format, as complete events with
+        times in microseconds.
+
+        Returns
+        -------
+        dict
+            The trace, with its events in "traceEvents".
+        """
+        pid = os.getpid()
+        trace_events = [
+            {
+                "name": event["name"].rsplit("/", 1)[-1],
+                "cat": "autocontour",
+                "ph": "X",
+                "ts": event["start"] * 1e6,
+                "dur": event["seconds"] * 1e6,
+                "pid": pid,
+                "tid": event["thread"],
+                "args": {
+                    "stage": event["name"],
+                    "voxels": event["voxels"],
+                    "output_bytes": event["output_bytes"],
+                },
+            }
+            for event in self.events
+        ]
+        # parents before their children, so viewers nest them correctly
+        trace_events.sort(key=lambda e: (e["tid"], e["ts"], -e["dur"]))
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def save_json(self, fn):
+        """
+        Write `to_json` to a file.
+
+        Parameters
+        ----------
+        fn : str
+            The path of the file.
+        """
+        with open(fn, "w") as f:
+            json.dump(self.to_json(), f, indent=2)
+
+    def save_chrome_trace(self, fn):
+        """
+        Write `to_chrome_trace` to a file, which chrome://tracing and
+        https://ui.perfetto.dev can open.
+
+        Parameters
+        ----------
+        fn : str
+            The path of the file.
+        """
+        with open(fn, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+
+    def clear(self):
+        """
+        Forget all events.
+        """
+        self.events = []
+
+
+class _Stage:
+    """
+    The context manager of `Profiler.stage`.
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(self.profiler._local, "stack", None)
+        if stack is None:
+            stack = self.profiler._local.stack = []
+        # the name of an event is the path from the outermost stage
+        path = f"{stack[-1]['name']}/{self.name}" if stack else self.name
+        self.event = {"name": path, "children_seconds": 0.0}
+        stack.append(self.event)
+        self.start = time.perf_counter()
+        return self.event
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        stack = self.profiler._local.stack
+        stack.pop()
+        if stack:
+            stack[-1]["children_seconds"] += seconds
+
+        # do not keep the output alive
+        output = self.event.pop("output", None)
+        self.profiler.events.append(
+            {
+                "name": self.event["name"],
+                "start": self.start - self.profiler._origin,
+                "seconds": seconds,
+                "self_seconds": seconds - self.event["children_seconds"],
+                "thread": self.profiler._thread(),
+                "voxels": (
+                    output.GetNumberOfPixels()
+                    if isinstance(output, sitk.Image)
+                    else None
+                ),
+                "output_bytes": image_nbytes(output),
+            }
+        )
+        return False
@@ -0,0 +1,215 @@
+"""
+pyramid.py
+
+Description: Coarse to fine binary morphology for AutocontourKnee: large
+             radius dilations, erosions, openings and closings computed on
+             the image downsampled by a factor, with only a narrow band at
+             the boundary refined at full resolution, and the comparison of
+             the masks of the pyramid mode with those at full resolution.
+"""
+
+import SimpleITK as sitk
+
+from ormir_xct.util.segmentation_evaluation import (
+    calculate_dice_and_jaccard,
+    calculate_surface_distance_measures,
+)
+
+
+def downsample(img, factor, in_value, out_value=0):
+    """
+    Downsample a binary image by `factor` in every direction: a coarse voxel
+    is foreground if at least half of the voxels it covers are. The image is
+    padded with background to a multiple of the factor.
+
+    Parameters
+    ----------
+    img : sitk.Image
+        The binary image.
+
+    factor : int
+        The downsampling factor.
+
+    in_value : int
+        The value of the foreground voxels.
+
+    out_value : int
+        The value of the background voxels. Default is 0.
+
+    Returns
+    -------
+    sitk.Image
+        The coarse binary image.
+    """
+
+    fraction = sitk.Cast(img == in_value, sitk.sitkFloat32)
+    padding = [-size % factor for size in img.GetSize()]
+    fraction = sitk.ConstantPad(fraction, [0, 0, 0], padding, 0.0)
+    fraction = sitk.BinShrink(fraction, [factor] * 3)
+
+    return sitk.BinaryThreshold(fraction, 0.5, 1.0, in_value, out_value)
+
+
+def upsample(img, reference, out_value=0):
+    """
+    Upsample a coarse binary image from `downsample` to the grid of the image
+    it was downsampled from, with nearest neighbour interpolation.
+
+    Parameters
+    ----------
+    img : sitk.Image
+        The coarse binary image.
+
+    reference : sitk.Image
+        The image that was downsampled.
+
+    out_value : int
+        The value of the background voxels. Default is 0.
+
+    Returns
+    -------
+    sitk.Image
+        The binary image on the grid of `reference`.
+    """
+
+    return sitk.Resample(
+        img,
+        reference,
+        sitk.Transform(),
+        sitk.sitkNearestNeighbor,
+        out_value,
+        reference.GetPixelID(),
+    )
+
+
+def pyramid_radii(radius, factor):
+    """
+    Split a ball of the given radius into one applied to the image
+    downsampled by `factor` and one applied at full resolution, see
+    `pyramid_morphology`.
+
+    Parameters
+    ----------
+    radius : int
+        The radius of the ball in voxels.
+
+    factor : int
+        The downsampling factor.
+
+    Returns
+    -------
+    tuple
+        The coarse radius, in coarse voxels, and the fine radius, in voxels.
+    """
+
+    coarse_radius = max((radius - factor) // factor, 0)
+    fine_radius = int(round(radius - factor * (coarse_radius + 0.5)))
+    return coarse_radius, fine_radius
+
+
+def pyramid_morphology(img, operation, radius, factor, morphology, down, up):
+    """
+    Approximate a large radius morphological operation coarse to fine.
+    A ball of radius r reaches about r + 1/2 voxels, and balls add up their
+    reach when applied one after the other. With the factor f, the ball of
+    radius r is split into one of radius c = (r - f) // f, applied to the
+    image downsampled by f, and one of radius w = r - f * (c + 1/2) (between
+    f / 2 and 3 f / 2), applied at full resolution, so that only the narrow
+    band at the boundary that the last w voxels of growth or shrinkage cover
+    is computed at full resolution:
+
+    dilate: D_w(up(D_c(down(X))))
+    erode: E_w(up(E_c(down(X))))
+    opening: D_w(up(O_c(down(E_w(X)))))
+    closing: E_w(up(C_c(down(D_w(X)))))
+
+    Dilations and closings never remove voxels of the input, and erosions and
+    openings never add voxels to it, so the result is combined with the input
+    accordingly.
+
+    Parameters
+    ----------
+    img : sitk.Image
+        The binary image to filter, with the foreground and background values
+        that `morphology`, `down` and `up` use.
+
+    operation : str
+        One of "dilate", "erode", "opening" and "closing".
+
+    radius : int
+        The radius of the ball in voxels.
+
+    factor : int
+        The downsampling factor.
+
+    morphology : function
+        Computes `morphology(img, operation, radius)` at the resolution of
+        `img`.
+
+    down : function
+        Downsamples an image by `factor`, like `downsample`.
+
+    up : function
+        Upsamples a coarse image to the grid of a reference image, like
+        `upsample`.
+
+    Returns
+    -------
+    sitk.Image
+        The filtered image.
+    """
+
+    coarse_radius, fine_radius = pyramid_radii(radius, factor)
+    before = {"opening": "erode", "closing": "dilate"}
+    after = {"dilate": "dilate", "erode": "erode", "opening": "dilate"}
+    after["closing"] = "erode"
+
+    img_filtered = img
+    if operation in before:
+        img_filtered = morphology(img_filtered, before[operation], fine_radius)
+    img_coarse = morphology(down(img_filtered), operation, coarse_radius)
+    img_filtered = morphology(up(img_coarse, img), after[operation], fine_radius)
+
+    # the voxels of the binary images are the foreground or background value,
+    # so the bitwise operators combine them as they are
+    if operation in ("dilate", "closing"):
+        return sitk.Or(img_filtered, img)
+    return sitk.And(img_filtered, img)
+
+
+def compare_masks(seg, ref, spacing):
+    """
+    Compare a mask with a reference mask, see
+    `AutocontourKnee.evaluate_pyramid`.
+
+    Parameters
+    ----------
+    seg : sitk.Image
+        The binary mask.
+
+    ref : sitk.Image
+        The binary reference mask.
+
+    spacing : tuple
+        The voxel spacing of the masks.
+
+    Returns
+    -------
+    dict
+        The Dice coefficient ("dice"), Jaccard index ("jaccard"), the mean
+        and Hausdorff symmetric surface distance ("mean_distance" and
+        "hausdorff", in the units of the spacing), and the number of voxels
+        that differ ("different_voxels").
+    """
+
+    seg = sitk.GetArrayFromImage(seg)
+    ref = sitk.GetArrayFromImage(ref)
+    dice, jaccard = calculate_dice_and_jaccard(ref, seg)
+    distances = calculate_surface_distance_measures(ref, seg, spacing)
+    return {
+        "dice": float(dice),
+        "jaccard": float(jaccard),
+        "mean_distance": float(distances["mean"]),
+        "hausdorff": float(distances["max"]),
+        "different_voxels": int(((ref > 0) != (seg > 0)).sum()),
+    }
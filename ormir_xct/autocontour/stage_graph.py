@@ -0,0 +1,432 @@
+"""
+stage_graph.py
+
+Description: A small scheduler for pipelines written as a sequence of named
+             stages that read and write named values, used by
+             AutocontourKnee. Every value is released as soon as the last
+             stage that reads it has run, binary images are stored as
+             sitkUInt8, and the time and memory of every stage can be
+             recorded. With a `StageCache`, the output of every stage is
+             memoized by a key of its inputs and parameters, so that running
+             the graph again with some parameters changed only runs the
+             stages that depend on them.
+"""
+
+import time
+import hashlib
+import resource
+from collections import OrderedDict
+
+import SimpleITK as sitk
+
+
+def get_rss():
+    """
+    The resident set size of this process in bytes, or None where it cannot
+    be read.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process to the current one.
+    This is only possible on Linux; elsewhere it returns False, and
+    `get_peak_rss` keeps reporting the peak since the start of the process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss():
+    """
+    The peak resident set size of this process in bytes, since the start of
+    the process or the last `reset_peak_rss`.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if peak > 2**32 else peak * 1024
+
+
+def image_nbytes(value):
+    """
+    The size of the pixel buffer of a SimpleITK image in bytes, 0 for any
+    other value.
+    """
+    if not isinstance(value, sitk.Image):
+        return 0
+    return (
+        value.GetNumberOfPixels()
+        * value.GetNumberOfComponentsPerPixel()
+        * value.GetSizeOfPixelComponent()
+    )
+
+
+def value_key(value):
+    """
+    A key of a value given to `StageGraph.run`, for `StageCache`: a hash of
+    the pixels and the geometry of a SimpleITK image, or of the repr of any
+    other value.
+    """
+    digest = hashlib.sha1()
+    if isinstance(value, sitk.Image):
+        digest.update(sitk.GetArrayViewFromImage(value))
+        value = (
+            value.GetPixelID(),
+            value.GetSize(),
+            value.GetSpacing(),
+            value.GetOrigin(),
+            value.GetDirection(),
+        )
+    digest.update(repr(value).encode())
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    The memoized outputs of stages of `StageGraph.run`, by the key of the
+    stage: a hash of its name, function, parameters and settings, and of the
+    keys of its inputs. The least recently used outputs are dropped when the
+    images held are more than `max_bytes`.
+
+    Attributes
+    ----------
+    max_bytes : int
+        The most bytes of images to hold, or None for no limit.
+
+    nbytes : int
+        The bytes of the images held.
+
+    hits : int
+        The number of stages whose output was found.
+
+    misses : int
+        The number of stages that had to run.
+
+    Methods
+    -------
+    get(key)
+
+    put(key, value)
+
+    clear()
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key):
+        """
+        The output stored for a key, which becomes the most recently used.
+        """
+        self._values.move_to_end(key)
+        return self._values[key]
+
+    def put(self, key, value):
+        """
+        Store the output of a stage, then drop the least recently used outputs
+        until at most `max_bytes` are held. An output larger than `max_bytes`
+        is not stored.
+        """
+        nbytes = image_nbytes(value)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+        self._values[key] = value
+        self.nbytes += nbytes
+        while self.max_bytes is not None and self.nbytes > self.max_bytes:
+            _, dropped = self._values.popitem(last=False)
+            self.nbytes -= image_nbytes(dropped)
+
+    def clear(self):
+        """
+        Drop all outputs.
+        """
+        self._values.clear()
+        self.nbytes = 0
+
+
+class Stage:
+    """
+    One stage of a `StageGraph`: `output = function(*inputs, **parameters)`.
+
+    Attributes
+    ----------
+    name : str
+        The name of the stage and of the value it writes.
+
+    function : callable
+
+    inputs : list
+        The names of the values passed to `function`, in order.
+
+    parameters : dict
+        Keyword arguments passed to `function`.
+
+    binary : bool
+        If True, the output is a binary image that is stored as sitkUInt8.
+
+    settings : dict
+        The values, other than its inputs and parameters, that `function`
+        reads, e.g. the attributes of the object of a bound method.
+    """
+
+    def __init__(self, name, function, inputs, parameters, binary, settings):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.parameters = parameters
+        self.binary = binary
+        self.settings = settings
+
+    def key(self, input_keys):
+        """
+        The key of the output of the stage, from the keys of its inputs.
+        """
+        description = (
+            self.name,
+            getattr(self.function, "__qualname__", repr(self.function)),
+            input_keys,
+            sorted(self.parameters.items()),
+            sorted(self.settings.items()),
+            self.binary,
+        )
+        return hashlib.sha1(repr(description).encode()).hexdigest()
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, inputs={self.inputs})"
+
+
+class StageGraph:
+    """
+    A pipeline of named stages that run in the order they were added. The
+    inputs of a stage are values given to `run` or written by earlier stages.
+
+    Attributes
+    ----------
+    stages : list
+        The stages, in the order they run.
+
+    report : list
+        After `run`, one dict per stage with its "stage" name, its run time in
+        "seconds" and the "held_bytes" of all images held by the graph after
+        it. If `run` recorded memory, also the resident set size after the
+        stage ("rss") and its peak during the stage ("peak_rss"), in bytes.
+        If `run` used a cache, also whether the output was "cached".
+
+    profiler : Profiler
+        If not None, every stage is recorded as a stage of this profiler, see
+        `ormir_xct.autocontour.profiling`.
+
+    Methods
+    -------
+    add_stage(name, function, inputs=(), binary=False, settings=None,
+              **parameters)
+
+    run(values, outputs, record_memory=False, cache=None, keys=None)
+
+    peak_rss()
+    """
+
+    def __init__(self, profiler=None):
+        self.stages = []
+        self.report = []
+        self.profiler = profiler
+
+    def add_stage(
+        self, name, function, inputs=(), binary=False, settings=None, **parameters
+    ):
+        """
+        Add a stage that writes `function(*inputs, **parameters)` to the value
+        `name`.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage and its output. It must be unique.
+
+        function : callable
+
+        inputs : list
+            The names of the values to pass to `function`.
+
+        binary : bool
+            Set this to True if the output is a binary image, so that it is
+            stored as sitkUInt8.
+
+        settings : dict
+            The values, other than its inputs and `parameters`, that `function`
+            reads and that change its output, for the keys of `StageCache`.
+
+        **parameters
+            Keyword arguments for `function`.
+
+        Returns
+        -------
+        str
+            `name`, to use as an input of later stages.
+        """
+        if any(stage.name == name for stage in self.stages):
+            raise ValueError(f"there is already a stage named {name!r}")
+        self.stages.append(
+            Stage(name, function, inputs, parameters, binary, settings or {})
+        )
+        return name
+
+    def run(self, values, outputs, record_memory=False, cache=None, keys=None):
+        """
+        Run the stages in order. Every value that is not one of `outputs` is
+        released by the graph as soon as the last stage that reads it has run.
+
+        Parameters
+        ----------
+        values : dict
+            The values the stages read that no stage writes, by name. The dict
+            itself is not modified.
+
+        outputs : list
+            The names of the values to return.
+
+        record_memory : bool
+            Set this to True to record the resident set size after each stage
+            and its peak during each stage in `report`. This resets the peak
+            resident set size of the process before every stage, see
+            `reset_peak_rss`.
+
+        cache : StageCache
+            If given, the output of every stage is looked up in it before the
+            stage runs, and stored in it after.
+
+        keys : dict
+            The keys of some of `values` for the cache, e.g. to hash a large
+            image only once for several runs. The keys of the other values are
+            computed with `value_key`.
+
+        Returns
+        -------
+        list
+            The values named in `outputs`, in order.
+        """
+        values = dict(values)
+        last_use = {name: -1 for name in values}
+        for index, stage in enumerate(self.stages):
+            for name in stage.inputs:
+                if name not in last_use:
+                    raise ValueError(
+                        f"stage {stage.name!r} reads {name!r}, which is neither "
+                        "given nor written by an earlier stage"
+                    )
+                last_use[name] = index
+            last_use[stage.name] = index
+        for name in outputs:
+            if name not in last_use:
+                raise ValueError(f"no value named {name!r}")
+            last_use[name] = len(self.stages)
+
+        if cache is not None:
+            keys = dict(keys or {})
+            for name, value in values.items():
+                if name not in keys:
+                    keys[name] = value_key(value)
+
+        self.report = []
+        for index, stage in enumerate(self.stages):
+            if record_memory:
+                reset_peak_rss()
+            start = time.perf_counter()
+            cached = False
+            if cache is not None:
+                key = stage.key([keys[name] for name in stage.inputs])
+                cached = key in cache
+
+            if cached:
+                value = cache.get(key)
+                cache.hits += 1
+            else:
+                value = self._run_stage(stage, values)
+                if cache is not None:
+                    cache.misses += 1
+                    cache.put(key, value)
+            if cache is not None:
+                # values that are not images are small, so the later stages
+                # see them by their content, and are found in the cache when
+                # such a value did not change even though its stage ran again
+                if isinstance(value, sitk.Image):
+                    keys[stage.name] = key
+                else:
+                    keys[stage.name] = value_key(value)
+            values[stage.name] = value
+            del value
+
+            # release what no later stage reads
+            for name in set(stage.inputs) | {stage.name}:
+                if last_use[name] <= index:
+                    del values[name]
+
+            entry = {
+                "stage": stage.name,
+                "seconds": time.perf_counter() - start,
+                "held_bytes": sum(image_nbytes(v) for v in values.values()),
+            }
+            if cache is not None:
+                entry["cached"] = cached
+            if record_memory:
+                entry["rss"] = get_rss()
+                entry["peak_rss"] = get_peak_rss()
+            self.report.append(entry)
+
+        return [values[name] for name in outputs]
+
+    def _run_stage(self, stage, values):
+        """
+        Run one stage on the values, and cast its output to sitkUInt8 if it is
+        binary.
+        """
+        inputs = [values[name] for name in stage.inputs]
+        if self.profiler is None:
+            value = stage.function(*inputs, **stage.parameters)
+        else:
+            with self.profiler.stage(stage.name) as event:
+                value = stage.function(*inputs, **stage.parameters)
+                event["output"] = value
+        del inputs
+        if stage.binary and value.GetPixelID() != sitk.sitkUInt8:
+            value = sitk.Cast(value, sitk.sitkUInt8)
+        return value
+
+    def peak_rss(self):
+        """
+        The largest peak resident set size of the stages of the last `run`, in
+        bytes, or None if it did not record memory.
+        """
+        peaks = [entry.get("peak_rss") for entry in self.report]
+        if not peaks or None in peaks:
+            return None
+        return max(peaks)
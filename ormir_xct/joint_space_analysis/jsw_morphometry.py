@@ -13,10 +13,10 @@ import numpy as np
 import SimpleITK as sitk
 
 from ormir_xct.joint_space_analysis.connected_check import connected_check
-from ormir_xct.util.hildebrand_thickness import (
-    calc_structure_thickness_statistics,
-    compute_local_thickness_from_mask,
-)
+from ormir_xct.util.lazy_import import lazy_import
+
+# the thickness kernels pull in numba, load them on the first jsw_parameters call
+hildebrand_thickness = lazy_import("ormir_xct.util.hildebrand_thickness")
 
 
 # Set standard global variables used in IPL script
@@ -166,6 +166,8 @@ def jsw_parameters(
     oversamp=True,
     skel=True,
     minimum=0.0,
+    output_dtype=np.float64,
+    output_format="dense",
 ):
     """
     Computes the following JSW parameters:
@@ -190,23 +192,76 @@ def jsw_parameters(
     filename : string
 
     voxel_size : float
+
+    output_dtype : numpy.dtype
+        Type of the thickness map, np.float64, np.float32 or np.float16.
+        SimpleITK has no half precision pixel type, so np.float16 maps are
+        returned as float32 images.
+
+    output_format : string
+        "dense" returns a thickness map with the size of the padded image.
+        "bbox" returns a thickness map cropped to the joint space, with the
+        spacing, direction and (shifted) origin of dilated_js_mask, or a
+        single zero voxel at the origin of dilated_js_mask if the joint space
+        has no thickness. "indices" returns the flat indices and values of
+        the nonzero voxels of the thickness map (see
+        hildebrand_thickness.SparseThickness) instead of an image, as an
+        image would have to be dense.
+
+    Returns
+    -------
+    dt_img : SimpleITK.Image or hildebrand_thickness.SparseThickness
+
+    jsw_params : numpy.ndarray
     """
+    if output_format not in ("dense", "bbox", "indices"):
+        raise ValueError('output_format must be "dense", "bbox" or "indices"')
+
     # Distance transform + JSW parameters
     mask = sitk.GetArrayFromImage(js_mask)
     dilated_mask = sitk.GetArrayFromImage(dilated_js_mask)
 
     # Needs to be fixed for masks with JS minimum < 1 voxel
-    result = calc_structure_thickness_statistics(
-        dilated_mask, voxel_size, minimum, mask, oversample=oversamp, skeletonize=skel
+    result = hildebrand_thickness.calc_structure_thickness_statistics(
+        dilated_mask,
+        voxel_size,
+        minimum,
+        mask,
+        oversample=oversamp,
+        skeletonize=skel,
+        output_dtype=output_dtype,
+        output_format=output_format,
     )
 
-    mean_thickness = result[0]
-    mean_thickness_std = result[1]
-    min_thickness = result[2]
-    max_thickness = result[3]
-    thickness_map = result[4]
-
-    dt_img = sitk.GetImageFromArray(thickness_map)
+    mean_thickness = result.mean
+    mean_thickness_std = result.std
+    min_thickness = result.min
+    max_thickness = result.max
+    thickness_map = result.local_thickness
+
+    if output_format == "indices":
+        dt_img = thickness_map
+    elif output_format == "bbox":
+        array, offset = thickness_map.array, thickness_map.offset
+        if array.size == 0:
+            # SimpleITK images cannot be empty
+            array, offset = np.zeros((1, 1, 1), dtype=array.dtype), (0, 0, 0)
+        dt_img = sitk.GetImageFromArray(
+            array.astype(np.promote_types(output_dtype, np.float32), copy=False)
+        )
+        dt_img.SetSpacing(dilated_js_mask.GetSpacing())
+        dt_img.SetDirection(dilated_js_mask.GetDirection())
+        dt_img.SetOrigin(
+            dilated_js_mask.TransformIndexToPhysicalPoint(
+                [int(i) for i in offset[::-1]]
+            )
+        )
+    else:
+        dt_img = sitk.GetImageFromArray(
+            thickness_map.astype(
+                np.promote_types(output_dtype, np.float32), copy=False
+            )
+        )
 
     # Get the volume of the JS
     shape_stats = sitk.LabelShapeStatisticsImageFilter()
@@ -221,7 +276,8 @@ def jsw_parameters(
         for i in shape_stats.GetLabels()
     ]
 
-    jsv = stats_list[0][0]
+    # an empty joint space has no label
+    jsv = stats_list[0][0] if stats_list else 0.0
 
     # Check if we have bone-on-bone contact
     labels = connected_check(pad_image)
@@ -260,7 +316,7 @@ def jsw_parameters(
                 min_thickness,
                 connected,
                 max_thickness,
-                max_thickness / min_thickness,
+                max_thickness / min_thickness if min_thickness else None,
             ]
         ],
         dtype=object,
@@ -0,0 +1,568 @@
+"""
+distance_transform.py
+
+Description: An exact, anisotropic, multithreaded Euclidean distance
+             transform, shared by the morphometry and segmentation
+             evaluation utilities, and its multi-label variant.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+import numba
+from collections.abc import Iterable
+from contextlib import contextmanager
+from numba import jit, prange
+from typing import Optional, Tuple, Union
+
+
+@contextmanager
+def numba_threads(n_threads: Optional[int]):
+    """
+    Temporarily set the number of threads numba uses for parallel kernels.
+
+    Parameters
+    ----------
+    n_threads : Optional[int]
+        The number of threads to use. If `None`, numba's current setting is left as is. Values larger than the number
+        of threads numba was started with are clipped to that number.
+    """
+    if n_threads is None:
+        yield
+        return
+    previous = numba.get_num_threads()
+    numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+    try:
+        yield
+    finally:
+        numba.set_num_threads(previous)
+
+
+def check_n_threads(n_threads: Optional[int]):
+    """
+    Validate a thread count.
+    """
+    if n_threads is not None and (not isinstance(n_threads, int) or n_threads <= 0):
+        raise ValueError("if given, `n_threads` must be a positive integer")
+
+
+def no_background_distances(
+    shape: Tuple[int, ...],
+    voxel_width: Iterable[float],
+    step: int = 1,
+    squared: bool = False,
+) -> np.ndarray:
+    """
+    The distances that `scipy.ndimage.distance_transform_edt` gives a mask without zero voxels, bit for bit. scipy
+    then takes index -1 along the first axis and index 0 along the other axes as the nearest zero voxel of every
+    voxel, so the distances grow from that corner outside of the image.
+
+    Parameters
+    ----------
+    shape : Tuple[int, ...]
+        The shape of the output.
+
+    voxel_width : Iterable[float]
+        The voxel widths in each dimension.
+
+    step : int
+        Set this to sample the distances of a mask with `(n - 1) * step + 1` voxels along each axis at every `step`-th
+        voxel, e.g. 2 for the native voxels of an oversampled grid.
+
+    squared : bool
+        Set this to `True` to return the squared distances, skipping the square root.
+
+    Returns
+    -------
+    np.ndarray
+        The distance map.
+    """
+    total = None
+    for axis, (n, width) in enumerate(zip(shape, voxel_width)):
+        # the offsets to the nearest zero voxel, scaled and squared like scipy
+        # does, and summed in the same order
+        offset = ((-1 if axis == 0 else 0) - step * np.arange(n)).astype(np.float64)
+        offset *= width
+        offset = (offset * offset).reshape(
+            [-1 if i == axis else 1 for i in range(len(shape))]
+        )
+        total = offset if total is None else total + offset
+    total = np.broadcast_to(total, shape)
+    return total.copy() if squared else np.sqrt(total)
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def lower_envelope(
+    f: np.ndarray,
+    scale: float,
+    step: int,
+    arg: np.ndarray,
+    v: np.ndarray,
+    z: np.ndarray,
+) -> np.ndarray:
+    """
+    Felzenszwalb and Huttenlocher's lower envelope of parabolas, the one-dimensional step of the separable distance
+    transform: for every `x` in `range(0, len(f), step)`, find the `y` that minimizes `scale * (x - y) ** 2 + f[y]`,
+    ignoring the `y` where `f` is infinite.
+
+    Parameters
+    ----------
+    f : np.ndarray
+        The squared distances along the line found by the previous steps, infinite where there is no feature.
+    scale : float
+        The squared voxel width along the line.
+    step : int
+        The stride of the positions `x` the envelope is evaluated at.
+    arg : np.ndarray
+        An int array to write the minimizing `y` for each `x` into, at index `x // step`, or -1 if every `f[y]` is
+        infinite.
+    v : np.ndarray
+        An int scratch array with length `len(f)`.
+    z : np.ndarray
+        A float scratch array with length `len(f) + 1`.
+
+    Returns
+    -------
+    np.ndarray
+        `arg`
+    """
+    k = -1
+    for q in range(len(f)):
+        if f[q] == np.inf:
+            continue
+        fq = f[q] + scale * q * q
+        s = -np.inf
+        while k >= 0:
+            s = (fq - (f[v[k]] + scale * v[k] * v[k])) / (2 * scale * (q - v[k]))
+            if s <= z[k]:
+                k -= 1
+                s = -np.inf
+            else:
+                break
+        k += 1
+        v[k] = q
+        z[k] = s
+        z[k + 1] = np.inf
+
+    j = 0
+    for x in range(0, len(f), step):
+        if k < 0:
+            arg[x // step] = -1
+            continue
+        while z[j + 1] < x:
+            j += 1
+        arg[x // step] = v[j]
+    return arg
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def squared_distance(
+    k0: int, k1: int, k2: int, spacing_sq: np.ndarray, groups: np.ndarray
+) -> float:
+    """
+    Squared length of the offset `(k0, k1, k2)` on a grid with squared voxel widths `spacing_sq`. The squared
+    offsets along axes with the same voxel width (`groups[i]` is the first axis with the voxel width of axis `i`,
+    see `spacing_groups`) are summed as integers first, so that offsets with the same length always give the same
+    float, whichever way ties between equidistant features are broken.
+    """
+    a0, a1, a2 = k0 * k0, 0, 0
+    if groups[1] == 0:
+        a0 += k1 * k1
+    else:
+        a1 += k1 * k1
+    if groups[2] == 0:
+        a0 += k2 * k2
+    elif groups[2] == 1:
+        a1 += k2 * k2
+    else:
+        a2 += k2 * k2
+    return (spacing_sq[0] * a0 + spacing_sq[1] * a1) + spacing_sq[2] * a2
+
+
+def spacing_groups(spacing: np.ndarray) -> np.ndarray:
+    """
+    For each axis, the index of the first axis with the same voxel width, see `squared_distance`.
+    """
+    return np.array([list(spacing).index(s) for s in spacing], dtype=np.int64)
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def squared_feature_distance(k0: int, k1: int, k2: int, spacing: np.ndarray) -> float:
+    """
+    Squared length of the offset `(k0, k1, k2)` to a feature on a grid with voxel widths `spacing`, evaluated like
+    `scipy.ndimage.distance_transform_edt` does, so that the distances are the same bit for bit.
+    """
+    t0 = k0 * spacing[0]
+    t1 = k1 * spacing[1]
+    t2 = k2 * spacing[2]
+    return (t0 * t0 + t1 * t1) + t2 * t2
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def feature_distance(k0: int, k1: int, k2: int, spacing: np.ndarray) -> float:
+    """
+    Length of the offset `(k0, k1, k2)`, see `squared_feature_distance`.
+    """
+    return np.sqrt(squared_feature_distance(k0, k1, k2, spacing))
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def voronoi_line(
+    f: np.ndarray,
+    d: int,
+    coor: np.ndarray,
+    spacing: np.ndarray,
+    g: np.ndarray,
+    nearest: np.ndarray,
+) -> bool:
+    """
+    Maurer, Qi and Raghavan's one-dimensional step of the separable feature transform, ported from `_VoronoiFT` of
+    `scipy.ndimage` with the same floating point expressions, so that ties between equidistant features are broken
+    the same way: for every voxel of a line along axis `d`, find the nearest of the features of the line.
+
+    Parameters
+    ----------
+    f : np.ndarray
+        An int array with shape `(n, 3)`, the features found by the previous steps for the `n` voxels of the line,
+        with `f[x, 0] < 0` where there is none.
+    d : int
+        The axis of the line.
+    coor : np.ndarray
+        The coordinates of the line along the other axes.
+    spacing : np.ndarray
+        The voxel widths.
+    g : np.ndarray
+        An int scratch array with length `n`.
+    nearest : np.ndarray
+        An int array to write the index in `f` of the nearest feature of every voxel into.
+
+    Returns
+    -------
+    bool
+        Whether the line has a feature. If not, `nearest` is left as is.
+    """
+    n = f.shape[0]
+    l = -1
+    for x in range(n):
+        if f[x, 0] < 0:
+            continue
+        fd = float(f[x, d])
+        w = 0.0
+        for jj in range(3):
+            if jj != d:
+                tw = float(f[x, jj] - coor[jj]) * spacing[jj]
+                w += tw * tw
+        while l >= 1:
+            idx1 = g[l]
+            idx2 = g[l - 1]
+            f1 = float(f[idx1, d])
+            a = (f1 - f[idx2, d]) * spacing[d]
+            b = (fd - f1) * spacing[d]
+            c = a + b
+            u = 0.0
+            v = 0.0
+            for jj in range(3):
+                if jj != d:
+                    tu = float(f[idx2, jj] - coor[jj]) * spacing[jj]
+                    tv = float(f[idx1, jj] - coor[jj]) * spacing[jj]
+                    u += tu * tu
+                    v += tv * tv
+            if c * v - b * u - a * w - a * b * c <= 0.0:
+                break
+            l -= 1
+        l += 1
+        g[l] = x
+
+    if l < 0:
+        return False
+    last = l
+    l = 0
+    for x in range(n):
+        delta1 = 0.0
+        for jj in range(3):
+            t = float(f[g[l], jj] - (x if jj == d else coor[jj])) * spacing[jj]
+            delta1 += t * t
+        while l < last:
+            delta2 = 0.0
+            for jj in range(3):
+                t = float(f[g[l + 1], jj] - (x if jj == d else coor[jj])) * spacing[jj]
+                delta2 += t * t
+            if delta1 <= delta2:
+                break
+            delta1 = delta2
+            l += 1
+        nearest[x] = g[l]
+    return True
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def _voxel(d: int, p: int, q: int, x: int) -> Tuple[int, int, int]:
+    """
+    Index of voxel `x` of the line along axis `d` at position `(p, q)` on the other axes.
+    """
+    x, p, q = np.int64(x), np.int64(p), np.int64(q)
+    if d == 0:
+        return x, p, q
+    if d == 1:
+        return p, x, q
+    return p, q, x
+
+
+@jit(nopython=True, parallel=True, error_model="numpy", cache=True)
+def _label_features(
+    labels: np.ndarray,
+    n_labels: int,
+    features: np.ndarray,
+    spacing: np.ndarray,
+    d: int,
+) -> np.ndarray:
+    """
+    The pass of the feature transform along axis `d`, for every label. On a line of one label, the voxels with other
+    labels are their own nearest feature, so only the features of the voxels with the label itself are read and
+    written, and the labels can share one feature array. The first pass also sets the voxels with label zero to
+    their own index, like the background of `scipy.ndimage.distance_transform_edt`.
+    """
+    shape = labels.shape
+    n = shape[d]
+    n_p = shape[1] if d == 0 else shape[0]
+    n_q = shape[1] if d == 2 else shape[2]
+    for p in prange(n_p):
+        f = np.empty((n, 3), dtype=np.int64)
+        g = np.empty(n, dtype=np.int64)
+        nearest = np.empty(n, dtype=np.int64)
+        coor = np.empty(3, dtype=np.int64)
+        for q in range(n_q):
+            i, j, k = _voxel(d, p, q, 0)
+            coor[0], coor[1], coor[2] = i, j, k
+            for label in range(1, n_labels + 1):
+                present = False
+                for x in range(n):
+                    i, j, k = _voxel(d, p, q, x)
+                    if labels[i, j, k] != label:
+                        f[x, 0], f[x, 1], f[x, 2] = i, j, k
+                        continue
+                    present = True
+                    if d == 0:
+                        # like scipy, only the first index marks a missing feature
+                        f[x, 0], f[x, 1], f[x, 2] = -1, 0, 0
+                    else:
+                        f[x, 0] = features[0, i, j, k]
+                        f[x, 1] = features[1, i, j, k]
+                        f[x, 2] = features[2, i, j, k]
+                if not present:
+                    continue
+                found = voronoi_line(f, d, coor, spacing, g, nearest)
+                for x in range(n):
+                    i, j, k = _voxel(d, p, q, x)
+                    if labels[i, j, k] != label:
+                        continue
+                    if found:
+                        features[0, i, j, k] = f[nearest[x], 0]
+                        features[1, i, j, k] = f[nearest[x], 1]
+                        features[2, i, j, k] = f[nearest[x], 2]
+                    elif d == 0:
+                        features[0, i, j, k] = -1
+                        features[1, i, j, k] = 0
+                        features[2, i, j, k] = 0
+            if d == 0:
+                for x in range(n):
+                    i, j, k = _voxel(d, p, q, x)
+                    if labels[i, j, k] == 0:
+                        features[0, i, j, k] = i
+                        features[1, i, j, k] = j
+                        features[2, i, j, k] = k
+    return features
+
+
+@jit(nopython=True, parallel=True, error_model="numpy", cache=True)
+def _label_feature_distances(
+    labels: np.ndarray,
+    features: np.ndarray,
+    spacing: np.ndarray,
+    squared: bool,
+    dist: np.ndarray,
+) -> np.ndarray:
+    """
+    Distance from every voxel to its nearest feature, zero on the voxels with label zero.
+    """
+    n0, n1, n2 = labels.shape
+    for i in prange(n0):
+        for j in range(n1):
+            for k in range(n2):
+                if labels[i, j, k] == 0:
+                    dist[i, j, k] = 0.0
+                    continue
+                d = squared_feature_distance(
+                    i - features[0, i, j, k],
+                    j - features[1, i, j, k],
+                    k - features[2, i, j, k],
+                    spacing,
+                )
+                dist[i, j, k] = d if squared else np.sqrt(d)
+    return dist
+
+
+def _voxel_widths(voxel_width: Union[Iterable[float], float], ndim: int) -> np.ndarray:
+    """
+    The voxel widths of a 1, 2 or 3 dimensional image, padded with ones to three dimensions.
+    """
+    if isinstance(voxel_width, (float, int)):
+        voxel_width = [float(voxel_width)] * ndim
+    elif len(voxel_width) != ndim:
+        raise ValueError(
+            "`voxel_width` must be a float, int, or iterable with one entry per dimension"
+        )
+    return np.concatenate([np.ones(3 - ndim), np.asarray(voxel_width, float)])
+
+
+def euclidean_distance_transform(
+    mask: np.ndarray,
+    voxel_width: Union[Iterable[float], float] = 1.0,
+    squared: bool = False,
+    return_indices: bool = False,
+    dtype: Union[type, np.dtype] = np.float64,
+    n_threads: Optional[int] = None,
+) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Exact Euclidean distance transform of a binary mask: the distance from every nonzero voxel to the nearest zero
+    voxel, which is zero on the zero voxels. For 1, 2 and 3 dimensional masks, the distances and indices are the same
+    as those of `scipy.ndimage.distance_transform_edt` bit for bit, also with anisotropic voxels and for masks
+    without zero voxels.
+
+    The transform is Maurer, Qi and Raghavan's separable algorithm as implemented by scipy, one pass per axis in the
+    same order and with the same floating point expressions (see `voronoi_line`), parallelized with numba over the
+    lines of each pass. Apart from the output, 13 bytes per voxel are needed.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        The binary mask.
+
+    voxel_width : Union[Iterable[float], float]
+        If an iterable with one entry per dimension, the voxel widths in each dimension. If a float, the isotropic
+        voxel width.
+
+    squared : bool
+        Set this to `True` to return the squared distances, skipping the square root.
+
+    return_indices : bool
+        Set this to `True` to also return the indices of the nearest zero voxel of every voxel.
+
+    dtype : Union[type, np.dtype]
+        The floating point type of the distances, `np.float64` or `np.float32`. The distances are always computed in
+        double precision.
+
+    n_threads : Optional[int]
+        Number of threads to use. If `None`, all threads available to numba are used. The result does not depend on
+        this setting.
+
+    Returns
+    -------
+    Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]
+        The distance map. If `return_indices` is `True`, also an int32 array with shape `(mask.ndim,) + mask.shape`
+        with the index of the nearest zero voxel along each axis, like the `indices` of `distance_transform_edt`.
+        If the mask has no zero voxels, these are the values scipy gives, see `no_background_distances`.
+    """
+    check_n_threads(n_threads)
+    mask = np.asarray(mask)
+    if mask.ndim not in (1, 2, 3):
+        raise ValueError("`mask` must have 1, 2 or 3 dimensions")
+    if np.dtype(dtype) not in (np.float32, np.float64):
+        raise ValueError("`dtype` must be `np.float32` or `np.float64`")
+    spacing = _voxel_widths(voxel_width, mask.ndim)
+
+    shape = mask.shape
+    if mask.size and mask.all():
+        dist = no_background_distances(shape, spacing[3 - mask.ndim :], squared=squared)
+        if return_indices:
+            indices = np.zeros((mask.ndim,) + shape, dtype=np.int32)
+            indices[0] = -1
+            return dist.astype(dtype), indices
+        return dist.astype(dtype)
+
+    # work on a 3D view, with unit length leading axes for lower dimensions
+    volume = (np.ascontiguousarray(mask) != 0).view(np.uint8)
+    volume = volume.reshape((1,) * (3 - mask.ndim) + shape)
+    features = np.empty((3,) + volume.shape, dtype=np.int32)
+    with numba_threads(n_threads):
+        for d in range(3):
+            _label_features(volume, 1, features, spacing, d)
+        dist = _label_feature_distances(
+            volume, features, spacing, squared, np.empty(volume.shape, dtype=dtype)
+        ).reshape(shape)
+
+    if return_indices:
+        return dist, features[3 - mask.ndim :].reshape((mask.ndim,) + shape)
+    return dist
+
+
+def label_distance_transform(
+    labels: np.ndarray,
+    voxel_width: Union[Iterable[float], float] = 1.0,
+    squared: bool = False,
+    dtype: Union[type, np.dtype] = np.float64,
+    n_threads: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Exact Euclidean distance transform of every label of a label image at once: the distance from every voxel with
+    a nonzero label to the nearest voxel with a different label (including zero), which is zero on the voxels with
+    label zero. On the voxels of each label, this is the same as `euclidean_distance_transform` of the mask of that
+    label, bit for bit.
+
+    The transform makes the same passes as `euclidean_distance_transform`, running `voronoi_line` once for each
+    label present on a line. Along a line of one label, the voxels with other labels are their own nearest feature,
+    so all labels share a single feature array and output, and are handled in one sweep over the image, with the
+    memory of a single transform.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        An integer label image with 1, 2 or 3 dimensions and labels `0, 1, ..., n`.
+
+    voxel_width : Union[Iterable[float], float]
+        If an iterable with one entry per dimension, the voxel widths in each dimension. If a float, the isotropic
+        voxel width.
+
+    squared : bool
+        Set this to `True` to return the squared distances, skipping the square root.
+
+    dtype : Union[type, np.dtype]
+        The floating point type of the distances, `np.float64` or `np.float32`.
+
+    n_threads : Optional[int]
+        Number of threads to use. If `None`, all threads available to numba are used. The result does not depend on
+        this setting.
+
+    Returns
+    -------
+    np.ndarray
+        The distance map.
+    """
+    check_n_threads(n_threads)
+    labels = np.asarray(labels)
+    if labels.ndim not in (1, 2, 3):
+        raise ValueError("`labels` must have 1, 2 or 3 dimensions")
+    if not np.issubdtype(labels.dtype, np.integer) and labels.dtype != bool:
+        raise ValueError("`labels` must be an integer array")
+    if np.dtype(dtype) not in (np.float32, np.float64):
+        raise ValueError("`dtype` must be `np.float32` or `np.float64`")
+    spacing = _voxel_widths(voxel_width, labels.ndim)
+
+    shape = labels.shape
+    volume = np.ascontiguousarray(labels).reshape((1,) * (3 - labels.ndim) + shape)
+    if volume.size and volume.min() < 0:
+        raise ValueError("`labels` must not be negative")
+    n_labels = int(volume.max()) if volume.size else 0
+    if volume.size and volume.min() > 0 and volume.min() == n_labels:
+        # one label covers the whole image
+        return euclidean_distance_transform(
+            labels, voxel_width, squared=squared, dtype=dtype, n_threads=n_threads
+        )
+
+    features = np.empty((3,) + volume.shape, dtype=np.int32)
+    with numba_threads(n_threads):
+        for d in range(3):
+            _label_features(volume, n_labels, features, spacing, d)
+        return _label_feature_distances(
+            volume, features, spacing, squared, np.empty(volume.shape, dtype)
+        ).reshape(shape)
@@ -34,10 +34,12 @@ import argparse
 
 from ormir_xct.util.sitk_itk import sitk_itk, itk_sitk
 from ormir_xct.util.image_to_dicom import image_to_dicom
+from ormir_xct.util.lazy_import import lazy_import
 
-import itk
 import SimpleITK as sitk
 
+itk = lazy_import("itk")
+
 
 def file_converter(input_image, output_image):
     """
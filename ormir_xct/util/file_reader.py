@@ -5,10 +5,13 @@ Created on: June 18th, 2022
 
 import os
 import sys
-import itk
 import SimpleITK as sitk
 
 from ormir_xct.util.sitk_itk import itk_sitk
+from ormir_xct.util.lazy_import import lazy_import
+
+# ITK is only needed to read Scanco files
+itk = lazy_import("itk")
 
 file_extensions = [".nii", ".mha", ".nrrd", ".aim", ".isq"]
 
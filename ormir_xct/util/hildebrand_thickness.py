@@ -11,22 +11,113 @@ from __future__ import annotations
 
 import numpy as np
 from collections.abc import Iterable
-from numba import jit
-from SimpleITK import GetImageFromArray, GetArrayFromImage, SignedMaurerDistanceMap
-import SimpleITK as sitk
-from scipy.ndimage.morphology import (
-    binary_erosion,
-    binary_dilation,
-    distance_transform_edt,
-)
-from skimage.morphology import skeletonize_3d
-from typing import Optional, Union
+from functools import lru_cache
+import tempfile
+from numba import jit, prange
+from typing import NamedTuple, Optional, Tuple, Union
 import warnings
 
+from ormir_xct.util.distance_transform import (
+    check_n_threads,
+    euclidean_distance_transform,
+    label_distance_transform,
+    lower_envelope,
+    no_background_distances,
+    numba_threads,
+    spacing_groups,
+    squared_distance,
+)
+from ormir_xct.util.lazy_import import lazy_import
+
+# SimpleITK is only needed for the skeleton ridge
+sitk = lazy_import("SimpleITK")
+
 EPS = 1e-8
 
+# the sets of voxels that spheres can be centered on, see
+# `compute_local_thickness_from_mask`
+RIDGE_MODES = ("skeleton", "mask", "hildebrand", "local_max")
+
+# the ways the local thickness field can be returned, see
+# `compute_local_thickness_from_mask`
+OUTPUT_FORMATS = ("dense", "indices", "bbox")
+
+# number of voxels around the bounding box of a mask that are kept when
+# cropping it, see `calc_structure_thickness_statistics`
+CROP_MARGIN = 2
+
+# edge length (in voxels) of the cubic tiles the output volume is split into
+# when filling spheres in parallel
+TILE_SIZE = 32
+
+# approximate peak working memory, in bytes per voxel of a slab, of the two
+# passes of `compute_local_thickness_chunked`: the distance transform (the same
+# with and without oversampling) and the ridge extraction and sphere filling
+DISTANCE_BYTES_PER_VOXEL = 32
+FILL_BYTES_PER_VOXEL = 72
+
+# number of thickness values whose moments are computed exactly before they are
+# merged into the running statistics, see `ThicknessAccumulator`
+STATISTICS_BLOCK = 4096
+
+
+class SparseThickness(NamedTuple):
+    """
+    A local thickness field stored as the flat indices and values of its nonzero voxels.
+
+    Attributes
+    ----------
+    indices : np.ndarray
+        The indices of the nonzero voxels into the flattened (C order) field.
+    values : np.ndarray
+        The local thickness at `indices`.
+    shape : Tuple[int, ...]
+        The shape of the field.
+    """
+
+    indices: np.ndarray
+    values: np.ndarray
+    shape: Tuple[int, ...]
+
+    def toarray(self) -> np.ndarray:
+        """
+        The dense local thickness field.
+        """
+        field = np.zeros(self.shape, dtype=self.values.dtype)
+        field.reshape(-1)[self.indices] = self.values
+        return field
+
+
+class CroppedThickness(NamedTuple):
+    """
+    A local thickness field stored as the bounding box of its nonzero voxels.
+
+    Attributes
+    ----------
+    array : np.ndarray
+        The local thickness in the bounding box.
+    offset : Tuple[int, ...]
+        The index of the first voxel of the bounding box in the field.
+    shape : Tuple[int, ...]
+        The shape of the field.
+    """
 
-@jit(nopython=True, fastmath=True, error_model="numpy")
+    array: np.ndarray
+    offset: Tuple[int, ...]
+    shape: Tuple[int, ...]
+
+    def toarray(self) -> np.ndarray:
+        """
+        The dense local thickness field.
+        """
+        field = np.zeros(self.shape, dtype=self.array.dtype)
+        field[tuple(slice(o, o + n) for o, n in zip(self.offset, self.array.shape))] = (
+            self.array
+        )
+        return field
+
+
+@jit(nopython=True, fastmath=True, error_model="numpy", cache=True)
 def compute_local_thickness_from_sorted_distances(
     local_thickness: np.ndarray,
     sorted_dists: np.ndarray,
@@ -90,25 +181,595 @@ def compute_local_thickness_from_sorted_distances(
     return local_thickness
 
 
+@jit(nopython=True, fastmath=True, error_model="numpy", cache=True)
+def _compute_sphere_stencil(
+    rd: float, voxel_width: np.ndarray, rd_extra: float
+) -> np.ndarray:
+    """
+    Compute the voxel offsets that lie within a sphere of radius `rd` using the same inclusion test as
+    `compute_local_thickness_from_sorted_distances`. The sphere is stored as runs along the last axis: each row is
+    `(di, dj, dk_extent)` and means that all offsets `(di, dj, dk)` with `|dk| <= dk_extent` are in the sphere. The
+    offsets cover a cube slightly larger than the cube scanned by the serial kernel, the kernels clip each run to
+    that cube so that the result is unchanged.
+
+    Parameters
+    ----------
+    rd : float
+        The sphere radius.
+    voxel_width : np.ndarray
+        A numpy array with shape (3,) that gives the width of voxels in each dimension.
+    rd_extra : float
+        An extra bit of distance added to `rd`, see `compute_local_thickness_from_sorted_distances`.
+
+    Returns
+    -------
+    np.ndarray
+        An int32 array with shape (N, 3) of runs.
+    """
+    rd_vox = rd / voxel_width
+    ni = int(np.ceil(rd_vox[0])) + 2
+    nj = int(np.ceil(rd_vox[1])) + 2
+    nk = int(np.ceil(rd_vox[2])) + 2
+    rows = np.empty(((2 * ni + 1) * (2 * nj + 1), 3), dtype=np.int32)
+    num_rows = 0
+    for oi in range(-ni, ni + 1):
+        for oj in range(-nj, nj + 1):
+            extent = -1
+            for ok in range(0, nk + 1):
+                if (
+                    (voxel_width[0] * oi) ** 2
+                    + (voxel_width[1] * oj) ** 2
+                    + (voxel_width[2] * ok) ** 2
+                ) < (rd + rd_extra) ** 2:
+                    extent = ok
+                else:
+                    break
+            if extent >= 0:
+                rows[num_rows, 0] = oi
+                rows[num_rows, 1] = oj
+                rows[num_rows, 2] = extent
+                num_rows += 1
+    return rows[:num_rows].copy()
+
+
+@lru_cache(maxsize=4096)
+def _sphere_stencil(
+    rd: float, voxel_width: Tuple[float, float, float], rd_extra: float
+) -> np.ndarray:
+    """
+    Cached wrapper around `_compute_sphere_stencil`, keyed by the radius, voxel width and `rd_extra`.
+    """
+    stencil = _compute_sphere_stencil(rd, np.array(voxel_width), rd_extra)
+    stencil.setflags(write=False)
+    return stencil
+
+
+def build_sphere_stencils(
+    sorted_dists: np.ndarray, voxel_width: np.ndarray, rd_extra: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Build the sphere stencils needed to fill the spheres of a sorted distance ridge.
+
+    Distance ridge values are distances between voxel centers (or half-voxel centers when oversampling), so they only
+    take a small number of distinct values. One stencil is computed per distinct value and shared by every ridge voxel
+    with that radius, and stencils are cached across calls.
+
+    Parameters
+    ----------
+    sorted_dists : np.ndarray
+        The distances of the sorted distance ridge.
+    voxel_width : np.ndarray
+        A numpy array with shape (3,) that gives the width of voxels in each dimension.
+    rd_extra : float
+        An extra bit of distance added to `rd`, see `compute_local_thickness_from_sorted_distances`.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        The stencil index of each ridge voxel, the offsets of each stencil in the concatenated stencil rows, and the
+        concatenated stencil rows.
+    """
+    radii, stencil_ids = np.unique(sorted_dists, return_inverse=True)
+    voxel_width = tuple(float(w) for w in voxel_width)
+    stencils = [
+        _sphere_stencil(float(rd), voxel_width, float(rd_extra)) for rd in radii
+    ]
+    stencil_ptr = np.zeros(len(stencils) + 1, dtype=np.int64)
+    stencil_ptr[1:] = np.cumsum([len(stencil) for stencil in stencils])
+    if len(stencils) > 0:
+        stencil_rows = np.concatenate(stencils)
+    else:
+        stencil_rows = np.zeros((0, 3), dtype=np.int32)
+    return stencil_ids.astype(np.int32), stencil_ptr, stencil_rows
+
+
+@jit(nopython=True, fastmath=True, error_model="numpy", cache=True, parallel=True)
+def compute_local_thickness_from_sorted_distances_parallel(
+    local_thickness: np.ndarray,
+    sorted_dists: np.ndarray,
+    sorted_dists_indices: np.ndarray,
+    voxel_width: np.ndarray,
+    stencil_ids: np.ndarray,
+    stencil_ptr: np.ndarray,
+    stencil_rows: np.ndarray,
+    origin: Optional[np.ndarray] = None,
+    tile_size: int = TILE_SIZE,
+) -> np.ndarray:
+    """
+    Multithreaded, stencil-based version of `compute_local_thickness_from_sorted_distances`.
+
+    Instead of testing every voxel in the bounding cube of each sphere, the voxels of the sphere are taken from a
+    precomputed stencil (see `build_sphere_stencils`) and filled as runs along the last axis.
+    The output volume is split into cubic tiles and every sphere is assigned to each tile that its bounding cube
+    overlaps. The tiles are then filled concurrently, each by a single thread, so no two threads ever write to the
+    same voxel. Within a tile the spheres are visited in the order they are given and a voxel only takes a new value
+    if it is larger than the one already there. With distances sorted in ascending order this max-reduction gives
+    exactly the same field as the serial overwrite, bit for bit, regardless of the number of threads.
+
+    Parameters
+    ----------
+    local_thickness : np.ndarray
+        A numpy array that is initialized as zeros.
+    sorted_dists : np.ndarray
+        A numpy array that is the sorted distance ridge of a mask, but the distances only.
+    sorted_dists_indices : np.ndarray
+        A numpy array that is the integer indices of the location of the distance, one row of i, j, k per distance.
+    voxel_width : np.ndarray
+        A numpy array with shape (3,) that gives the width of voxels in each dimension.
+    stencil_ids : np.ndarray
+        The stencil index of each distance, as returned by `build_sphere_stencils`.
+    stencil_ptr : np.ndarray
+        The offsets of each stencil in `stencil_rows`, as returned by `build_sphere_stencils`.
+    stencil_rows : np.ndarray
+        The concatenated stencil rows, as returned by `build_sphere_stencils`.
+    origin : Optional[np.ndarray]
+        If `local_thickness` is a block of a larger image, the index of its first voxel in that image. The indices in
+        `sorted_dists_indices` are then indices into the larger image, and the bounding cube of every sphere is
+        computed in the coordinates of the larger image so that the block gets exactly the values it would have in
+        the full field. Defaults to the origin.
+    tile_size : int
+        Edge length of the tiles, in voxels.
+    Returns
+    -------
+    np.ndarray
+        The local thickness field.
+    """
+    shape = local_thickness.shape
+    num_spheres = sorted_dists.shape[0]
+    num_tiles_i = (shape[0] + tile_size - 1) // tile_size
+    num_tiles_j = (shape[1] + tile_size - 1) // tile_size
+    num_tiles_k = (shape[2] + tile_size - 1) // tile_size
+    if origin is None:
+        oi, oj, ok = 0, 0, 0
+    else:
+        oi, oj, ok = origin[0], origin[1], origin[2]
+
+    # bounding cube of each sphere, computed exactly as in the serial kernel
+    # and then shifted into the coordinates of `local_thickness`
+    bounds = np.empty((num_spheres, 6), dtype=np.int64)
+    for n in prange(num_spheres):
+        rd = sorted_dists[n]
+        ri = sorted_dists_indices[n, 0]
+        rj = sorted_dists_indices[n, 1]
+        rk = sorted_dists_indices[n, 2]
+        rd_vox = rd / voxel_width
+        bounds[n, 0] = int(np.maximum(np.floor(ri - rd_vox[0]) - 1 - oi, 0))
+        bounds[n, 1] = int(np.minimum(np.ceil(ri + rd_vox[0]) + 2 - oi, shape[0]))
+        bounds[n, 2] = int(np.maximum(np.floor(rj - rd_vox[1]) - 1 - oj, 0))
+        bounds[n, 3] = int(np.minimum(np.ceil(rj + rd_vox[1]) + 2 - oj, shape[1]))
+        bounds[n, 4] = int(np.maximum(np.floor(rk - rd_vox[2]) - 1 - ok, 0))
+        bounds[n, 5] = int(np.minimum(np.ceil(rk + rd_vox[2]) + 2 - ok, shape[2]))
+
+    # count the spheres overlapping each tile in a first pass, then bucket the
+    # sphere indices per tile in a second pass, preserving the ascending
+    # distance order within each bucket
+    num_tiles = num_tiles_i * num_tiles_j * num_tiles_k
+    tile_ptr = np.zeros(num_tiles + 1, dtype=np.int64)
+    tile_fill = np.zeros(num_tiles, dtype=np.int64)
+    tile_spheres = np.empty(0, dtype=np.int64)
+    for bucket_pass in range(2):
+        for n in range(num_spheres):
+            if (
+                bounds[n, 0] >= bounds[n, 1]
+                or bounds[n, 2] >= bounds[n, 3]
+                or bounds[n, 4] >= bounds[n, 5]
+            ):
+                continue
+            for ti in range(
+                bounds[n, 0] // tile_size, (bounds[n, 1] - 1) // tile_size + 1
+            ):
+                for tj in range(
+                    bounds[n, 2] // tile_size, (bounds[n, 3] - 1) // tile_size + 1
+                ):
+                    for tk in range(
+                        bounds[n, 4] // tile_size, (bounds[n, 5] - 1) // tile_size + 1
+                    ):
+                        t = (ti * num_tiles_j + tj) * num_tiles_k + tk
+                        if bucket_pass == 0:
+                            tile_ptr[t + 1] += 1
+                        else:
+                            tile_spheres[tile_fill[t]] = n
+                            tile_fill[t] += 1
+        if bucket_pass == 0:
+            tile_ptr = np.cumsum(tile_ptr)
+            tile_fill[:] = tile_ptr[:-1]
+            tile_spheres = np.empty(tile_ptr[-1], dtype=np.int64)
+
+    # fill the tiles concurrently, each tile is owned by exactly one thread
+    for t in prange(num_tiles):
+        ti = t // (num_tiles_j * num_tiles_k)
+        tj = (t // num_tiles_k) % num_tiles_j
+        tk = t % num_tiles_k
+        for p in range(tile_ptr[t], tile_ptr[t + 1]):
+            n = tile_spheres[p]
+            value = 2 * sorted_dists[n]
+            ri = sorted_dists_indices[n, 0] - oi
+            rj = sorted_dists_indices[n, 1] - oj
+            rk = sorted_dists_indices[n, 2] - ok
+            di_min = max(bounds[n, 0], ti * tile_size)
+            di_max = min(bounds[n, 1], (ti + 1) * tile_size)
+            dj_min = max(bounds[n, 2], tj * tile_size)
+            dj_max = min(bounds[n, 3], (tj + 1) * tile_size)
+            dk_min = max(bounds[n, 4], tk * tile_size)
+            dk_max = min(bounds[n, 5], (tk + 1) * tile_size)
+            s = stencil_ids[n]
+            for r in range(stencil_ptr[s], stencil_ptr[s + 1]):
+                di = ri + stencil_rows[r, 0]
+                dj = rj + stencil_rows[r, 1]
+                if di < di_min or di >= di_max or dj < dj_min or dj >= dj_max:
+                    continue
+                dk_start = max(rk - stencil_rows[r, 2], dk_min)
+                dk_stop = min(rk + stencil_rows[r, 2] + 1, dk_max)
+                for dk in range(dk_start, dk_stop):
+                    if value > local_thickness[di, dj, dk]:
+                        local_thickness[di, dj, dk] = value
+    return local_thickness
+
+
+@jit(nopython=True, fastmath=True, error_model="numpy", cache=True)
+def _oversampled_plane(mask: np.ndarray, u0: int, plane: np.ndarray) -> np.ndarray:
+    """
+    Compute one plane, at index `u0` along the first axis, of the oversampled mask used by
+    `oversampling_distance_transform`: the mask upsampled onto the grid with twice the resolution (native voxels at
+    the even indices), dilated and then eroded with a 3x3x3 box, with edge padding for the erosion. Both box
+    operations are separable, so the plane only needs the (at most four) native planes around it.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        The binary mask.
+    u0 : int
+        The index of the plane on the oversampled grid.
+    plane : np.ndarray
+        A boolean array with shape (2 * n1 - 1, 2 * n2 - 1) to write the plane into.
+
+    Returns
+    -------
+    np.ndarray
+        The oversampled plane.
+    """
+    n0, n1, n2 = mask.shape
+    m1, m2 = plane.shape
+
+    # dilation: an oversampled voxel is set if any native voxel within one
+    # oversampled voxel of it is set. the erosion along the first axis is
+    # then the AND of the dilated planes u0 - 1, u0 and u0 + 1 (edge padded)
+    dilated = np.ones((m1, m2), dtype=np.bool_)
+    for w in range(max(u0 - 1, 0), min(u0 + 1, 2 * n0 - 2) + 1):
+        for u1 in range(m1):
+            for u2 in range(m2):
+                value = False
+                for v0 in range(w // 2, (w + 1) // 2 + 1):
+                    for v1 in range(u1 // 2, (u1 + 1) // 2 + 1):
+                        for v2 in range(u2 // 2, (u2 + 1) // 2 + 1):
+                            value |= mask[v0, v1, v2]
+                dilated[u1, u2] &= value
+
+    # erosion within the plane, along the last axis then the middle axis
+    rows = np.empty((m1, m2), dtype=np.bool_)
+    for u1 in range(m1):
+        for u2 in range(m2):
+            rows[u1, u2] = (
+                dilated[u1, max(u2 - 1, 0)]
+                and dilated[u1, u2]
+                and dilated[u1, min(u2 + 1, m2 - 1)]
+            )
+    for u1 in range(m1):
+        for u2 in range(m2):
+            plane[u1, u2] = (
+                rows[max(u1 - 1, 0), u2]
+                and rows[u1, u2]
+                and rows[min(u1 + 1, m1 - 1), u2]
+            )
+    return plane
+
+
+@jit(nopython=True, parallel=True, error_model="numpy", cache=True)
+def _oversampled_plane_features(
+    mask: np.ndarray,
+    spacing_sq: np.ndarray,
+    groups: np.ndarray,
+    offsets: np.ndarray,
+    missing: int,
+) -> np.ndarray:
+    """
+    For every plane of the oversampled mask along the first axis and every native voxel position (even indices) in
+    that plane, find the offset to the nearest background voxel of the plane with two passes of
+    `lower_envelope`. `offsets` has shape (2 * n0 - 1, n1, n2, 2) and is set to `missing` where a plane has no
+    background.
+    """
+    n0, n1, n2 = mask.shape
+    m1, m2 = 2 * n1 - 1, 2 * n2 - 1
+    for u0 in prange(2 * n0 - 1):
+        plane = _oversampled_plane(mask, u0, np.empty((m1, m2), dtype=np.bool_))
+
+        # along the last axis
+        f = np.empty(m2)
+        arg = np.empty(n2, dtype=np.int64)
+        v = np.empty(max(m1, m2), dtype=np.int64)
+        z = np.empty(max(m1, m2) + 1)
+        row_offsets = np.empty((m1, n2), dtype=np.int64)
+        row_dists = np.empty((m1, n2))
+        for u1 in range(m1):
+            for u2 in range(m2):
+                f[u2] = np.inf if plane[u1, u2] else 0.0
+            lower_envelope(f, spacing_sq[2], 2, arg, v, z)
+            for x2 in range(n2):
+                if arg[x2] < 0:
+                    row_dists[u1, x2] = np.inf
+                else:
+                    row_offsets[u1, x2] = 2 * x2 - arg[x2]
+                    row_dists[u1, x2] = squared_distance(
+                        0, 0, row_offsets[u1, x2], spacing_sq, groups
+                    )
+
+        # along the middle axis
+        arg = np.empty(n1, dtype=np.int64)
+        for x2 in range(n2):
+            lower_envelope(row_dists[:, x2], spacing_sq[1], 2, arg, v, z)
+            for x1 in range(n1):
+                if arg[x1] < 0:
+                    offsets[u0, x1, x2, 0] = missing
+                    offsets[u0, x1, x2, 1] = missing
+                else:
+                    offsets[u0, x1, x2, 0] = 2 * x1 - arg[x1]
+                    offsets[u0, x1, x2, 1] = row_offsets[arg[x1], x2]
+    return offsets
+
+
+@jit(nopython=True, parallel=True, error_model="numpy", cache=True)
+def _oversampled_distances(
+    mask: np.ndarray,
+    spacing_sq: np.ndarray,
+    groups: np.ndarray,
+    offsets: np.ndarray,
+    missing: int,
+    dist: np.ndarray,
+) -> np.ndarray:
+    """
+    Finish the oversampled distance transform along the first axis, given the in-plane offsets from
+    `_oversampled_plane_features`.
+    """
+    n0, n1, n2 = mask.shape
+    m0 = 2 * n0 - 1
+    for x1 in prange(n1):
+        f = np.empty(m0)
+        arg = np.empty(n0, dtype=np.int64)
+        v = np.empty(m0, dtype=np.int64)
+        z = np.empty(m0 + 1)
+        for x2 in range(n2):
+            for u0 in range(m0):
+                if offsets[u0, x1, x2, 0] == missing:
+                    f[u0] = np.inf
+                else:
+                    f[u0] = squared_distance(
+                        0,
+                        offsets[u0, x1, x2, 0],
+                        offsets[u0, x1, x2, 1],
+                        spacing_sq,
+                        groups,
+                    )
+            lower_envelope(f, spacing_sq[0], 2, arg, v, z)
+            for x0 in range(n0):
+                if not mask[x0, x1, x2] or arg[x0] < 0:
+                    dist[x0, x1, x2] = 0
+                    continue
+                dist[x0, x1, x2] = np.sqrt(
+                    squared_distance(
+                        2 * x0 - arg[x0],
+                        offsets[arg[x0], x1, x2, 0],
+                        offsets[arg[x0], x1, x2, 1],
+                        spacing_sq,
+                        groups,
+                    )
+                )
+    return dist
+
+
 def oversampling_distance_transform(
     mask: np.ndarray, voxel_width: np.ndarray
 ) -> np.ndarray:
-    # oversample the image
-    shape = [2 * s - 1 for s in mask.shape]
-    upsampled_mask = np.zeros(shape, dtype=mask.dtype)
-    upsampled_mask[tuple([slice(None, None, 2)] * len(mask.shape))] = mask
-    upsampled_mask = binary_dilation(
-        upsampled_mask, structure=np.ones(tuple([3] * len(mask.shape)))
-    ).astype(int)
-    upsampled_mask = binary_erosion(
-        np.pad(upsampled_mask, 1, mode="edge"),
-        structure=np.ones(tuple([3] * len(mask.shape))),
-    ).astype(int)[tuple([slice(1, -1)] * len(mask.shape))]
+    """
+    Distance transform of a mask on a grid with twice the resolution, sampled back at the voxel centers.
+
+    The mask is upsampled onto a grid with `2 * n - 1` voxels along each axis (the native voxels at the even
+    indices), dilated and eroded with a 3x3x3 box, and the Euclidean distance transform of the result is sampled at
+    the native voxels. This measures the distance from each voxel center to the boundary of the shape rather than
+    to the nearest background voxel center.
+
+    The oversampled grid is never stored: its planes are built one at a time from the native planes around them,
+    and the exact separable distance transform of Felzenszwalb and Huttenlocher is only evaluated at the native
+    voxels. Apart from the output, this needs 4 or 8 bytes per voxel of scratch memory (the in-plane offsets to the
+    nearest background voxel for every oversampled plane), instead of several arrays 8 times the size of the mask.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        The binary mask.
+
+    voxel_width : np.ndarray
+        A numpy array with shape (3,) that gives the width of voxels in each dimension.
+
+    Returns
+    -------
+    np.ndarray
+        The distance map, zero outside the mask.
+    """
+    mask = np.ascontiguousarray(mask > 0)
+    if mask.all():
+        # the oversampled mask has no background either, keep the distances
+        # that scipy gives it
+        return no_background_distances(
+            mask.shape, np.asarray(voxel_width, dtype=float) / 2, step=2
+        )
+
+    # the offsets are bounded by the size of the oversampled grid, so small
+    # integers do for all but very large images
+    dtype = np.int16 if 2 * max(mask.shape) - 1 < 2**15 else np.int32
+    missing = np.iinfo(dtype).min
+    spacing = np.asarray(voxel_width, dtype=float) / 2
+    spacing_sq = spacing**2
+    groups = spacing_groups(spacing)
+
+    offsets = np.empty((2 * mask.shape[0] - 1,) + mask.shape[1:] + (2,), dtype=dtype)
+    _oversampled_plane_features(mask, spacing_sq, groups, offsets, missing)
+    return _oversampled_distances(
+        mask, spacing_sq, groups, offsets, missing, np.empty(mask.shape, dtype=float)
+    )
+
+
+def hildebrand_distance_ridge(
+    mask_dist: np.ndarray, voxel_width: np.ndarray
+) -> np.ndarray:
+    """
+    Find Hildebrand's distance ridge of a distance map: the voxels whose sphere is not completely contained in the
+    sphere of one of their 26 neighbours.
+
+    The sphere centered at voxel `p` with radius `dist[p]` lies inside the sphere centered at a neighbour `q` with
+    radius `dist[q]` if `dist[q] >= dist[p] + |p - q|`. Filling a contained sphere never changes the local thickness
+    field, since every voxel it covers is also covered by the larger sphere, so these voxels can be dropped before
+    sphere filling without changing the result. This is done with one vectorized comparison per neighbour offset.
+
+    Parameters
+    ----------
+    mask_dist : np.ndarray
+        The distance map of the mask, zero outside the mask.
+
+    voxel_width : np.ndarray
+        A numpy array with shape (3,) that gives the width of voxels in each dimension.
+
+    Returns
+    -------
+    np.ndarray
+        A boolean array that is `True` on the distance ridge.
+    """
+    ridge = mask_dist > 0
+    for offset in np.ndindex(3, 3, 3):
+        offset = np.array(offset) - 1
+        if not offset.any():
+            continue
+        step = np.sqrt(((voxel_width * offset) ** 2).sum())
+
+        # slices selecting the voxels p and their neighbours q = p + offset
+        p = tuple(slice(max(-o, 0), s - max(o, 0)) for o, s in zip(offset, ridge.shape))
+        q = tuple(slice(max(o, 0), s - max(-o, 0)) for o, s in zip(offset, ridge.shape))
+
+        ridge[p] &= mask_dist[q] < mask_dist[p] + step
+
+    return ridge
+
+
+@jit(nopython=True, parallel=True, error_model="numpy", cache=True)
+def local_maximum_ridge(mask_dist: np.ndarray) -> np.ndarray:
+    """
+    Find the local maximum ridge of a distance map: the voxels whose distance is at least as large as the distances
+    of both of their neighbours, and larger than one of them, along one of the 13 lines through the voxel and its 26
+    neighbours. The distance map is edge padded for the neighbours outside of the image, since it does not count them
+    as background either.
+
+    This is a cheap, parallel replacement for skeletonization: the ridge runs along the middle of every structure
+    (the distance map has a crest there along the direction across the structure), it is computed directly from the
+    distance map, and since the largest distance of a structure is always on it, it is never empty.
+
+    Parameters
+    ----------
+    mask_dist : np.ndarray
+        The distance map of the mask, zero outside the mask.
+
+    Returns
+    -------
+    np.ndarray
+        A boolean array that is `True` on the ridge.
+    """
+    n0, n1, n2 = mask_dist.shape
+    ridge = np.zeros(mask_dist.shape, dtype=np.bool_)
+    for i in prange(n0):
+        for j in range(n1):
+            for k in range(n2):
+                d = mask_dist[i, j, k]
+                if d <= 0:
+                    continue
+                # one offset from each antipodal pair of neighbours
+                for oi in range(0, 2):
+                    for oj in range(-1, 2):
+                        for ok in range(-1, 2):
+                            if oi == 0 and (oj < 0 or (oj == 0 and ok <= 0)):
+                                continue
+                            before = mask_dist[
+                                min(max(i - oi, 0), n0 - 1),
+                                min(max(j - oj, 0), n1 - 1),
+                                min(max(k - ok, 0), n2 - 1),
+                            ]
+                            after = mask_dist[
+                                min(i + oi, n0 - 1),
+                                min(max(j + oj, 0), n1 - 1),
+                                min(max(k + ok, 0), n2 - 1),
+                            ]
+                            if d >= before and d >= after and d > min(before, after):
+                                ridge[i, j, k] = True
+                                break
+                        if ridge[i, j, k]:
+                            break
+                    if ridge[i, j, k]:
+                        break
+    return ridge
+
 
-    # do distance transform on oversampled mask
-    dt = upsampled_mask * distance_transform_edt(upsampled_mask, voxel_width / 2)
+def sorted_distance_ridge(ridge_dist: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Build the sorted distance ridge from a distance map that is zero outside of the ridge.
+
+    This is done with array operations only: the flat indices of the nonzero voxels are found with `np.flatnonzero`,
+    sorted by distance with a stable `argsort`, and converted to compact int32 (i, j, k) indices. Ties are kept in
+    C order, which is the same order a sort of `(dist, i, j, k)` tuples gives. The distances keep the dtype of the
+    distance map, so the arrays can be passed to the sphere-filling kernels without any copies.
+
+    Parameters
+    ----------
+    ridge_dist : np.ndarray
+        The distance map restricted to the ridge voxels, zero everywhere else.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The ridge distances in ascending order, and an int32 array with shape (N, 3) with the indices of the ridge
+        voxel for each distance.
+    """
+    flat_indices = np.flatnonzero(ridge_dist)
+    dists = ridge_dist.ravel()[flat_indices]
+    order = np.argsort(dists, kind="stable")
+    dists = dists[order]
+    flat_indices = flat_indices[order]
+    del order
 
-    return dt[tuple([slice(None, None, 2)] * len(mask.shape))]
+    # unravel the flat indices one axis at a time, in place, so that only one
+    # temporary the size of the ridge exists at a time
+    indices = np.empty((len(flat_indices), ridge_dist.ndim), dtype=np.int32)
+    for axis in range(ridge_dist.ndim - 1, 0, -1):
+        indices[:, axis] = flat_indices % ridge_dist.shape[axis]
+        flat_indices //= ridge_dist.shape[axis]
+    indices[:, 0] = flat_indices
+    return dists, indices
 
 
 def compute_local_thickness_from_mask(
@@ -116,7 +777,11 @@ def compute_local_thickness_from_mask(
     voxel_width: Union[Iterable[float], float],
     oversample: bool = True,
     skeletonize: bool = True,
-) -> np.ndarray:
+    n_threads: Optional[int] = None,
+    ridge: Optional[str] = None,
+    output_dtype: Union[type, np.dtype] = np.float64,
+    output_format: str = "dense",
+) -> Union[np.ndarray, SparseThickness, CroppedThickness]:
     """
     Compute the local thickness field for a binary mask.
 
@@ -143,38 +808,213 @@ def compute_local_thickness_from_mask(
         Set this to `True` to skeletonize and use only voxels on the skeleton for thickness calculation. For
         better consistency with IPL, set this to `True`
 
+    n_threads : Optional[int]
+        Number of threads used to fill the spheres. If `None`, all threads available to numba are used. The result
+        does not depend on this setting.
+
+    ridge : Optional[str]
+        Which voxels to center spheres on. `"skeleton"` uses the voxels of the skeleton, `"mask"` uses every voxel
+        of the mask and `"hildebrand"` uses Hildebrand's distance ridge (see `hildebrand_distance_ridge`), which gives
+        the same result as `"mask"` with far fewer spheres. `"local_max"` uses the local maxima of the distance map
+        (see `local_maximum_ridge`), a fast parallel alternative to the skeleton. If `None`, `"skeleton"` is used if
+        `skeletonize` is `True` and `"mask"` otherwise.
+
+    output_dtype : Union[type, np.dtype]
+        The floating point type of the returned field, `np.float64`, `np.float32` or `np.float16`. The field is
+        always computed in double precision.
+
+    output_format : str
+        How to return the field. `"dense"` returns an array with the shape of the mask. Since the field is zero
+        outside the mask, it can be returned more compactly: `"indices"` returns a `SparseThickness` with the flat
+        indices and values of the nonzero voxels, and `"bbox"` returns a `CroppedThickness` with the bounding box of
+        the nonzero voxels and its offset. Both have a `toarray` method that returns the dense field.
+
     Returns
     -------
-    np.ndarray
+    Union[np.ndarray, SparseThickness, CroppedThickness]
+        The local thickness field.
+    """
+    ridge = _parse_ridge(ridge, skeletonize)
+    check_n_threads(n_threads)
+    _check_output_options(output_dtype, output_format)
+
+    voxel_width = _parse_voxel_width(voxel_width)
+
+    # binarize the mask if it wasn't already done
+    mask = mask > 0
+    if mask.sum() == 0:
+        warnings.warn("given an empty mask, cannot proceed, returning zeros array")
+        return format_local_thickness(
+            np.zeros(mask.shape, dtype=float), output_dtype, output_format
+        )
+
+    mask_dist = _distance_map(mask, voxel_width, oversample)
+    ridge_dist = _ridge_distances(mask, mask_dist, voxel_width, ridge)
+    local_thickness = _fill_spheres(
+        ridge_dist, voxel_width, oversample, n_threads, mask_dist.shape
+    )
+    local_thickness *= mask
+
+    return format_local_thickness(local_thickness, output_dtype, output_format)
+
+
+def _check_output_options(output_dtype: Union[type, np.dtype], output_format: str):
+    """
+    Validate the output type and format of a local thickness field.
+    """
+    if np.dtype(output_dtype) not in (np.float16, np.float32, np.float64):
+        raise ValueError(
+            "`output_dtype` must be `np.float64`, `np.float32` or `np.float16`"
+        )
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"`output_format` must be one of {OUTPUT_FORMATS}; got {output_format}"
+        )
+
+
+def format_local_thickness(
+    local_thickness: np.ndarray,
+    output_dtype: Union[type, np.dtype] = np.float64,
+    output_format: str = "dense",
+) -> Union[np.ndarray, SparseThickness, CroppedThickness]:
+    """
+    Convert a dense local thickness field to the given type and format, see `compute_local_thickness_from_mask`.
+    A dense field that already has the right type is returned as is.
+
+    Parameters
+    ----------
+    local_thickness : np.ndarray
+        The dense local thickness field.
+
+    output_dtype : Union[type, np.dtype]
+        `np.float64`, `np.float32` or `np.float16`.
+
+    output_format : str
+        `"dense"`, `"indices"` or `"bbox"`.
+
+    Returns
+    -------
+    Union[np.ndarray, SparseThickness, CroppedThickness]
         The local thickness field.
     """
+    _check_output_options(output_dtype, output_format)
+    shape = tuple(local_thickness.shape)
+
+    if output_format == "dense":
+        return local_thickness.astype(output_dtype, copy=False)
+
+    if output_format == "indices":
+        indices = np.flatnonzero(local_thickness)
+        values = local_thickness.reshape(-1)[indices].astype(output_dtype, copy=False)
+        return SparseThickness(indices, values, shape)
+
+    box = _bounding_box(local_thickness)
+    array = np.array(local_thickness[box], dtype=output_dtype)
+    return CroppedThickness(array, tuple(b.start for b in box), shape)
+
+
+def _bounding_box(array: np.ndarray) -> Tuple[slice, ...]:
+    """
+    The bounding box of the nonzero voxels of an array, one slice per axis, found from the projections of the array
+    on each axis. The slices are empty if the array is zero everywhere.
+    """
+    box = []
+    for axis in range(array.ndim):
+        other_axes = tuple(a for a in range(array.ndim) if a != axis)
+        nonzero = np.flatnonzero(np.any(array, axis=other_axes))
+        box.append(
+            slice(int(nonzero[0]), int(nonzero[-1]) + 1)
+            if nonzero.size
+            else slice(0, 0)
+        )
+    return tuple(box)
+
+
+def _uncrop_local_thickness(
+    local_thickness: np.ndarray,
+    box: Tuple[slice, ...],
+    shape: Tuple[int, ...],
+    output_dtype: Union[type, np.dtype],
+    output_format: str,
+) -> Union[np.ndarray, SparseThickness, CroppedThickness]:
+    """
+    Convert a local thickness field computed on the crop `box` of an image with the given `shape` to the given
+    type and format (see `format_local_thickness`) for the whole image. Only the dense format needs an array with
+    the shape of the image.
+    """
+    if tuple(b.stop - b.start for b in box) == tuple(shape):
+        return format_local_thickness(local_thickness, output_dtype, output_format)
+
+    if output_format == "dense":
+        field = np.zeros(shape, dtype=output_dtype)
+        field[box] = local_thickness
+        return field
+
+    offset = np.array([b.start for b in box])
+    formatted = format_local_thickness(local_thickness, output_dtype, output_format)
+    if output_format == "indices":
+        indices = np.unravel_index(formatted.indices, local_thickness.shape)
+        indices = np.ravel_multi_index(
+            tuple(i + o for i, o in zip(indices, offset)), shape
+        )
+        return SparseThickness(indices, formatted.values, tuple(shape))
+    return CroppedThickness(
+        formatted.array,
+        tuple(int(o) for o in offset + formatted.offset),
+        tuple(shape),
+    )
+
+
+def _parse_voxel_width(voxel_width: Union[Iterable[float], float]) -> np.ndarray:
+    """
+    Convert a voxel width given as a float, int or length-3 iterable to a float array with shape (3,).
+    """
     if isinstance(voxel_width, float) or isinstance(voxel_width, int):
-        voxel_width = np.array([float(voxel_width)] * 3)
+        return np.array([float(voxel_width)] * 3)
     elif isinstance(voxel_width, Iterable):
         if len(voxel_width) != 3:
             raise ValueError(
                 "`voxel_width must be a float, int, or iterable of length 3`"
             )
         else:
-            voxel_width = np.array(voxel_width).astype(float)
+            return np.array(voxel_width).astype(float)
     else:
         raise ValueError("`voxel_width must be a float, int, or iterable of length 3`")
 
-    # binarize the mask if it wasn't already done
-    mask = mask > 0
-    if mask.sum() == 0:
-        warnings.warn("given an empty mask, cannot proceed, returning zeros array")
-        return np.zeros(mask.shape, dtype=float)
 
+def _parse_ridge(ridge: Optional[str], skeletonize: bool) -> str:
+    """
+    Resolve the ridge mode, falling back on `skeletonize` if `ridge` is not given.
+    """
+    if ridge is None:
+        ridge = "skeleton" if skeletonize else "mask"
+    if ridge not in RIDGE_MODES:
+        raise ValueError(f"`ridge` must be one of {RIDGE_MODES}; got {ridge}")
+    return ridge
+
+
+def _distance_map(
+    mask: np.ndarray, voxel_width: np.ndarray, oversample: bool
+) -> np.ndarray:
+    """
+    Distance map of a binary mask, zero outside of the mask.
+    """
     if oversample:
-        mask_dist = oversampling_distance_transform(mask, voxel_width)
+        return oversampling_distance_transform(mask, voxel_width)
     else:
-        mask_dist = mask * distance_transform_edt(mask, voxel_width)
+        return euclidean_distance_transform(mask, voxel_width)
+
 
-    if skeletonize:
+def _ridge_distances(
+    mask: np.ndarray, mask_dist: np.ndarray, voxel_width: np.ndarray, ridge: str
+) -> np.ndarray:
+    """
+    The distance map restricted to the voxels that spheres are centered on, zero everywhere else.
+    """
+    if ridge == "skeleton":
         skeleton = np.asarray(
             sitk.GetArrayFromImage(
-                sitk.BinaryThinning(sitk.GetImageFromArray(mask.astype(int)))
+                sitk.BinaryThinning(sitk.GetImageFromArray(mask.astype(np.uint8)))
             ),
             dtype=bool,
         )
@@ -183,30 +1023,536 @@ def compute_local_thickness_from_mask(
             warnings.warn(
                 "shape too thin, no skeletonization is found, skipping skeletonization step"
             )
-            skeleton_dist = mask_dist
+            return mask_dist
         else:
-            skeleton_dist = (skeleton > 0) * mask_dist
-
-        sorted_dists = [
-            (skeleton_dist[i, j, k], i, j, k)
-            for (i, j, k) in zip(*skeleton_dist.nonzero())
-        ]
+            return (skeleton > 0) * mask_dist
+    elif ridge == "hildebrand":
+        return hildebrand_distance_ridge(mask_dist, voxel_width) * mask_dist
+    elif ridge == "local_max":
+        return local_maximum_ridge(mask_dist) * mask_dist
     else:
-        sorted_dists = [
-            (mask_dist[i, j, k], i, j, k) for (i, j, k) in zip(*mask_dist.nonzero())
-        ]
+        return mask_dist
+
+
+def _fill_spheres(
+    ridge_dist: np.ndarray,
+    voxel_width: np.ndarray,
+    oversample: bool,
+    n_threads: Optional[int],
+    shape: Tuple[int, int, int],
+    origin: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Fill the spheres of a distance ridge into a new array of the given shape. If given, `origin` is added to the
+    ridge indices and passed on to the kernel, see `compute_local_thickness_from_sorted_distances_parallel`.
+    """
+    sorted_dists, sorted_dists_indices = sorted_distance_ridge(ridge_dist)
+    return _fill_sorted_spheres(
+        sorted_dists,
+        sorted_dists_indices,
+        voxel_width,
+        oversample,
+        n_threads,
+        np.zeros(shape, dtype=float),
+        origin,
+    )
+
+
+def _fill_sorted_spheres(
+    sorted_dists: np.ndarray,
+    sorted_dists_indices: np.ndarray,
+    voxel_width: np.ndarray,
+    oversample: bool,
+    n_threads: Optional[int],
+    out: np.ndarray,
+    origin: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Like `_fill_spheres`, for the ridge as returned by `sorted_distance_ridge`, into `out`, a float array of zeros.
+    """
+    if origin is not None:
+        sorted_dists_indices += origin.astype(np.int32)
+
+    rd_extra = 0.5 if oversample else 0
+    stencil_ids, stencil_ptr, stencil_rows = build_sphere_stencils(
+        sorted_dists, voxel_width, rd_extra
+    )
+    with numba_threads(n_threads):
+        return compute_local_thickness_from_sorted_distances_parallel(
+            out,
+            sorted_dists,
+            sorted_dists_indices,
+            voxel_width,
+            stencil_ids,
+            stencil_ptr,
+            stencil_rows,
+            origin,
+        )
+
+
+def _create_memmap(
+    path: Optional[str],
+    scratch_dir: Optional[str],
+    shape: Tuple[int, ...],
+    dtype: Union[type, np.dtype] = np.float64,
+) -> np.memmap:
+    """
+    Create a memory-mapped array. If `path` is given it is written as a `.npy` file that can be opened with
+    `np.load(path, mmap_mode="r")`, otherwise an anonymous temporary file in `scratch_dir` is used, which is removed
+    as soon as the array is no longer referenced.
+    """
+    if path is not None:
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    return np.memmap(
+        tempfile.TemporaryFile(dir=scratch_dir), dtype=dtype, mode="w+", shape=shape
+    )
+
+
+def _slab_depth(memory_budget: int, slice_voxels: int, bytes_per_voxel: int) -> int:
+    """
+    The number of slices along the first axis that fit in the memory budget.
+    """
+    return int(memory_budget // (bytes_per_voxel * slice_voxels))
+
+
+def _chunked_distance_map(
+    mask: np.ndarray,
+    voxel_width: np.ndarray,
+    oversample: bool,
+    depth: int,
+    dist: np.memmap,
+) -> float:
+    """
+    Write the distance map of `mask` into `dist` slab by slab and return the largest distance.
+
+    Each slab is extended by a halo of slices on both sides. A distance computed in the slab is exact if it is
+    shorter than the distance to the first slice of the slab at an internal cut, since no background voxel the slab
+    is missing (nor any spurious background the oversampling erosion creates at the cut) can be closer. If that
+    does not hold for every voxel of the slab core, the halo is grown and the slab is done again.
+    """
+    n = mask.shape[0]
+    halo = max(depth // 4, 1)
+    max_dist = 0.0
+    z0 = 0
+    while z0 < n:
+        if 2 * halo + 1 > depth:
+            raise MemoryError(
+                "`memory_budget` is too small for the distance transform of this mask"
+            )
+        z1 = min(z0 + depth - 2 * halo, n)
+        lo, hi = max(z0 - halo, 0), min(z1 + halo, n)
+
+        slab_dist = _distance_map(np.asarray(mask[lo:hi]) > 0, voxel_width, oversample)
+        core_dist = slab_dist[z0 - lo : z1 - lo]
+        del slab_dist
+
+        # distance (in slices) from each core slice to the nearest internal cut
+        gap = np.full(z1 - z0, np.inf)
+        if lo > 0:
+            gap = np.minimum(gap, np.arange(z0, z1) - lo)
+        if hi < n:
+            gap = np.minimum(gap, hi - 1 - np.arange(z0, z1))
+        exact = core_dist < gap[:, None, None] * voxel_width[0]
+        if not exact.all():
+            # grow the halo past the largest distance that could not be trusted
+            halo = max(halo + 1, int(core_dist[~exact].max() // voxel_width[0]) + 1)
+            continue
+
+        dist[z0:z1] = core_dist
+        max_dist = max(max_dist, float(core_dist.max()))
+        z0 = z1
+
+    dist.flush()
+    return max_dist
+
+
+def compute_local_thickness_chunked(
+    mask: np.ndarray,
+    voxel_width: Union[Iterable[float], float],
+    memory_budget: int,
+    oversample: bool = True,
+    ridge: str = "hildebrand",
+    n_threads: Optional[int] = None,
+    output_path: Optional[str] = None,
+    scratch_dir: Optional[str] = None,
+    output_dtype: Union[type, np.dtype] = np.float64,
+) -> np.memmap:
+    """
+    Compute the local thickness field for a binary mask that does not fit in memory, working on slabs along the
+    first axis so that the working memory stays within `memory_budget`.
+
+    The computation is done in two passes. First, the distance map is computed slab by slab, with a halo of slices
+    around each slab that is grown until the distances in the slab are exact, and written to a memory-mapped
+    scratch file. Then, the spheres are filled slab by slab, with a halo as thick as the largest sphere so that
+    every sphere reaching into a slab is filled into it. Both passes give exactly the same values as the in-memory
+    computation, so the result is identical to `compute_local_thickness_from_mask` with the same settings.
+
+    `mask` only has to support slicing along the first axis, so it can itself be a memory-mapped array. Since
+    skeletonization is a global operation that cannot be split into slabs, only the `"mask"`, `"hildebrand"` and
+    `"local_max"` ridges are supported.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        The mask for which to calculate the local thickness field.
+
+    voxel_width : Union[Iterable[float], float]
+        If an iterable of length 3, the voxel widths in each dimension. If a float, the isotropic voxel width.
+
+    memory_budget : int
+        Approximate limit, in bytes, on the working memory used for the computation. The memory-mapped output and
+        scratch arrays are not counted.
+
+    oversample : bool
+        Set this to `True` to use the (more accurate but slower) oversampling distance transform method. For
+        consistency with IPL, set this to `False`
+
+    ridge : str
+        Which voxels to center spheres on, one of `"hildebrand"`, `"mask"` or `"local_max"`. See
+        `compute_local_thickness_from_mask`.
+
+    n_threads : Optional[int]
+        Number of threads used to fill the spheres. If `None`, all threads available to numba are used.
+
+    output_path : Optional[str]
+        If given, the local thickness field is written to this `.npy` file. Otherwise, it is kept in an anonymous
+        temporary file.
+
+    scratch_dir : Optional[str]
+        Directory for the temporary files. If `None`, the default temporary directory is used.
+
+    output_dtype : Union[type, np.dtype]
+        The floating point type of the output file, `np.float64`, `np.float32` or `np.float16`.
+
+    Returns
+    -------
+    np.memmap
+        The local thickness field.
+    """
+    if ridge not in ("mask", "hildebrand", "local_max"):
+        raise ValueError(
+            f'`ridge` must be "mask", "hildebrand" or "local_max" for the chunked computation; got {ridge}'
+        )
+    check_n_threads(n_threads)
+    _check_output_options(output_dtype, "dense")
+    voxel_width = _parse_voxel_width(voxel_width)
 
-    sorted_dists.sort()
-    sorted_dists = np.asarray(sorted_dists, dtype=float)
+    shape = tuple(mask.shape)
+    slice_voxels = shape[1] * shape[2]
 
-    return mask * compute_local_thickness_from_sorted_distances(
-        np.zeros(mask_dist.shape, dtype=float),
-        sorted_dists[:, 0].astype(float),
-        sorted_dists[:, 1:].astype(int),
+    # pass 1: distance map
+    dist = _create_memmap(None, scratch_dir, shape)
+    max_dist = _chunked_distance_map(
+        mask,
         voxel_width,
-        0.5 if oversample else 0,
+        oversample,
+        _slab_depth(memory_budget, slice_voxels, DISTANCE_BYTES_PER_VOXEL),
+        dist,
     )
 
+    # pass 2: sphere filling, with a halo covering the largest sphere
+    local_thickness = _create_memmap(output_path, scratch_dir, shape, output_dtype)
+    if max_dist == 0:
+        warnings.warn("given an empty mask, cannot proceed, returning zeros array")
+        return local_thickness
+
+    depth = _slab_depth(memory_budget, slice_voxels, FILL_BYTES_PER_VOXEL)
+    halo = int(np.ceil(max_dist / voxel_width[0])) + 2
+    if 2 * halo + 1 > depth:
+        raise MemoryError(
+            "`memory_budget` is too small to fill the largest sphere of this mask"
+        )
+    for z0 in range(0, shape[0], depth - 2 * halo):
+        z1 = min(z0 + depth - 2 * halo, shape[0])
+        lo, hi = max(z0 - halo, 0), min(z1 + halo, shape[0])
+
+        slab_mask = np.asarray(mask[lo:hi]) > 0
+        slab_dist = np.asarray(dist[lo:hi])
+        ridge_dist = _ridge_distances(slab_mask, slab_dist, voxel_width, ridge)
+        del slab_dist
+        slab_thickness = _fill_spheres(
+            ridge_dist,
+            voxel_width,
+            oversample,
+            n_threads,
+            ridge_dist.shape,
+            np.array([lo, 0, 0]),
+        )
+        del ridge_dist
+
+        local_thickness[z0:z1] = (slab_mask * slab_thickness)[z0 - lo : z1 - lo]
+
+    local_thickness.flush()
+    return local_thickness
+
+
+class _ThicknessFields(NamedTuple):
+    """
+    The fields of `ThicknessStatistics` that it unpacks to.
+    """
+
+    mean: Optional[float]
+    std: Optional[float]
+    min: Optional[float]
+    max: Optional[float]
+    local_thickness: Union[np.ndarray, SparseThickness, CroppedThickness]
+
+
+class ThicknessStatistics(_ThicknessFields):
+    """
+    Statistics of the local thickness of a structure, as returned by `calc_structure_thickness_statistics`. It is a
+    tuple of the mean, standard deviation, minimum and maximum thickness and the local thickness field, so that it
+    unpacks like the 5-tuple this function used to return, and has the other statistics as attributes only.
+
+    Attributes
+    ----------
+    mean : Optional[float]
+        Mean thickness, `None` if there is no structure.
+    std : Optional[float]
+        Standard deviation of the thickness (IPL's Th.Sd).
+    min : Optional[float]
+        Minimum thickness.
+    max : Optional[float]
+        Maximum thickness (IPL's Th.Max).
+    local_thickness : Union[np.ndarray, SparseThickness, CroppedThickness]
+        The local thickness field of the entire image, 0 outside the structure, in the format that was asked for.
+    skewness : Optional[float]
+        Skewness of the thickness (IPL's Th.Skew), 0 if the thickness is constant.
+    kurtosis : Optional[float]
+        Excess kurtosis of the thickness (IPL's Th.Kurtos), 0 if the thickness is constant.
+    histogram : Optional[np.ndarray]
+        Number of voxels with a thickness in each bin.
+    bin_edges : Optional[np.ndarray]
+        The edges of the histogram bins, starting at 0, with length `len(histogram) + 1`.
+    count : int
+        Number of voxels the statistics were computed on.
+    """
+
+    def __new__(
+        cls,
+        mean: Optional[float],
+        std: Optional[float],
+        min: Optional[float],
+        max: Optional[float],
+        local_thickness: Union[np.ndarray, SparseThickness, CroppedThickness],
+        skewness: Optional[float] = None,
+        kurtosis: Optional[float] = None,
+        histogram: Optional[np.ndarray] = None,
+        bin_edges: Optional[np.ndarray] = None,
+        count: int = 0,
+    ):
+        self = super().__new__(cls, mean, std, min, max, local_thickness)
+        self.skewness = skewness
+        self.kurtosis = kurtosis
+        self.histogram = histogram
+        self.bin_edges = bin_edges
+        self.count = count
+        return self
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def _merge_moments(
+    state: np.ndarray, n: float, mean: float, m2: float, m3: float, m4: float
+) -> np.ndarray:
+    """
+    Merge the count, mean and sums of the 2nd to 4th powers of the deviations from the mean of a set of values into
+    the first five entries of `state`, with Pébay's pairwise update.
+    """
+    na, mean_a, m2a, m3a, m4a = state[0], state[1], state[2], state[3], state[4]
+    if n == 0:
+        return state
+    total = na + n
+    delta = mean - mean_a
+    delta_n = delta / total
+    state[0] = total
+    state[1] = mean_a + n * delta_n
+    state[2] = m2a + m2 + delta * delta_n * na * n
+    state[3] = (
+        m3a
+        + m3
+        + delta * delta_n * delta_n * na * n * (na - n)
+        + 3 * delta_n * (na * m2 - n * m2a)
+    )
+    state[4] = (
+        m4a
+        + m4
+        + delta * delta_n**3 * na * n * (na * na - na * n + n * n)
+        + 6 * delta_n**2 * (na * na * m2 + n * n * m2a)
+        + 4 * delta_n * (na * m3 - n * m3a)
+    )
+    return state
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def _accumulate_thickness(
+    values: np.ndarray,
+    sub_mask: np.ndarray,
+    min_thickness: float,
+    bin_width: float,
+    state: np.ndarray,
+    histogram: np.ndarray,
+) -> np.ndarray:
+    """
+    Add the positive `values` (only where `sub_mask` is nonzero, unless it is empty), raised to `min_thickness`, to
+    the count, mean, central moment sums, minimum and maximum in `state`. The moments of blocks of `STATISTICS_BLOCK`
+    values are computed exactly, in two passes over the block, and merged into `state` with `_merge_moments`.
+    Returns `histogram` with each value counted in bin `int(value / bin_width)`, grown if needed.
+    """
+    use_sub_mask = sub_mask.shape[0] > 0
+    minimum, maximum = state[5], state[6]
+    block = np.empty(STATISTICS_BLOCK)
+    for start in range(0, values.shape[0], STATISTICS_BLOCK):
+        stop = min(start + STATISTICS_BLOCK, values.shape[0])
+        m, total = 0, 0.0
+        for i in range(start, stop):
+            x = float(values[i])
+            if x > 0 and (not use_sub_mask or sub_mask[i]):
+                x = max(x, min_thickness)
+                block[m] = x
+                m += 1
+                total += x
+        if m == 0:
+            continue
+
+        mean = total / m
+        m2, m3, m4 = 0.0, 0.0, 0.0
+        for i in range(m):
+            x = block[i]
+            minimum = min(minimum, x)
+            maximum = max(maximum, x)
+            d = x - mean
+            d2 = d * d
+            m2 += d2
+            m3 += d2 * d
+            m4 += d2 * d2
+        _merge_moments(state, m, mean, m2, m3, m4)
+
+        # the histogram is grown to fit the largest value of the block
+        size = int(maximum / bin_width) + 1
+        if size > histogram.shape[0]:
+            grown = np.zeros(max(size, 2 * histogram.shape[0]), dtype=np.int64)
+            grown[: histogram.shape[0]] = histogram
+            histogram = grown
+        for i in range(m):
+            histogram[int(block[i] / bin_width)] += 1
+    state[5], state[6] = minimum, maximum
+    return histogram
+
+
+class ThicknessAccumulator:
+    """
+    Single-pass accumulator of the mean, standard deviation, minimum, maximum, skewness, (excess) kurtosis and
+    histogram of a local thickness field, the statistics IPL reports for DT thickness measurements.
+
+    The field can be added all at once or chunk by chunk with `update`, and accumulators of separate chunks can be
+    combined with `merge`. The moments are accumulated in double precision: they are computed exactly for blocks of a
+    few thousand values at a time, which are merged with Pébay's (2008) pairwise update, so the thickness values are
+    read once and never copied.
+
+    Parameters
+    ----------
+    min_thickness : float
+        Positive thicknesses below this value are counted as `min_thickness`. Zero thickness is never counted.
+
+    bin_width : float
+        The width of the histogram bins, which start at 0.
+    """
+
+    def __init__(self, min_thickness: float = 0.0, bin_width: float = 1.0):
+        if bin_width <= 0:
+            raise ValueError("`bin_width` must be positive")
+        self.min_thickness = float(min_thickness)
+        self.bin_width = float(bin_width)
+        # count, mean, sums of the 2nd to 4th powers of the deviations, min, max
+        self._state = np.array([0.0, 0.0, 0.0, 0.0, 0.0, np.inf, -np.inf])
+        self._histogram = np.zeros(0, dtype=np.int64)
+
+    @property
+    def count(self) -> int:
+        return int(self._state[0])
+
+    def update(
+        self, local_thickness: np.ndarray, sub_mask: Optional[np.ndarray] = None
+    ) -> ThicknessAccumulator:
+        """
+        Add the positive voxels of a local thickness field, or a chunk of it, to the statistics.
+
+        Parameters
+        ----------
+        local_thickness : np.ndarray
+            The local thickness values, of any shape. Half precision values are converted to single precision.
+
+        sub_mask : Optional[np.ndarray]
+            If given, only the voxels where this mask, with the same shape as `local_thickness`, is nonzero are added.
+
+        Returns
+        -------
+        ThicknessAccumulator
+            This accumulator.
+        """
+        local_thickness = np.asarray(local_thickness)
+        if local_thickness.dtype == np.float16:
+            local_thickness = local_thickness.astype(np.float32)
+        if sub_mask is None:
+            sub_mask = np.zeros(0, dtype=bool)
+        else:
+            sub_mask = np.asarray(sub_mask)
+            if sub_mask.shape != local_thickness.shape:
+                raise ValueError(
+                    "`local_thickness` and `sub_mask` must have same shape"
+                )
+            sub_mask = sub_mask if sub_mask.dtype == bool else sub_mask != 0
+        self._histogram = _accumulate_thickness(
+            local_thickness.reshape(-1),
+            sub_mask.reshape(-1),
+            self.min_thickness,
+            self.bin_width,
+            self._state,
+            self._histogram,
+        )
+        return self
+
+    def merge(self, other: ThicknessAccumulator) -> ThicknessAccumulator:
+        """
+        Add the statistics of another accumulator with the same `bin_width` to this one.
+        """
+        if other.bin_width != self.bin_width:
+            raise ValueError("cannot merge accumulators with different `bin_width`")
+        _merge_moments(self._state, *other._state[:5])
+        self._state[5] = min(self._state[5], other._state[5])
+        self._state[6] = max(self._state[6], other._state[6])
+        length = max(len(self._histogram), len(other._histogram))
+        histogram = np.zeros(length, dtype=np.int64)
+        histogram[: len(self._histogram)] += self._histogram
+        histogram[: len(other._histogram)] += other._histogram
+        self._histogram = histogram
+        return self
+
+    def statistics(self, local_thickness: np.ndarray) -> ThicknessStatistics:
+        """
+        The accumulated statistics, with the `local_thickness` field they were computed on. If no voxels were added,
+        all statistics are `None`.
+        """
+        n, mean, m2, m3, m4, minimum, maximum = self._state
+        if n == 0:
+            return ThicknessStatistics(None, None, None, None, local_thickness)
+        histogram = self._histogram[: int(maximum / self.bin_width) + 1].copy()
+        # scipy.stats' (biased) skewness and Fisher's kurtosis, which IPL reports
+        skewness = np.sqrt(n) * m3 / m2**1.5 if m2 > 0 else 0.0
+        kurtosis = n * m4 / m2**2 - 3 if m2 > 0 else 0.0
+        return ThicknessStatistics(
+            mean,
+            np.sqrt(m2 / n),
+            minimum,
+            maximum,
+            local_thickness,
+            skewness,
+            kurtosis,
+            histogram,
+            self.bin_width * np.arange(len(histogram) + 1),
+            int(n),
+        )
+
 
 def calc_structure_thickness_statistics(
     mask: np.ndarray,
@@ -216,7 +1562,15 @@ def calc_structure_thickness_statistics(
     pad_amount: Optional[Union[int, Tuplep[int, int, int]]] = None,
     oversample: bool = True,
     skeletonize: bool = True,
-) -> Tuple[float, float, float, float, np.ndarray]:
+    n_threads: Optional[int] = None,
+    ridge: Optional[str] = None,
+    memory_budget: Optional[int] = None,
+    scratch_dir: Optional[str] = None,
+    bin_width: Optional[float] = None,
+    output_dtype: Union[type, np.dtype] = np.float64,
+    output_format: str = "dense",
+    crop: bool = True,
+) -> ThicknessStatistics:
     """
     Parameters
     ----------
@@ -237,7 +1591,8 @@ def calc_structure_thickness_statistics(
     pad_amount: Optional[int]
         specify this to pad your mask using edge padding but then only use the local distances provided on the
         original image. can be useful if you have a structure that intersects the edge of the image but you don't want
-        local thicknesses to be artificially decreased
+        local thicknesses to be artificially decreased. with `crop`, only the sides of the crop that reach the edge of
+        the image are padded
 
     oversample : bool
         Set this to `True` to use the (more accurate but slower) oversampling distance transform method. For
@@ -247,60 +1602,370 @@ def calc_structure_thickness_statistics(
         Set this to `True` to skeletonize and use only voxels on the skeleton for thickness calculation. For
         better consistency with IPL, set this to `True`
 
+    n_threads : Optional[int]
+        Number of threads used to fill the spheres. If `None`, all threads available to numba are used.
+
+    ridge : Optional[str]
+        Which voxels to center spheres on, one of `"skeleton"`, `"mask"`, `"hildebrand"` or `"local_max"`. If `None`,
+        this is set from `skeletonize`. See `compute_local_thickness_from_mask`.
+
+    memory_budget : Optional[int]
+        If given, the local thickness field is computed out of core with `compute_local_thickness_chunked`, keeping
+        the working memory to roughly this many bytes, and returned as a memory-mapped array. `ridge` must then be
+        `"mask"`, `"hildebrand"` or `"local_max"`, `pad_amount` is not supported and `output_format` must be
+        `"dense"`. If `ridge` is `None`, the `"hildebrand"` ridge is used, with a warning if `skeletonize` is `True`
+        since the skeleton cannot be computed in slabs.
+
+    scratch_dir : Optional[str]
+        Directory for the temporary files of the out-of-core computation.
+
+    bin_width : Optional[float]
+        Width of the bins of the thickness histogram. If `None`, the smallest voxel width is used.
+
+    output_dtype : Union[type, np.dtype]
+        The floating point type of the returned local thickness field, `np.float64`, `np.float32` or `np.float16`.
+        The statistics are computed in double precision, except with `memory_budget`, where they are computed from
+        the stored field.
+
+    output_format : str
+        How to return the local thickness field, `"dense"`, `"indices"` or `"bbox"`. See
+        `compute_local_thickness_from_mask`.
+
+    crop : bool
+        Set this to `True` to compute the local thickness field only on the bounding box of the mask, with a margin of
+        `CROP_MARGIN` voxels, and paste it back into the image. The result is the same, but the time and memory needed
+        scale with the size of the structure rather than the size of the image. Not used with `memory_budget`.
+
     Returns
     -------
-    Tuple[float, float, float, float, np.ndarray]
-        the mean, standard deviation, minimum, and maximum of the local thickness of the structure defined by the mask,
-        and the whole local thickness field of the entire image (0 outside the mask)
+    ThicknessStatistics
+        the mean, standard deviation, minimum, maximum, skewness and kurtosis and the histogram of the local
+        thickness of the structure defined by the mask, and the whole local thickness field of the entire image (0
+        outside the mask). It unpacks like the tuple `(mean, std, min, max, local_thickness)`, the other statistics
+        are attributes only.
     """
+    _check_output_options(output_dtype, output_format)
+    if bin_width is None:
+        bin_width = _parse_voxel_width(voxel_width).min()
+    accumulator = ThicknessAccumulator(min_thickness, bin_width)
+
     if sub_mask is not None:
         sub_mask = sub_mask > 0  # binarize
         if sub_mask.sum() == 0:
             warnings.warn(
                 "cannot find structure thickness statistics for binary sub_mask with no positive voxels"
             )
-            return None, None, None, None, np.zeros(mask.shape, dtype=float)
+            return ThicknessStatistics(
+                None,
+                None,
+                None,
+                None,
+                format_local_thickness(
+                    np.zeros(mask.shape, dtype=float), output_dtype, output_format
+                ),
+            )
         if mask.shape != sub_mask.shape:
             raise ValueError(
                 "`mask` and `sub_mask` must have same shape if `sub_mask` is given"
             )
-    else:
-        sub_mask = np.ones_like(mask, dtype=bool)
+
+    if memory_budget is not None:
+        if pad_amount is not None:
+            raise ValueError("`pad_amount` is not supported with `memory_budget`")
+        if output_format != "dense":
+            raise ValueError('`output_format` must be "dense" with `memory_budget`')
+        if ridge is None:
+            if skeletonize:
+                warnings.warn(
+                    "the skeleton ridge is not supported with `memory_budget`, "
+                    'using the "hildebrand" ridge instead'
+                )
+            ridge = "hildebrand"
+        local_thickness = compute_local_thickness_chunked(
+            mask,
+            voxel_width,
+            memory_budget,
+            oversample,
+            ridge,
+            n_threads,
+            scratch_dir=scratch_dir,
+            output_dtype=output_dtype,
+        )
+        return _chunked_thickness_statistics(
+            local_thickness, sub_mask, accumulator, memory_budget
+        )
 
     if pad_amount is not None:
         if not isinstance(pad_amount, int) or (pad_amount <= 0):
             raise ValueError("if given, `pad_amount` must be a positive integer")
-        mask = np.pad(mask, pad_amount, mode="edge")
 
-    if (mask > 0).sum() > 0:
-        mask = mask > 0  # binarize
-        local_thickness = compute_local_thickness_from_mask(
-            mask, voxel_width, oversample, skeletonize
-        )
-        local_thickness *= sub_mask
-    else:
+    mask = mask > 0  # binarize
+    box = _bounding_box(mask)
+    if box[0].stop == 0:
         warnings.warn(
             "cannot find structure thickness statistics for binary mask with no positive voxels"
         )
-        return None, None, None, None, np.zeros(mask.shape, dtype=float)
+        return ThicknessStatistics(
+            None,
+            None,
+            None,
+            None,
+            format_local_thickness(
+                np.zeros(mask.shape, dtype=float), output_dtype, output_format
+            ),
+        )
+    if crop:
+        box = tuple(
+            slice(max(b.start - CROP_MARGIN, 0), min(b.stop + CROP_MARGIN, n))
+            for b, n in zip(box, mask.shape)
+        )
+    else:
+        box = tuple(slice(0, n) for n in mask.shape)
+    structure = mask[box]
 
     if pad_amount is not None:
-        # trim down the output
-        mask = mask[
-            pad_amount:-pad_amount, pad_amount:-pad_amount, pad_amount:-pad_amount
+        # beyond the sides of the crop that do not reach the edge of the image,
+        # the padded mask is background anyway
+        pad_width = [
+            (pad_amount if b.start == 0 else 0, pad_amount if b.stop == n else 0)
+            for b, n in zip(box, mask.shape)
         ]
+        structure = np.pad(structure, pad_width, mode="edge")
+
+    local_thickness = compute_local_thickness_from_mask(
+        structure, voxel_width, oversample, skeletonize, n_threads, ridge
+    )
+
+    if pad_amount is not None:
+        # trim down the output
         local_thickness = local_thickness[
-            pad_amount:-pad_amount, pad_amount:-pad_amount, pad_amount:-pad_amount
+            tuple(
+                slice(lo, n - hi)
+                for (lo, hi), n in zip(pad_width, local_thickness.shape)
+            )
         ]
+    if sub_mask is not None:
+        local_thickness *= sub_mask[box]
 
-    local_thickness_structure = np.maximum(
-        local_thickness[local_thickness > 0], min_thickness
+    accumulator.update(local_thickness)
+    return accumulator.statistics(
+        _uncrop_local_thickness(
+            local_thickness, box, mask.shape, output_dtype, output_format
+        )
     )
 
-    return (
-        local_thickness_structure.mean(),
-        local_thickness_structure.std(),
-        local_thickness_structure.min(),
-        local_thickness_structure.max(),
-        local_thickness,
+
+def _chunked_thickness_statistics(
+    local_thickness: np.memmap,
+    sub_mask: Optional[np.ndarray],
+    accumulator: ThicknessAccumulator,
+    memory_budget: int,
+) -> ThicknessStatistics:
+    """
+    Structure thickness statistics of a memory-mapped local thickness field, accumulated slab by slab.
+    """
+    depth = max(
+        _slab_depth(
+            memory_budget,
+            local_thickness.shape[1] * local_thickness.shape[2],
+            FILL_BYTES_PER_VOXEL,
+        ),
+        1,
     )
+    for z0 in range(0, local_thickness.shape[0], depth):
+        slab = local_thickness[z0 : z0 + depth]
+        if sub_mask is not None:
+            slab *= np.asarray(sub_mask[z0 : z0 + depth])
+        accumulator.update(slab)
+    local_thickness.flush()
+
+    statistics = accumulator.statistics(local_thickness)
+    if statistics.count == 0:
+        warnings.warn(
+            "cannot find structure thickness statistics for binary mask with no positive voxels"
+        )
+    return statistics
+
+
+def calc_thickness_and_separation(
+    mask: np.ndarray,
+    roi_mask: np.ndarray,
+    voxel_width: Union[float, Iterable],
+    min_thickness: float = 0.0,
+    min_separation: float = 0.0,
+    oversample: bool = True,
+    skeletonize: bool = True,
+    n_threads: Optional[int] = None,
+    ridge: Optional[str] = None,
+    bin_width: Optional[float] = None,
+    output_dtype: Union[type, np.dtype] = np.float64,
+    output_format: str = "dense",
+    crop: bool = True,
+) -> Tuple[ThicknessStatistics, ThicknessStatistics]:
+    """
+    Calculate the thickness statistics of a structure and of the space around it (its separation) within a region
+    of interest, e.g. Tb.Th and Tb.Sp of the trabecular bone within a periosteal mask.
+
+    This gives the same results as `calc_structure_thickness_statistics` of `mask & roi_mask` and of
+    `roi_mask & ~mask`, but the two phases share the work: the region of interest is cropped and labelled once, and
+    the distance maps of both phases are computed in one pass with `label_distance_transform` (or one phase after the
+    other when oversampling). Each phase is then finished in one buffer, which holds its distances and then its
+    local thickness field, whose statistics and output are taken before the buffer is reused for the other phase.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        3-dimensional binary mask of the structure.
+
+    roi_mask : np.ndarray
+        3-dimensional binary mask of the region of interest, with the same shape as `mask`. The separation is the
+        thickness of the part of the region of interest outside `mask`.
+
+    voxel_width : Union[float, Iterable]
+        physical width of a voxel, for scaling distance. Either a single float value or length-3 iterable
+
+    min_thickness : float
+        the minimum thickness of the structure
+
+    min_separation : float
+        the minimum thickness of the separation
+
+    oversample : bool
+        Set this to `True` to use the (more accurate but slower) oversampling distance transform method. For
+        consistency with IPL, set this to `False`
+
+    skeletonize : bool
+        Set this to `True` to skeletonize and use only voxels on the skeleton for thickness calculation. For
+        better consistency with IPL, set this to `True`
+
+    n_threads : Optional[int]
+        Number of threads to use. If `None`, all threads available to numba are used.
+
+    ridge : Optional[str]
+        Which voxels to center spheres on, see `compute_local_thickness_from_mask`.
+
+    bin_width : Optional[float]
+        Width of the bins of the thickness histograms. If `None`, the smallest voxel width is used.
+
+    output_dtype : Union[type, np.dtype]
+        The floating point type of the returned local thickness fields, see `compute_local_thickness_from_mask`.
+
+    output_format : str
+        How to return the local thickness fields, see `compute_local_thickness_from_mask`.
+
+    crop : bool
+        Set this to `True` to work only on the bounding box of the region of interest, see
+        `calc_structure_thickness_statistics`.
+
+    Returns
+    -------
+    Tuple[ThicknessStatistics, ThicknessStatistics]
+        The statistics and local thickness fields of the structure and of the separation.
+    """
+    ridge = _parse_ridge(ridge, skeletonize)
+    check_n_threads(n_threads)
+    _check_output_options(output_dtype, output_format)
+    voxel_width = _parse_voxel_width(voxel_width)
+    if bin_width is None:
+        bin_width = voxel_width.min()
+    if mask.shape != roi_mask.shape:
+        raise ValueError("`mask` and `roi_mask` must have same shape")
+
+    roi_mask = roi_mask > 0  # binarize
+    box = _bounding_box(roi_mask)
+    if crop:
+        box = tuple(
+            slice(max(b.start - CROP_MARGIN, 0), min(b.stop + CROP_MARGIN, n))
+            for b, n in zip(box, mask.shape)
+        )
+    else:
+        box = tuple(slice(0, n) for n in mask.shape)
+
+    # label 1 is the structure, label 2 the separation
+    labels = 2 * roi_mask[box].astype(np.uint8)
+    labels[(mask[box] > 0) & roi_mask[box]] = 1
+    phases = [phase for phase in (1, 2) if np.any(labels == phase)]
+
+    if not oversample:
+        dist = label_distance_transform(labels, voxel_width, n_threads=n_threads)
+
+    # one buffer holds the distances of each phase in turn, and then its
+    # spheres, whose statistics and output are taken before the next phase
+    buffer = np.zeros(labels.shape)
+    results = []
+    for phase, minimum, name in [
+        (1, min_thickness, "mask"),
+        (2, min_separation, "separation"),
+    ]:
+        phase_mask = labels == phase
+        if phase in phases:
+            if oversample:
+                phase_dist = _distance_map(phase_mask, voxel_width, True)
+            else:
+                phase_dist = np.multiply(dist, phase_mask, out=buffer)
+                if phase == phases[-1]:
+                    del dist
+            ridge_dist = _ridge_distances(phase_mask, phase_dist, voxel_width, ridge)
+            del phase_dist
+            # only the sorted ridge is kept, as the ridge can be the buffer
+            sorted_ridge = sorted_distance_ridge(ridge_dist)
+            del ridge_dist
+            buffer[...] = 0
+            _fill_sorted_spheres(
+                *sorted_ridge, voxel_width, oversample, n_threads, out=buffer
+            )
+            del sorted_ridge
+            buffer *= phase_mask
+        else:
+            buffer[...] = 0
+
+        accumulator = ThicknessAccumulator(minimum, bin_width).update(buffer)
+        if accumulator.count == 0:
+            warnings.warn(
+                f"cannot find structure thickness statistics for {name} with no positive voxels in `roi_mask`"
+            )
+        local_thickness = _uncrop_local_thickness(
+            buffer, box, mask.shape, output_dtype, output_format
+        )
+        if phase == 1 and local_thickness is buffer:
+            local_thickness = local_thickness.copy()
+        results.append(accumulator.statistics(local_thickness))
+    return tuple(results)
+
+
+def warmup_kernels():
+    """
+    Compile the numba kernels of this module and of `ormir_xct.util.distance_transform` for the argument types they
+    are used with (float32 and float64 fields and distances, int32 and int64 indices), by running them on a small
+    mask. The kernels are cached on disk, so in every process after the first this only loads them from the cache.
+    """
+    mask = np.zeros((6, 6, 6), dtype=bool)
+    mask[1:5, 1:5, 1:5] = True
+    voxel_width = np.ones(3)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for dtype in (np.float32, np.float64):
+            euclidean_distance_transform(mask, voxel_width, dtype=dtype)
+            label_distance_transform(mask.astype(np.uint8), voxel_width, dtype=dtype)
+            values = np.ones(mask.shape, dtype=dtype)
+            ThicknessAccumulator().update(values)
+            ThicknessAccumulator().update(values, mask)
+
+        for oversample in (False, True):
+            for ridge in ("mask", "hildebrand", "local_max"):
+                compute_local_thickness_from_mask(
+                    mask, voxel_width, oversample, ridge=ridge
+                )
+        compute_local_thickness_chunked(mask, voxel_width, 2**16, oversample=False)
+
+        sorted_dists = np.ones(1)
+        for dtype in (np.float32, np.float64):
+            for index_dtype in (np.int32, np.int64):
+                compute_local_thickness_from_sorted_distances(
+                    np.zeros(mask.shape, dtype=dtype),
+                    sorted_dists,
+                    np.ones((1, 3), dtype=index_dtype),
+                    voxel_width,
+                    0.0,
+                )
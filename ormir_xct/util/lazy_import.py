@@ -0,0 +1,61 @@
+"""
+lazy_import.py
+
+Description: Lazy loading of modules, so that heavy backends (ITK, VTK,
+             numba, scipy) are only imported when a code path uses them.
+"""
+
+import sys
+import types
+import importlib
+import importlib.util
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that imports it on the first attribute access and
+    forwards all attribute access to it from then on.
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_module"] is not None else "not loaded"
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+def lazy_import(name):
+    """
+    Import a module lazily: the module is imported when one of its attributes
+    is first accessed. If the module was already imported, it is returned as
+    is.
+
+    Parameters
+    ----------
+    name : string
+        The absolute name of the module, e.g. "itk" or "scipy.ndimage".
+
+    Returns
+    -------
+    module : module or LazyModule
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name.partition(".")[0]) is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    return LazyModule(name)
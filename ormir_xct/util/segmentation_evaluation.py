@@ -11,6 +11,12 @@ https://github.com/InsightSoftwareConsortium/SimpleITK-Notebooks/blob/master/Pyt
 import SimpleITK as sitk
 import numpy as np
 
+from ormir_xct.util.lazy_import import lazy_import
+
+# scipy and the numba distance transform are only needed for the surface metrics
+ndimage = lazy_import("scipy.ndimage")
+distance_transform = lazy_import("ormir_xct.util.distance_transform")
+
 
 def binarize_numpy_array(arr):
     """
@@ -33,6 +39,10 @@ def get_distance_map_and_surface(mask):
     """
     Take in an ITK image mask and return the distance map and surface images.
 
+    The distance map is the absolute value of `sitk.SignedMaurerDistanceMap`:
+    the distance to the nearest voxel of the mask that touches the background,
+    computed with `euclidean_distance_transform`.
+
     Parameters
     ----------
     mask : ITK.Image
@@ -43,9 +53,16 @@ def get_distance_map_and_surface(mask):
         A Python list containing the distance map, surface image, and number of
         pixels in the surface image.
     """
-    dist_map = sitk.Abs(
-        sitk.SignedMaurerDistanceMap(mask, squaredDistance=False, useImageSpacing=True)
+    mask_array = sitk.GetArrayFromImage(mask) > 0
+    border = mask_array & ~ndimage.binary_erosion(
+        mask_array, np.ones((3,) * mask_array.ndim), border_value=1
+    )
+    dist_map = sitk.GetImageFromArray(
+        distance_transform.euclidean_distance_transform(
+            ~border, mask.GetSpacing()[::-1], dtype=np.float32
+        )
     )
+    dist_map.CopyInformation(mask)
     surface = sitk.LabelContour(mask)
     stats_filter = sitk.StatisticsImageFilter()
     stats_filter.Execute(surface)
@@ -71,8 +88,9 @@ def get_surface_to_surface_distances_list(surf2surf_dist_map, surface_num_pix):
     surf2surf_dist_list = list(surf2surf_dist_array[surf2surf_dist_array != 0])
     num_nonzero_pix = len(surf2surf_dist_list)
     if num_nonzero_pix < surface_num_pix:
+        # the surface voxels that overlap have distance zero
         zeros_list = list(np.zeros(surface_num_pix - num_nonzero_pix))
-        surf2surf_distance_list = surf2surf_dist_list + zeros_list
+        surf2surf_dist_list = surf2surf_dist_list + zeros_list
 
     return surf2surf_dist_list
 
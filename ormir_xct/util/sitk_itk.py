@@ -7,11 +7,14 @@ Created on:   26/01/2021
 Description: Converts between SimpleITK and ITK images.
 """
 
-import itk
 import SimpleITK as sitk
 
 import numpy as np
 
+from ormir_xct.util.lazy_import import lazy_import
+
+itk = lazy_import("itk")
+
 
 def sitk_itk(sitk_image):
     """
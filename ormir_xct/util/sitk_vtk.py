@@ -7,11 +7,13 @@ Created on:   21-01-2020
 Description: Converts between SimpleITK and VTK image types
 """
 
-import vtk
-from vtk.util.numpy_support import vtk_to_numpy
-
 import SimpleITK as sitk
 
+from ormir_xct.util.lazy_import import lazy_import
+
+vtk = lazy_import("vtk")
+numpy_support = lazy_import("vtk.util.numpy_support")
+
 
 def sitk_to_vtk(sitk_image):
     """
@@ -82,7 +84,7 @@ def vtk_to_sitk(vtk_image):
     sitk_image : SimpleITK.Image
     """
     vtk_data = vtk_image.GetPointData().GetScalars()
-    numpy_data = vtk_to_numpy(vtk_data)
+    numpy_data = numpy_support.vtk_to_numpy(vtk_data)
     dims = vtk_image.GetDimensions()
     numpy_data = numpy_data.reshape(dims[2], dims[1], dims[0])
     numpy_data = numpy_data.transpose(2, 1, 0)
@@ -0,0 +1,639 @@
+"""
+slab_streaming.py
+
+Description: Process a 3D image a slab of z slices at a time: neighbourhood
+             filters on slabs padded with a halo of the slices they read,
+             connected component labelling of the slabs merged across their
+             faces with union-find, the selection of the largest component,
+             also of a crop of a larger image, and reading slabs and regions
+             of an image file without loading the whole image. The results are identical
+             to processing the whole image at once.
+"""
+
+from __future__ import annotations
+
+import functools
+import numpy as np
+import SimpleITK as sitk
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from ormir_xct.util.lazy_import import lazy_import
+
+# the union-find pulls in numba, only load it when slabs are merged
+slice_connected_components = lazy_import("ormir_xct.util.slice_connected_components")
+
+Image = Union[sitk.Image, str]
+
+
+def slab_ranges(
+    depth: int, slab_size: Optional[int], halo: int = 0
+) -> List[Tuple[int, int, int, int]]:
+    """
+    Split the z slices of an image into slabs.
+
+    Parameters
+    ----------
+    depth : int
+        The number of z slices of the image.
+    slab_size : int
+        The number of slices of a slab, the last slab can be thinner. None for a single slab.
+    halo : int
+        The number of slices a slab is padded with on both sides, clipped to the image.
+
+    Returns
+    -------
+    List[Tuple[int, int, int, int]]
+        The first and one past the last slice of every slab, and of the slab with its halo.
+    """
+    if slab_size is None:
+        slab_size = max(depth, 1)
+    return [
+        (
+            start,
+            min(start + slab_size, depth),
+            max(start - halo, 0),
+            min(start + slab_size + halo, depth),
+        )
+        for start in range(0, depth, slab_size)
+    ]
+
+
+def image_geometry(image: Image) -> Tuple[tuple, tuple, tuple, tuple]:
+    """
+    The size, origin, spacing and direction of an image, read from the header if it is a file.
+
+    Parameters
+    ----------
+    image : sitk.Image or str
+        The image, or the path of an image file.
+
+    Returns
+    -------
+    Tuple[tuple, tuple, tuple, tuple]
+        The size, origin, spacing and direction, in SimpleITK's (x, y, z) order.
+    """
+    if isinstance(image, str):
+        image = _reader(image)
+        image.ReadImageInformation()
+    return image.GetSize(), image.GetOrigin(), image.GetSpacing(), image.GetDirection()
+
+
+def blank_image(reference: Image, pixel_id: int = sitk.sitkUInt8) -> sitk.Image:
+    """
+    An image of zeros with the size and geometry of another image.
+
+    Parameters
+    ----------
+    reference : sitk.Image or str
+        The image, or the path of an image file, to take the size and geometry from.
+    pixel_id : int
+        The pixel type. Default is `sitk.sitkUInt8`.
+
+    Returns
+    -------
+    sitk.Image
+        The blank image.
+    """
+    size, origin, spacing, direction = image_geometry(reference)
+    image = sitk.Image(size, pixel_id)
+    _set_geometry(image, origin, spacing, direction)
+    return image
+
+
+def read_region(
+    image: Image,
+    index: Optional[Sequence[int]] = None,
+    size: Optional[Sequence[int]] = None,
+) -> sitk.Image:
+    """
+    A region of an image. Image files are read as float32, and only the region is read from the file if its format
+    can be streamed, like uncompressed NIfTI and MetaImage files.
+
+    Parameters
+    ----------
+    image : sitk.Image or str
+        The image, or the path of an image file.
+    index : Sequence[int]
+        The first voxel of the region in (x, y, z) order. None for the whole image.
+    size : Sequence[int]
+        The size of the region in (x, y, z) order.
+
+    Returns
+    -------
+    sitk.Image
+        The region, with the origin of its first voxel.
+    """
+    if isinstance(image, sitk.Image):
+        if index is None:
+            return image
+        return sitk.RegionOfInterest(
+            image, [int(n) for n in size], [int(i) for i in index]
+        )
+
+    reader = _reader(image)
+    reader.SetOutputPixelType(sitk.sitkFloat32)
+    if index is not None:
+        reader.SetExtractIndex([int(i) for i in index])
+        reader.SetExtractSize([int(n) for n in size])
+    return reader.Execute()
+
+
+def read_slab(image: Image, start: int, stop: int) -> sitk.Image:
+    """
+    The z slices from `start` to `stop` of an image, see `read_region`.
+
+    Parameters
+    ----------
+    image : sitk.Image or str
+        The image, or the path of an image file.
+    start : int
+        The first slice.
+    stop : int
+        One past the last slice.
+
+    Returns
+    -------
+    sitk.Image
+        The slab.
+    """
+    size = image_geometry(image)[0]
+    if start == 0 and stop == size[2] and isinstance(image, sitk.Image):
+        return image
+    return read_region(image, [0, 0, start], [size[0], size[1], stop - start])
+
+
+def map_slabs(
+    function: Callable, images: Sequence[Image], slab_size: Optional[int], halo: int
+) -> sitk.Image:
+    """
+    Apply a filter to images slab by slab and stitch the slabs of the result. Each slab is padded with `halo` slices
+    on both sides and only its own slices are kept, so the result is identical to filtering the whole images if
+    the value of a voxel only depends on the voxels at most `halo` slices from it.
+
+    Parameters
+    ----------
+    function : Callable
+        The filter, taking a slab of each image and returning an image of the same size.
+    images : Sequence[sitk.Image or str]
+        The images, or paths of image files, all of the same size.
+    slab_size : int
+        The number of slices of a slab. None to filter the whole images at once.
+    halo : int
+        The number of slices the filter reads on each side of a voxel.
+
+    Returns
+    -------
+    sitk.Image
+        The result, with the geometry of the first image.
+    """
+    size, origin, spacing, direction = image_geometry(images[0])
+    output = None
+    for start, stop, halo_start, halo_stop in slab_ranges(size[2], slab_size, halo):
+        result = function(
+            *[read_slab(image, halo_start, halo_stop) for image in images]
+        )
+        if output is None:
+            if start == halo_start and stop == halo_stop == size[2]:
+                return result
+            array = sitk.GetArrayViewFromImage(result)
+            output = np.empty((size[2],) + array.shape[1:], dtype=array.dtype)
+        output[start:stop] = sitk.GetArrayViewFromImage(result)[
+            start - halo_start : stop - halo_start
+        ]
+
+    image = sitk.GetImageFromArray(output)
+    _set_geometry(image, origin, spacing, direction)
+    return image
+
+
+@functools.lru_cache(maxsize=None)
+def gaussian_radius(
+    variance: float,
+    maximum_kernel_width: int,
+    maximum_error: float,
+    use_image_spacing: bool,
+    spacing: float,
+) -> int:
+    """
+    The number of slices `sitk.DiscreteGaussian` reads on each side of a voxel, measured by filtering an impulse,
+    as the size of the kernel depends on all of its parameters.
+
+    Parameters
+    ----------
+    variance : float
+        The variance of the gaussian.
+    maximum_kernel_width : int
+        The maximum kernel width of the filter.
+    maximum_error : float
+        The maximum error of the filter.
+    use_image_spacing : bool
+        Whether the variance is in physical units.
+    spacing : float
+        The z spacing of the image.
+
+    Returns
+    -------
+    int
+        The radius of the kernel along z in voxels.
+    """
+    radius = 16
+    while True:
+        impulse = np.zeros((2 * radius + 1, 3, 3), dtype=np.float32)
+        impulse[radius, 1, 1] = 1
+        image = sitk.GetImageFromArray(impulse)
+        image.SetSpacing([spacing] * 3)
+        sitk.ProcessObject_SetGlobalWarningDisplay(False)
+        smoothed = sitk.DiscreteGaussian(
+            image, variance, maximum_kernel_width, maximum_error, use_image_spacing
+        )
+        sitk.ProcessObject_SetGlobalWarningDisplay(True)
+        reach = np.flatnonzero(sitk.GetArrayViewFromImage(smoothed)[:, 1, 1])
+        if reach[0] > 0:
+            return radius - int(reach[0])
+        radius *= 2
+
+
+class SlabLabels:
+    """
+    The connected components of the foreground of a binary image, labelled slab by slab with
+    `sitk.ConnectedComponent` and merged across the faces between the slabs with union-find. The components are
+    numbered from 1 in the raster order of their first voxel, like those of `sitk.ConnectedComponent` on the whole
+    image, so the labels are identical to its labels. Only the labels of one slab are in memory at a time: they are
+    recomputed for `map`.
+
+    Attributes
+    ----------
+    sizes : np.ndarray
+        The number of voxels of every label, with the background at index 0.
+    faces : Dict[Tuple[int, int], set]
+        The labels on each face of the image, by numpy axis and side, 0 for the first and -1 for the last slice.
+    """
+
+    def __init__(
+        self,
+        image: sitk.Image,
+        slab_size: Optional[int] = None,
+        fully_connected: bool = True,
+    ):
+        """
+        Label the components.
+
+        Parameters
+        ----------
+        image : sitk.Image
+            The binary image, in which all nonzero voxels are foreground.
+        slab_size : int
+            The number of z slices of a slab. None to label the whole image at once.
+        fully_connected : bool
+            If `True`, voxels that share a corner or an edge are connected, otherwise only voxels that share a face.
+        """
+        self.image = image
+        self.fully_connected = fully_connected
+        self.slabs = slab_ranges(image.GetDepth(), slab_size)
+
+        # the labels of a single slab are kept, as they would be recomputed for the whole image
+        self._labels = None
+
+        # the labels of every slab, numbered on from those of the slabs before it
+        self.offsets = []
+        provisional_sizes = [np.zeros(1, dtype=np.int64)]
+        faces = {(axis, side): [] for axis in range(3) for side in [0, -1]}
+        pairs = []
+        offset, previous = 0, None
+        for index in range(len(self.slabs)):
+            labels = self._slab_labels(index)
+            n = int(labels.max(initial=0))
+
+            # counted a few slices at a time, so that no 64 bit copy of the labels is needed
+            sizes = np.zeros(n + 1, dtype=np.int64)
+            for start in range(0, labels.shape[0], 16):
+                sizes += np.bincount(
+                    labels[start : start + 16].ravel(), minlength=n + 1
+                )
+            provisional_sizes[0] += sizes[0]
+            provisional_sizes.append(sizes[1:])
+
+            first = _offset_labels(labels[0], offset)
+            if previous is not None:
+                pairs.append(self._touching_pairs(previous, first))
+            previous = _offset_labels(labels[-1], offset)
+
+            for axis in [1, 2]:
+                for side in [0, -1]:
+                    faces[axis, side].append(
+                        _offset_labels(np.unique(labels.take(side, axis=axis)), offset)
+                    )
+            if index == 0:
+                faces[0, 0].append(np.unique(first))
+            if index == len(self.slabs) - 1:
+                faces[0, -1].append(np.unique(previous))
+
+            self.offsets.append(offset)
+            offset += n
+            if len(self.slabs) == 1:
+                self._labels = labels
+
+        # union-find of the labels that touch across the faces between the slabs, with the smaller label as the
+        # root, so the root of a component is the label of its first voxel
+        parent = np.arange(offset + 1)
+        if pairs:
+            slice_connected_components.union_pairs(parent, np.concatenate(pairs))
+
+        # the roots numbered from 1 in order, which is the raster order of their first voxel
+        is_root = parent == np.arange(offset + 1)
+        is_root[0] = False
+        self.lookup = np.cumsum(is_root)[parent]
+        self.sizes = np.zeros(int(is_root.sum()) + 1, dtype=np.int64)
+        np.add.at(self.sizes, self.lookup, np.concatenate(provisional_sizes))
+        self.faces = {
+            key: set(self.lookup[np.concatenate(ids)].tolist()) - {0}
+            for key, ids in faces.items()
+        }
+
+    def _slab_labels(self, index: int) -> np.ndarray:
+        """
+        The labels of the components of a slab, numbered from 1 within the slab.
+        """
+        if self._labels is not None:
+            return self._labels
+        start, stop, _, _ = self.slabs[index]
+        slab = read_slab(self.image, start, stop)
+        return sitk.GetArrayFromImage(
+            sitk.ConnectedComponent(slab, self.fully_connected)
+        )
+
+    def _touching_pairs(self, last: np.ndarray, first: np.ndarray) -> np.ndarray:
+        """
+        The pairs of labels of the last slice of a slab and the first slice of the next slab whose voxels touch.
+        """
+        shifts = [-1, 0, 1] if self.fully_connected else [0]
+        pairs = []
+        for dy in shifts:
+            for dx in shifts:
+                a = last[
+                    max(dy, 0) : last.shape[0] + min(dy, 0),
+                    max(dx, 0) : last.shape[1] + min(dx, 0),
+                ]
+                b = first[
+                    max(-dy, 0) : first.shape[0] + min(-dy, 0),
+                    max(-dx, 0) : first.shape[1] + min(-dx, 0),
+                ]
+                touching = (a > 0) & (b > 0)
+                pairs.append(np.stack([a[touching], b[touching]], axis=1))
+        return np.unique(np.concatenate(pairs), axis=0)
+
+    def first_voxel(self, label: int) -> Tuple[int, int, int]:
+        """
+        The first voxel of a label in raster order.
+
+        Parameters
+        ----------
+        label : int
+            The label.
+
+        Returns
+        -------
+        Tuple[int, int, int]
+            The index of the voxel in numpy's (z, y, x) order.
+        """
+        root = int(np.argmax(self.lookup == label))
+        index = int(np.searchsorted(self.offsets, root, side="left")) - 1
+        labels = self._slab_labels(index)
+        z, y, x = np.unravel_index(
+            np.argmax(labels == root - self.offsets[index]), labels.shape
+        )
+        return int(z) + self.slabs[index][0], int(y), int(x)
+
+    def map(self, values: np.ndarray) -> sitk.Image:
+        """
+        An image of a value per label.
+
+        Parameters
+        ----------
+        values : np.ndarray
+            The value of every label, with the value of the background at index 0.
+
+        Returns
+        -------
+        sitk.Image
+            The image of the value of the label of every voxel, with the pixel type of `values` and the geometry of
+            the labelled image.
+        """
+        output = np.empty(self.image.GetSize()[::-1], dtype=values.dtype)
+        for index, (start, stop, _, _) in enumerate(self.slabs):
+            labels = self._slab_labels(index)
+            offset = self.offsets[index]
+            table = values[
+                self.lookup[offset : offset + int(labels.max(initial=0)) + 1]
+            ]
+            table[0] = values[0]
+            output[start:stop] = table[labels]
+
+        image = sitk.GetImageFromArray(output)
+        image.CopyInformation(self.image)
+        return image
+
+
+def largest_connected_component(
+    image: sitk.Image,
+    slab_size: Optional[int] = None,
+    roi: Optional[tuple] = None,
+    value: int = 1,
+) -> sitk.Image:
+    """
+    The largest fully connected component of the foreground of a binary image, like `sitk.ConnectedComponent`
+    followed by `sitk.RelabelComponent`: on ties, the component whose first voxel comes first in raster order.
+
+    Parameters
+    ----------
+    image : sitk.Image
+        The binary image, in which all nonzero voxels are foreground.
+    slab_size : int
+        The number of z slices of a slab, see `SlabLabels`. None to label the whole image at once.
+    roi : tuple
+        If the image was cropped from a larger image in which all voxels outside of the crop are foreground, the
+        (index, size, size of the larger image) of the crop, in x, y, z order. Those voxels join the components on
+        the faces of the crop, and the largest component is chosen as it would be in the larger image, see
+        `largest_component_in_roi`.
+    value : int
+        The value of the voxels of the component in the output.
+
+    Returns
+    -------
+    sitk.Image
+        The uint8 image with `value` on the voxels of the largest component and 0 elsewhere.
+    """
+    # numpy axes are in z, y, x order
+    shape = image.GetSize()[::-1]
+
+    if slab_size is None:
+        image_conn = sitk.ConnectedComponent(image, image, True)
+        labels = sitk.GetArrayViewFromImage(image_conn)
+
+        # the size of every label, counted a few slices at a time so that neither a relabelled nor a 64 bit copy of
+        # the labels is needed
+        sizes = np.zeros(int(labels.max()) + 1, dtype=np.int64)
+        for start in range(0, labels.shape[0], 16):
+            sizes += np.bincount(
+                labels[start : start + 16].ravel(), minlength=sizes.size
+            )
+
+        def face_labels(axis, side):
+            return set(np.unique(labels.take(side, axis=axis))) - {0}
+
+        def first_label_voxel(label):
+            return np.unravel_index(np.argmax(labels == label), shape)
+
+    else:
+        # the same labels, a slab at a time
+        slab_labels = SlabLabels(image, slab_size)
+        sizes = slab_labels.sizes
+
+        def face_labels(axis, side):
+            return slab_labels.faces[axis, side]
+
+        first_label_voxel = slab_labels.first_voxel
+
+    if roi is None:
+        # the largest label, on ties the lowest one like `sitk.RelabelComponent`
+        largest = int(np.argmax(sizes[1:])) + 1 if sizes.size > 1 else 1
+        if slab_size is None:
+            return sitk.BinaryThreshold(image_conn, largest, largest, value, 0)
+        largest = {largest}
+
+    else:
+        largest = largest_component_in_roi(
+            sizes, face_labels, first_label_voxel, shape, roi
+        )
+
+    if slab_size is not None:
+        values = np.zeros(sizes.size, dtype=np.uint8)
+        values[list(largest)] = value
+        return slab_labels.map(values)
+
+    array = np.isin(labels, list(largest)).view(np.uint8)
+    array *= value
+    largest_image = sitk.GetImageFromArray(array)
+    largest_image.CopyInformation(image)
+    return largest_image
+
+
+def largest_component_in_roi(
+    sizes: np.ndarray,
+    face_labels: Callable[[int, int], set],
+    first_label_voxel: Callable[[int], Tuple[int, int, int]],
+    shape: Tuple[int, int, int],
+    roi: tuple,
+) -> set:
+    """
+    The labels of the largest connected component of an image cropped from a larger image in which all voxels
+    outside of the crop are foreground, see `largest_connected_component`.
+
+    Parameters
+    ----------
+    sizes : np.ndarray
+        The number of voxels of every label of the crop.
+    face_labels : Callable[[int, int], set]
+        The set of labels on a face of the crop, by numpy axis and side, 0 for the first and -1 for the last slice.
+    first_label_voxel : Callable[[int], Tuple[int, int, int]]
+        The index of the first voxel of a label in the crop, in raster order.
+    shape : Tuple[int, int, int]
+        The shape of the crop, in numpy's z, y, x order.
+    roi : tuple
+        The (index, size, size of the larger image) of the crop, in x, y, z order.
+
+    Returns
+    -------
+    set
+        The labels of the crop that are part of the largest component.
+    """
+    offset = np.array(roi[0][::-1])
+    full_shape = np.array(roi[2][::-1])
+    end = offset + shape
+
+    # the voxels outside of the crop are the slabs beyond the faces of the crop that are not on the edge of the image,
+    # each joining the labels on its face, as (labels, number of voxels, first voxel)
+    slabs, axes = [], set()
+    for axis in range(3):
+        cross_section = np.prod(full_shape) // full_shape[axis]
+        if offset[axis] > 0:
+            face = face_labels(axis, 0)
+            slabs.append((face, offset[axis] * cross_section, 0))
+            axes.add(axis)
+        if end[axis] < full_shape[axis]:
+            face = face_labels(axis, -1)
+            corner = [end[axis] if a == axis else 0 for a in range(3)]
+            slabs.append(
+                (
+                    face,
+                    (full_shape[axis] - end[axis]) * cross_section,
+                    np.ravel_multi_index(corner, full_shape),
+                )
+            )
+            axes.add(axis)
+
+    # slabs on different axes meet beyond the edges of the crop, and the two slabs of one axis meet if they join the
+    # same label
+    if len(axes) > 1 or (len(slabs) == 2 and slabs[0][0] & slabs[1][0]):
+        slabs = [
+            (
+                set().union(*[face for face, _, _ in slabs]),
+                np.prod(full_shape) - np.prod(shape),
+                min(first_outside for _, _, first_outside in slabs),
+            )
+        ]
+
+    # the components of the full image as (size, labels, first voxel outside of the crop or None)
+    components = [
+        (outside + sum(sizes[label] for label in face), face, first_outside)
+        for face, outside, first_outside in slabs
+    ]
+    joined = set().union(*[face for face, _, _ in slabs])
+    components += [
+        (sizes[label], {label}, None)
+        for label in range(1, sizes.size)
+        if label not in joined
+    ]
+
+    def first_voxel(component):
+        # the labels are numbered in the raster order of their first voxel, so the first voxel of a component inside
+        # of the crop is that of its lowest label
+        _, face, first_outside = component
+        first = [] if first_outside is None else [first_outside]
+        if face:
+            crop_index = first_label_voxel(min(face))
+            first.append(np.ravel_multi_index(tuple(offset + crop_index), full_shape))
+        return min(first)
+
+    # the largest component, on ties the one whose first voxel comes first in raster order, like
+    # `sitk.RelabelComponent`
+    largest = set()
+    if components:
+        size = max(component[0] for component in components)
+        largest = min(
+            [component for component in components if component[0] == size],
+            key=first_voxel,
+        )[1]
+
+    return largest
+
+
+def _offset_labels(labels: np.ndarray, offset: int) -> np.ndarray:
+    """
+    Labels of a slab numbered on from `offset`, as 64 bit integers, with the background left at 0.
+    """
+    labels = labels.astype(np.int64)
+    labels[labels > 0] += offset
+    return labels
+
+
+def _reader(fn: str) -> sitk.ImageFileReader:
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(fn)
+    return reader
+
+
+def _set_geometry(image: sitk.Image, origin: tuple, spacing: tuple, direction: tuple):
+    image.SetOrigin(origin)
+    image.SetSpacing(spacing)
+    image.SetDirection(direction)
@@ -9,12 +9,19 @@ Description: Test automatic periosteal contour.
 
 import os
 import shutil
+import itertools
 import tempfile
 import unittest
 import numpy as np
 import SimpleITK as sitk
 
 from ormir_xct.autocontour.autocontour import autocontour
+from ormir_xct.autocontour.AutocontourKnee import (
+    AutocontourKnee,
+    COMMON_PARAMETERS,
+    STEP_PARAMETERS,
+)
+from ormir_xct.autocontour.stage_graph import StageCache
 
 
 class TestAutocontour(unittest.TestCase):
@@ -88,3 +95,457 @@ class TestAutocontour(unittest.TestCase):
         test_mask_array = sitk.GetArrayFromImage(mask)
         true_mask_array = sitk.GetArrayFromImage(true_joint_mask)
         np.testing.assert_array_equal(true_mask_array, test_mask_array)
+
+
+def create_knee_phantom(shape=(60, 50, 50), seed=0, bone_radius=20):
+    """
+    Two noisy bones, cylinders with a cortical shell and a sparse trabecular
+    interior, separated by a joint space, as a density image.
+    """
+    rng = np.random.default_rng(seed)
+    z, y, x = np.indices(shape)
+    radius = np.hypot(y - shape[1] / 2, x - shape[2] / 2)
+    gap = shape[0] // 2
+    bone = (radius < bone_radius) & (z > 3) & (z < shape[0] - 4)
+    bone &= np.abs(z - gap) > 3
+    marrow = (radius < bone_radius - 4) & (z > 6) & (z < shape[0] - 7)
+    marrow &= np.abs(z - gap) > 6
+
+    array = np.where(bone & ~marrow, 1200.0, 0.0)
+    array[marrow & (rng.random(shape) < 0.3)] = 900.0
+    array += rng.normal(0, 50, shape)
+
+    image = sitk.GetImageFromArray(array.astype(np.float32))
+    image.SetSpacing([0.0607] * 3)
+    return image
+
+
+class TestAutocontourKneeMorphology(unittest.TestCase):
+    def masks(self, image, morphology, **kwargs):
+        auto_contour = AutocontourKnee(morphology=morphology, **kwargs)
+        prx_mask = auto_contour.get_periosteal_mask(image, 1)
+        dst_mask = auto_contour.get_periosteal_mask(image, 2)
+        endo_mask = auto_contour.get_endosteal_mask(image, prx_mask)
+        return [prx_mask, dst_mask, endo_mask]
+
+    def check_backends(self, image):
+        for ball, edt in zip(self.masks(image, "ball"), self.masks(image, "edt")):
+            self.assertEqual(ball.GetPixelID(), edt.GetPixelID())
+            self.assertEqual(ball.GetSpacing(), edt.GetSpacing())
+            np.testing.assert_array_equal(
+                sitk.GetArrayFromImage(ball), sitk.GetArrayFromImage(edt)
+            )
+
+    def test_edt_morphology_matches_ball(self):
+        image = create_knee_phantom()
+        self.check_backends(image)
+        self.assertGreater(sitk.GetArrayFromImage(self.masks(image, "edt")[0]).max(), 0)
+
+    def test_edt_morphology_matches_ball_on_aim(self):
+        import itk
+        from ormir_xct.util.file_reader import file_reader
+
+        if not hasattr(itk, "ScancoImageIO"):
+            self.skipTest("ITK was built without the Scanco image IO")
+        aim_path = os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            "data",
+            "test_aim.AIM",
+        )
+        self.check_backends(file_reader(aim_path))
+
+    def test_roi_crop(self):
+        # smaller radii, so that the regions of interest are smaller than the
+        # image on a small phantom
+        radii = {
+            "peri_s1_radius": 8,
+            "peri_s2_radius": 4,
+            "peri_s4_open_radius": 4,
+            "peri_s4_close_radius": 6,
+            "endo_open_close_radius": 6,
+            "endo_close_radius": 12,
+        }
+        image = create_knee_phantom((50, 90, 90), bone_radius=20)
+        auto_contour = AutocontourKnee(**radii)
+        peri = auto_contour.get_periosteal_mask(image, 1)
+        self.assertIsNotNone(auto_contour._get_roi(peri, 12, [(550, 10000)]))
+        for morphology in ["ball", "edt"]:
+            with self.subTest(morphology=morphology):
+                cropped = self.masks(image, morphology, roi_crop=True, **radii)
+                uncropped = self.masks(image, morphology, roi_crop=False, **radii)
+                for a, b in zip(cropped, uncropped):
+                    self.assertEqual(a.GetSize(), b.GetSize())
+                    self.assertEqual(a.GetOrigin(), b.GetOrigin())
+                    self.assertEqual(a.GetPixelID(), b.GetPixelID())
+                    np.testing.assert_array_equal(
+                        sitk.GetArrayFromImage(a), sitk.GetArrayFromImage(b)
+                    )
+
+    def test_largest_connected_component_in_roi(self):
+        # the voxels outside of the crop are foreground, and on ties the
+        # component with the first voxel wins, so small images are a hard case
+        auto_contour = AutocontourKnee()
+        rng = np.random.default_rng(0)
+        for _ in range(300):
+            shape = rng.integers(3, 9, 3)
+            array = (rng.random(shape) < rng.uniform(0.3, 0.8)).astype(np.uint8)
+            lower = [int(rng.integers(0, n)) for n in shape]
+            upper = [int(rng.integers(l + 1, n + 1)) for l, n in zip(lower, shape)]
+            crop = tuple(slice(l, u) for l, u in zip(lower, upper))
+            outside = np.ones(shape, dtype=bool)
+            outside[crop] = False
+            array[outside] = 1
+            image = sitk.GetImageFromArray(array * auto_contour.in_value)
+
+            roi = (
+                lower[::-1],
+                [u - l for l, u in zip(lower, upper)][::-1],
+                image.GetSize(),
+            )
+            expected = auto_contour._get_largest_connected_component(image)
+            for slab_size in [None, 2]:
+                auto_contour.slab_size = slab_size
+                result = auto_contour._get_largest_connected_component(
+                    auto_contour._crop(image, roi), roi
+                )
+                np.testing.assert_array_equal(
+                    sitk.GetArrayFromImage(result),
+                    sitk.GetArrayFromImage(expected)[crop],
+                )
+            auto_contour.slab_size = None
+
+    def test_periosteal_masks(self):
+        image = create_knee_phantom()
+        auto_contour = AutocontourKnee(morphology="edt")
+        expected = [auto_contour.get_periosteal_mask(image, c) for c in [1, 2]]
+        for n_threads in [None, 1]:
+            with self.subTest(n_threads=n_threads):
+                masks = auto_contour.get_periosteal_masks(image, [1, 2], n_threads)
+                self.assertEqual(len(masks), 2)
+                for mask, reference in zip(masks, expected):
+                    np.testing.assert_array_equal(
+                        sitk.GetArrayFromImage(mask),
+                        sitk.GetArrayFromImage(reference),
+                    )
+        self.assertEqual(auto_contour.get_periosteal_masks(image, []), [])
+
+    def test_get_masks(self):
+        image = create_knee_phantom()
+        auto_contour = AutocontourKnee(morphology="edt")
+        peris = auto_contour.get_periosteal_masks(image, [1, 2], n_threads=1)
+        endos = [auto_contour.get_endosteal_mask(image, peri) for peri in peris]
+        masks, report = auto_contour.get_masks(image, [1, 2], return_report=True)
+        self.assertEqual(len(masks), 2)
+        for (peri, endo), expected in zip(masks, zip(peris, endos)):
+            for mask, reference in zip([peri, endo], expected):
+                self.assertEqual(mask.GetPixelID(), sitk.sitkUInt8)
+                self.assertEqual(mask.GetOrigin(), reference.GetOrigin())
+                np.testing.assert_array_equal(
+                    sitk.GetArrayFromImage(mask), sitk.GetArrayFromImage(reference)
+                )
+        stages = [stage["stage"] for stage in report["stages"]]
+        self.assertEqual(stages[:3], ["labels", "peri_1_s1", "peri_2_s1"])
+        self.assertLess(stages.index("endo_1"), stages.index("peri_2"))
+        self.assertEqual(
+            report["peak_rss"], max(stage["peak_rss"] for stage in report["stages"])
+        )
+
+    def test_unknown_morphology(self):
+        with self.assertRaises(ValueError):
+            AutocontourKnee(morphology="chamfer")
+
+    def test_pyramid_resampling(self):
+        # a mask made of whole coarse voxels survives the roundtrip
+        for factor in [2, 4]:
+            with self.subTest(factor=factor):
+                auto_contour = AutocontourKnee(pyramid_factor=factor)
+                rng = np.random.default_rng(factor)
+                blocks = rng.random((3, 4, 5)) < 0.5
+                array = 127 * np.kron(blocks, np.ones([factor] * 3, dtype=np.uint8))
+                mask = sitk.GetImageFromArray(array)
+                mask.SetSpacing([0.0607] * 3)
+                mask.SetOrigin([1.0, 2.0, 3.0])
+                coarse = auto_contour._downsample(mask)
+                self.assertEqual(coarse.GetSize(), (5, 4, 3))
+                upsampled = auto_contour._upsample(coarse, mask)
+                self.assertEqual(upsampled.GetPixelID(), mask.GetPixelID())
+                np.testing.assert_array_equal(sitk.GetArrayFromImage(upsampled), array)
+
+                # sizes that are not multiples of the factor are padded
+                coarse = auto_contour._downsample(mask[:-1, :, 1:])
+                self.assertEqual(coarse.GetSize(), (5, 4, 3))
+
+    def test_pyramid_morphology(self):
+        z, y, x = np.indices((70, 70, 70))
+        array = (z - 35) ** 2 + (y - 35) ** 2 + (x - 30) ** 2 < 22**2
+        array |= (np.abs(z - 35) < 4) & (np.abs(y - 35) < 20) & (x > 40)
+        mask = sitk.GetImageFromArray(127 * array.astype(np.uint8))
+        full_resolution = AutocontourKnee()
+        pyramid = AutocontourKnee(pyramid_factor=2, pyramid_min_radius=5)
+        for operation in ["dilate", "erode", "opening", "closing"]:
+            with self.subTest(operation=operation):
+                expected = full_resolution._morphology(mask, operation, 10)
+                result = pyramid._morphology(mask, operation, 10)
+                self.assertEqual(result.GetPixelID(), mask.GetPixelID())
+                expected = sitk.GetArrayFromImage(expected) > 0
+                result = sitk.GetArrayFromImage(result) > 0
+                dice = 2 * (expected & result).sum() / (expected.sum() + result.sum())
+                self.assertGreater(dice, 0.9)
+                if operation in ["dilate", "closing"]:
+                    self.assertTrue(result[array].all())
+                else:
+                    self.assertFalse(result[~array].any())
+
+        # radii below pyramid_min_radius are computed at full resolution
+        np.testing.assert_array_equal(
+            sitk.GetArrayFromImage(pyramid._dilate(mask, 4)),
+            sitk.GetArrayFromImage(full_resolution._dilate(mask, 4)),
+        )
+
+    def test_evaluate_pyramid(self):
+        image = create_knee_phantom()
+        auto_contour = AutocontourKnee(morphology="edt", pyramid_factor=2)
+        report = auto_contour.evaluate_pyramid(image, [1])
+        self.assertEqual(set(report["time"]), {"pyramid", "full"})
+        for mask in ["periosteal", "endosteal"]:
+            measures = report[1][mask]
+            self.assertGreater(measures["dice"], 0.9)
+            self.assertLessEqual(measures["jaccard"], measures["dice"])
+            self.assertLessEqual(
+                measures["mean_distance"], measures["hausdorff"] + 1e-6
+            )
+            self.assertLess(measures["hausdorff"], 4 * 0.0607)
+        self.assertEqual(auto_contour.pyramid_factor, 2)
+
+    def test_evaluate_pyramid_identical_masks(self):
+        # no radius is large enough for the pyramid, so the masks are the same
+        auto_contour = AutocontourKnee(
+            morphology="edt", pyramid_factor=2, pyramid_min_radius=1000
+        )
+        report = auto_contour.evaluate_pyramid(create_knee_phantom(), [1])
+        for mask in ["periosteal", "endosteal"]:
+            measures = report[1][mask]
+            self.assertEqual(measures["dice"], 1)
+            self.assertEqual(measures["different_voxels"], 0)
+            self.assertEqual(measures["mean_distance"], 0)
+            self.assertEqual(measures["hausdorff"], 0)
+
+    def test_slice_connected_components(self):
+        auto_contour = AutocontourKnee()
+        rng = np.random.default_rng(0)
+        array = 127 * (rng.random((5, 30, 30)) < 0.5).astype(np.uint8)
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing([0.0607] * 3)
+        result = auto_contour._slice_connected_components(image)
+        self.assertEqual(result.GetSpacing(), image.GetSpacing())
+        for k in range(array.shape[0]):
+            img_slice = sitk.GetImageFromArray(array[k])
+            expected = auto_contour._get_largest_connected_component(img_slice)
+            np.testing.assert_array_equal(
+                sitk.GetArrayFromImage(result)[k], sitk.GetArrayFromImage(expected)
+            )
+
+        result = auto_contour._slice_connected_components(image, min_size=5)
+        self.assertGreater(
+            sitk.GetArrayFromImage(result).sum(),
+            sitk.GetArrayFromImage(
+                auto_contour._slice_connected_components(image)
+            ).sum(),
+        )
+
+    def test_endo_slice_cl(self):
+        image = create_knee_phantom()
+        default, slice_cl = [
+            self.masks(image, "edt", endo_slice_cl=endo_slice_cl)[2]
+            for endo_slice_cl in [False, True]
+        ]
+        self.assertEqual(default.GetSize(), slice_cl.GetSize())
+        # removing trabecular voxels can only add to the cortical mask
+        default = sitk.GetArrayFromImage(default) > 0
+        slice_cl = sitk.GetArrayFromImage(slice_cl) > 0
+        self.assertTrue(slice_cl[default].all())
+        self.assertLess((slice_cl != default).sum(), 0.01 * default.size)
+
+    def test_invalid_pyramid_factor(self):
+        for factor in [0, 1.5]:
+            with self.assertRaises(ValueError):
+                AutocontourKnee(pyramid_factor=factor)
+
+    def test_slab_size(self):
+        # the masks are identical to those of the whole image, also with slabs
+        # thinner than the reach of the filters, and from the image file
+        image = create_knee_phantom()
+        expected = AutocontourKnee(morphology="edt").get_masks(image, [1, 2])
+        with tempfile.TemporaryDirectory() as directory:
+            fn = os.path.join(directory, "image.nii")
+            sitk.WriteImage(image, fn)
+            for slab_size, img in [(16, image), (25, fn)]:
+                with self.subTest(slab_size=slab_size):
+                    auto_contour = AutocontourKnee(
+                        morphology="edt", slab_size=slab_size
+                    )
+                    masks = auto_contour.get_masks(img, [1, 2])
+                    for pair, reference in zip(masks, expected):
+                        for mask, reference_mask in zip(pair, reference):
+                            self.assertEqual(
+                                mask.GetPixelID(), reference_mask.GetPixelID()
+                            )
+                            self.assertEqual(mask.GetSize(), reference_mask.GetSize())
+                            np.testing.assert_array_equal(
+                                sitk.GetArrayFromImage(mask),
+                                sitk.GetArrayFromImage(reference_mask),
+                            )
+
+        # the steps with connected components
+        whole, slabs = AutocontourKnee(), AutocontourKnee(slab_size=7)
+        rng = np.random.default_rng(0)
+        mask = sitk.GetImageFromArray(
+            127 * (rng.random((40, 30, 30)) < 0.1).astype(np.uint8)
+        )
+        for result, reference in [
+            (slabs._label_bones(image), whole._label_bones(image)),
+            (
+                slabs._extract_large_regions(mask, 5),
+                whole._extract_large_regions(mask, 5),
+            ),
+            (slabs._dilate(mask, 3), whole._dilate(mask, 3)),
+        ]:
+            self.assertEqual(result.GetPixelID(), reference.GetPixelID())
+            np.testing.assert_array_equal(
+                sitk.GetArrayFromImage(result), sitk.GetArrayFromImage(reference)
+            )
+
+        for parameters in [
+            {"slab_size": 0},
+            {"slab_size": 1.5},
+            {"slab_size": 16, "pyramid_factor": 2},
+        ]:
+            with self.assertRaises(ValueError):
+                AutocontourKnee(**parameters)
+
+    def test_uint8_intermediates(self):
+        # the binary images and the labels stay uint8, with the values of the
+        # SimpleITK filters they replace
+        auto_contour = AutocontourKnee()
+        rng = np.random.default_rng(0)
+        mask = sitk.GetImageFromArray(
+            127 * (rng.random((40, 60, 60)) < 0.1).astype(np.uint8)
+        )
+        other = sitk.GetImageFromArray(
+            127 * (rng.random((40, 60, 60)) < 0.5).astype(np.uint8)
+        )
+
+        labels = sitk.ConnectedComponent(mask, True)
+        large = sitk.RelabelComponent(labels, 5, True) > 0
+        # sparse enough that more than 255 components survive the smoothing
+        image = sitk.GetImageFromArray(
+            12700 * (rng.random((40, 60, 60)) < 0.01).astype(np.float32)
+        )
+        segmented = auto_contour._gaussian_and_threshold(
+            image,
+            auto_contour.peri_s1_sigma,
+            auto_contour.peri_s1_support,
+            auto_contour.peri_s1_lower,
+            auto_contour.peri_s1_upper,
+        )
+        ranked = sitk.GetArrayFromImage(
+            sitk.RelabelComponent(sitk.ConnectedComponent(segmented, True))
+        )
+        self.assertGreater(ranked.max(), 255)
+        ranked[ranked > 255] = 0
+
+        for result, expected in [
+            (auto_contour._label_bones(image), ranked),
+            (auto_contour._extract_large_regions(mask, 5), 127 * large),
+            (auto_contour._invert_binary_image(mask), 127 * (mask == 0)),
+            (auto_contour._select_label(labels, 3), 127 * (labels == 3)),
+            (
+                auto_contour._and_not(mask, other),
+                127 * sitk.And(mask, sitk.Not(other)),
+            ),
+        ]:
+            self.assertEqual(result.GetPixelID(), sitk.sitkUInt8)
+            if isinstance(expected, sitk.Image):
+                expected = sitk.GetArrayFromImage(expected)
+            np.testing.assert_array_equal(sitk.GetArrayFromImage(result), expected)
+
+    def test_sweep(self):
+        image = create_knee_phantom()
+        auto_contour = AutocontourKnee(morphology="edt", profile=True)
+        grid = {"peri_s4_close_radius": [12, 16], "endo_close_radius": [40, 50]}
+        cache = StageCache()
+        results = auto_contour.sweep(image, grid, cache=cache)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(auto_contour.peri_s4_close_radius, 16)
+
+        for (setting, masks), values in zip(results, itertools.product(*grid.values())):
+            parameters = dict(zip(grid, values))
+            self.assertEqual(
+                setting.get_parameters(),
+                {**auto_contour.get_parameters(), **parameters},
+            )
+            expected = AutocontourKnee(morphology="edt", **parameters).get_masks(image)
+            for pair, expected_pair in zip(masks, expected):
+                for mask, reference in zip(pair, expected_pair):
+                    np.testing.assert_array_equal(
+                        sitk.GetArrayFromImage(mask), sitk.GetArrayFromImage(reference)
+                    )
+
+        # only the stages that read a parameter that changed run again
+        calls = {}
+        for event in auto_contour.profiler.events:
+            calls[event["name"]] = calls.get(event["name"], 0) + 1
+        self.assertEqual(calls["labels"], 1)
+        self.assertEqual(calls["peri_1_s2"], 1)
+        self.assertEqual(calls["peri_1_s4"], 2)
+        self.assertEqual(calls["endo_1_cort_final"], 4)
+        self.assertEqual(
+            cache.misses, sum(calls[name] for name in calls if "/" not in name)
+        )
+
+        # a second sweep of the same image only finds its regions of interest
+        # again, which are the same, and reads all else from the cache
+        auto_contour.profiler.clear()
+        auto_contour.sweep(image, {"endo_close_radius": 50}, cache=cache)
+        names = [event["name"] for event in auto_contour.profiler.events]
+        self.assertEqual(
+            sorted(names), ["endo_1_roi", "endo_2_roi", "peri_1_roi", "peri_2_roi"]
+        )
+
+    def test_parameters_yaml(self):
+        auto_contour = AutocontourKnee(endo_close_radius=30, morphology="edt")
+        with tempfile.TemporaryDirectory() as directory:
+            fn = os.path.join(directory, "parameters.yaml")
+            auto_contour.save_parameters_to_yaml(fn)
+            loaded = AutocontourKnee()
+            loaded.load_parameters_from_yaml(fn)
+            self.assertEqual(loaded.get_parameters(), auto_contour.get_parameters())
+
+            # a grid for `sweep` in the same format
+            with open(fn, "w") as f:
+                f.write("endo_close_radius: [20, 30]\nmorphology: edt\n")
+            image = create_knee_phantom()
+            results = AutocontourKnee().sweep(image, fn, components=[1])
+            self.assertEqual(
+                [setting.endo_close_radius for setting, _ in results], [20, 30]
+            )
+            self.assertEqual(results[0][0].morphology, "edt")
+
+            with open(fn, "w") as f:
+                f.write("endo_closing_radius: 20\n")
+            with self.assertRaises(ValueError):
+                loaded.load_parameters_from_yaml(fn)
+        with self.assertRaises(ValueError):
+            loaded.set_parameters(morphology="chamfer")
+        self.assertEqual(loaded.morphology, "edt")
+
+    def test_step_parameters(self):
+        # every parameter is read by some stage, so the cache of `sweep` never
+        # returns the output of a stage computed with other parameters
+        auto_contour = AutocontourKnee()
+        names = set(COMMON_PARAMETERS).union(*STEP_PARAMETERS.values())
+        self.assertTrue(set(auto_contour.get_parameters()) <= names)
+        for name in names:
+            self.assertTrue(hasattr(auto_contour, name), name)
+        for step in STEP_PARAMETERS:
+            self.assertTrue(callable(getattr(auto_contour, step)), step)
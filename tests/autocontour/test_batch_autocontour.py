@@ -0,0 +1,239 @@
+"""
+test_batch_autocontour.py
+
+Description: Test that the batch autocontour contours every scan of a
+             directory or manifest like autocontour does, skips the scans
+             whose masks are up to date, and goes on when a scan fails or
+             crashes its worker process.
+"""
+
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import SimpleITK as sitk
+
+from ormir_xct.autocontour import batch_autocontour as batch
+from ormir_xct.autocontour.autocontour import autocontour, output_paths
+from ormir_xct.autocontour.AutocontourKnee import AutocontourKnee
+from tests.autocontour.test_autocontour import create_knee_phantom
+
+# smaller radii, so that the scans are contoured quickly
+PARAMETERS = {
+    "peri_s1_radius": 8,
+    "peri_s2_radius": 4,
+    "peri_s4_open_radius": 4,
+    "peri_s4_close_radius": 6,
+    "endo_open_close_radius": 6,
+    "endo_close_radius": 12,
+}
+
+
+def create_knee_scan(seed=0):
+    """
+    The knee phantom in HU, with the default calibration of autocontour.
+    """
+    density = create_knee_phantom(seed=seed)
+    calibration = batch.CALIBRATION
+    array = sitk.GetArrayFromImage(density)
+    attenuation = (array - calibration["rescale_intercept"]) / calibration[
+        "rescale_slope"
+    ]
+    image = sitk.GetImageFromArray(
+        (attenuation / calibration["mu_water"] * 1000 - 1000).astype(np.float32)
+    )
+    image.CopyInformation(density)
+    return image
+
+
+def crashing_contour_scan(scan, *args):
+    # kills the worker process on the scan named crash
+    if "crash" in os.path.basename(scan["image_path"]):
+        os._exit(1)
+    return CONTOUR_SCAN(scan, *args)
+
+
+def truncating_write_image(image, fn, *args):
+    # kills the worker process halfway through writing a _DST_MASK
+    WRITE_IMAGE(image, fn, *args)
+    if "_DST_MASK" in os.path.basename(fn):
+        with open(fn, "r+b") as f:
+            f.truncate(os.path.getsize(fn) // 2)
+        os._exit(1)
+
+
+def killed_contour_scan(scan, *args):
+    # kills the worker process while writing the masks of the scan knee_b
+    if "knee_b" in os.path.basename(scan["image_path"]):
+        with mock.patch.object(batch.sitk, "WriteImage", truncating_write_image):
+            return CONTOUR_SCAN(scan, *args)
+    return CONTOUR_SCAN(scan, *args)
+
+
+CONTOUR_SCAN = batch.contour_scan
+WRITE_IMAGE = sitk.WriteImage
+
+
+class TestBatchAutocontour(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.parameters = os.path.join(self.test_dir, "parameters.yaml")
+        AutocontourKnee(**PARAMETERS).save_parameters_to_yaml(self.parameters)
+
+        self.scan_dir = os.path.join(self.test_dir, "scans")
+        os.makedirs(self.scan_dir)
+        for seed, name in enumerate(["knee_a.nii", "knee_b.mha"]):
+            sitk.WriteImage(create_knee_scan(seed), os.path.join(self.scan_dir, name))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def run_batch(self, scans, **kwargs):
+        return batch.batch_autocontour(
+            scans, parameters=self.parameters, verbose=False, **kwargs
+        )
+
+    def test_directory(self):
+        # a file that is not an image, and one that is not a scan
+        with open(os.path.join(self.scan_dir, "broken.nii"), "w") as f:
+            f.write("not an image")
+        sitk.WriteImage(
+            sitk.Image([4, 4, 4], sitk.sitkUInt8),
+            os.path.join(self.scan_dir, "old_MASK.nii"),
+        )
+        scans = batch.find_scans(self.scan_dir)
+        self.assertEqual(
+            [os.path.basename(scan["image_path"]) for scan in scans],
+            ["broken.nii", "knee_a.nii", "knee_b.mha"],
+        )
+
+        summary = os.path.join(self.test_dir, "summary.csv")
+        rows = self.run_batch(scans, n_workers=2, sitk_threads=1, summary_path=summary)
+        self.assertEqual(
+            [row["status"] for row in rows], ["failed", "done", "done"], rows
+        )
+        self.assertIn("RuntimeError", rows[0]["error"])
+        with open(rows[0]["log_path"]) as f:
+            self.assertIn("Traceback", f.read())
+
+        # the same masks as autocontour
+        auto_contour = AutocontourKnee(**PARAMETERS)
+        for scan, row in zip(scans[1:], rows[1:]):
+            image = sitk.ReadImage(scan["image_path"], sitk.sitkFloat32)
+            expected = autocontour(image, auto_contour=auto_contour)
+            paths = output_paths(scan["image_path"])
+            for name, mask in zip(["dst_mask", "prx_mask", "mask"], expected):
+                np.testing.assert_array_equal(
+                    sitk.GetArrayFromImage(sitk.ReadImage(paths[name])),
+                    sitk.GetArrayFromImage(mask),
+                )
+            voxels = int((sitk.GetArrayViewFromImage(expected[1]) > 0).sum())
+            self.assertEqual(row["prx_voxels"], voxels)
+            self.assertAlmostEqual(
+                row["prx_volume"], voxels * np.prod(image.GetSpacing())
+            )
+            self.assertTrue(os.path.isfile(row["log_path"]))
+
+        with open(summary, newline="") as f:
+            table = list(csv.DictReader(f))
+        self.assertEqual([row["status"] for row in table], ["failed", "done", "done"])
+        self.assertEqual(int(table[1]["prx_voxels"]), rows[1]["prx_voxels"])
+
+    def test_compressed_names(self):
+        for name in ["knee_c.nii.gz", "knee_c_MASK.nii.gz"]:
+            sitk.WriteImage(create_knee_scan(), os.path.join(self.scan_dir, name))
+        scans = batch.find_scans(self.scan_dir)
+        self.assertEqual(
+            [os.path.basename(scan["image_path"]) for scan in scans],
+            ["knee_a.nii", "knee_b.mha", "knee_c.nii.gz"],
+        )
+
+        # the compound extension is stripped from the masks and the log
+        image_path = scans[2]["image_path"]
+        self.assertEqual(
+            output_paths(image_path)["prx_mask"],
+            os.path.join(self.scan_dir, "knee_c_PRX_MASK.nii"),
+        )
+        self.assertEqual(
+            batch.log_path(image_path),
+            os.path.join(self.scan_dir, "knee_c_AUTOCONTOUR.log"),
+        )
+
+    def test_resume(self):
+        scans = batch.find_scans(self.scan_dir)
+        output_dir = os.path.join(self.test_dir, "masks")
+        rows = self.run_batch(scans, output_dir=output_dir)
+        self.assertEqual([row["status"] for row in rows], ["done", "done"])
+        self.assertTrue(os.path.isfile(os.path.join(output_dir, "knee_a_PRX_MASK.nii")))
+
+        rows = self.run_batch(scans, output_dir=output_dir)
+        self.assertEqual([row["status"] for row in rows], ["skipped", "skipped"])
+
+        # a scan that changed after its masks were written
+        masks = output_paths(scans[1]["image_path"], output_dir)
+        modified = os.path.getmtime(masks["prx_mask"])
+        os.utime(scans[1]["image_path"], (modified + 10, modified + 10))
+        rows = self.run_batch(scans, output_dir=output_dir)
+        self.assertEqual([row["status"] for row in rows], ["skipped", "done"])
+
+        rows = self.run_batch(scans, output_dir=output_dir, force=True)
+        self.assertEqual([row["status"] for row in rows], ["done", "done"])
+
+    def test_resume_partially_written(self):
+        scans = batch.find_scans(self.scan_dir)
+        with mock.patch.object(batch, "contour_scan", killed_contour_scan):
+            rows = self.run_batch(scans)
+        self.assertEqual([row["status"] for row in rows], ["done", "failed"])
+
+        # the truncated mask is not in place, and is not taken for a scan
+        masks = output_paths(scans[1]["image_path"])
+        self.assertTrue(os.path.isfile(masks["prx_mask"]))
+        self.assertFalse(os.path.exists(masks["dst_mask"]))
+        self.assertFalse(batch.is_up_to_date(scans[1]["image_path"]))
+        self.assertEqual(batch.find_scans(self.scan_dir), scans)
+
+        rows = self.run_batch(scans)
+        self.assertEqual([row["status"] for row in rows], ["skipped", "done"])
+        sitk.ReadImage(masks["dst_mask"])
+
+    def test_manifest(self):
+        manifest = os.path.join(self.test_dir, "manifest.csv")
+        with open(manifest, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["image_path", "mu_water"])
+            writer.writerow([os.path.join("scans", "knee_b.mha"), "0.25"])
+            writer.writerow([os.path.join("scans", "knee_a.nii"), ""])
+        scans = batch.find_scans(manifest, rescale_slope=1600.0)
+        self.assertEqual(
+            [scan["image_path"] for scan in scans],
+            [
+                os.path.join(self.scan_dir, "knee_b.mha"),
+                os.path.join(self.scan_dir, "knee_a.nii"),
+            ],
+        )
+        self.assertEqual([scan["mu_water"] for scan in scans], [0.25, 0.2409])
+        self.assertEqual([scan["rescale_slope"] for scan in scans], [1600.0] * 2)
+
+        with open(manifest, "w") as f:
+            f.write("path\nknee_a.nii\n")
+        with self.assertRaises(ValueError):
+            batch.find_scans(manifest)
+
+    def test_crashed_worker(self):
+        shutil.copy(
+            os.path.join(self.scan_dir, "knee_a.nii"),
+            os.path.join(self.scan_dir, "crash.nii"),
+        )
+        scans = batch.find_scans(self.scan_dir)
+        with mock.patch.object(batch, "contour_scan", crashing_contour_scan):
+            rows = self.run_batch(scans, n_workers=2)
+        self.assertEqual([row["status"] for row in rows], ["failed", "done", "done"])
+        self.assertIn("died", rows[0]["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+"""
+test_profiling.py
+
+Description: Test that the profiler records nested stages with their time
+             and output size, exports them as JSON and as a Chrome trace,
+             and that AutocontourKnee records its stages when profiling is
+             switched on.
+"""
+
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import SimpleITK as sitk
+
+from ormir_xct.autocontour.AutocontourKnee import AutocontourKnee
+from ormir_xct.autocontour.profiling import (
+    Profiler,
+    profiled,
+    PROFILE_ENVIRONMENT_VARIABLE,
+)
+from ormir_xct.autocontour.stage_graph import StageGraph
+from tests.autocontour.test_autocontour import create_knee_phantom
+
+
+class Pipeline:
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    @profiled("outer")
+    def outer(self, image):
+        return self.inner(image, 2) + 1
+
+    @profiled(lambda image, factor: f"inner_{factor}")
+    def inner(self, image, factor):
+        return image * factor
+
+
+class TestProfiler(unittest.TestCase):
+    def test_nested_stages(self):
+        profiler = Profiler()
+        image = sitk.Image([4, 5, 6], sitk.sitkUInt8)
+        with profiler.stage("top") as event:
+            event["output"] = Pipeline(profiler).outer(image)
+        Pipeline(profiler).inner(image, 3)
+
+        names = [event["name"] for event in profiler.events]
+        self.assertEqual(names, ["top/outer/inner_2", "top/outer", "top", "inner_3"])
+        events = {event["name"]: event for event in profiler.events}
+        self.assertEqual(events["top"]["voxels"], 4 * 5 * 6)
+        self.assertEqual(events["top"]["output_bytes"], 4 * 5 * 6)
+        for event in profiler.events:
+            self.assertGreaterEqual(event["self_seconds"], 0)
+            self.assertLessEqual(event["self_seconds"], event["seconds"])
+        self.assertAlmostEqual(
+            events["top"]["seconds"] - events["top"]["self_seconds"],
+            events["top/outer"]["seconds"],
+        )
+
+    def test_disabled(self):
+        pipeline = Pipeline(None)
+        self.assertEqual(pipeline.outer(1), 3)
+
+    def test_export(self):
+        profiler = Profiler()
+        graph = StageGraph(profiler)
+        graph.add_stage("a", lambda x: x + 1, ["x"])
+        graph.add_stage("b", lambda a: a * 2, ["a"])
+        graph.run({"x": sitk.Image([3, 3, 3], sitk.sitkFloat32)}, ["b"])
+        graph.run({"x": sitk.Image([3, 3, 3], sitk.sitkFloat32)}, ["b"])
+
+        summary = profiler.summary()
+        self.assertEqual({stage["name"] for stage in summary}, {"a", "b"})
+        self.assertEqual([stage["calls"] for stage in summary], [2, 2])
+        self.assertEqual(summary[0]["output_bytes"], 27 * 4)
+
+        with tempfile.TemporaryDirectory() as directory:
+            json_fn = os.path.join(directory, "profile.json")
+            trace_fn = os.path.join(directory, "trace.json")
+            profiler.save_json(json_fn)
+            profiler.save_chrome_trace(trace_fn)
+            with open(json_fn) as f:
+                report = json.load(f)
+            with open(trace_fn) as f:
+                trace = json.load(f)
+
+        self.assertEqual(len(report["events"]), 4)
+        self.assertEqual(len(report["summary"]), 2)
+        events = trace["traceEvents"]
+        self.assertEqual([event["name"] for event in events], ["a", "b", "a", "b"])
+        for event in events:
+            self.assertEqual(event["ph"], "X")
+            self.assertGreaterEqual(event["dur"], 0)
+        self.assertTrue(all(a["ts"] <= b["ts"] for a, b in zip(events, events[1:])))
+
+        profiler.clear()
+        self.assertEqual(profiler.events, [])
+
+
+class TestAutocontourKneeProfiling(unittest.TestCase):
+    def test_profile(self):
+        image = create_knee_phantom()
+        masks = AutocontourKnee(morphology="edt").get_masks(image, [1, 2])
+        auto_contour = AutocontourKnee(morphology="edt", profile=True)
+        profiled_masks = auto_contour.get_masks(image, [1, 2])
+        for expected, result in zip(masks, profiled_masks):
+            for a, b in zip(expected, result):
+                np.testing.assert_array_equal(
+                    sitk.GetArrayFromImage(a), sitk.GetArrayFromImage(b)
+                )
+
+        names = {event["name"] for event in auto_contour.profiler.events}
+        for name in [
+            "labels",
+            "peri_1_s1/dilate_35",
+            "peri_2_s2/gauss",
+            "peri_1_s2/close_cc/largest_cc",
+            "endo_2_cort_final/closing_50",
+        ]:
+            self.assertIn(name, names)
+        # the regions of interest are not images
+        voxels = [event["voxels"] for event in auto_contour.profiler.events]
+        self.assertIn(None, voxels)
+        self.assertEqual(max(filter(None, voxels)), np.prod(image.GetSize()))
+
+    def test_environment_variable(self):
+        with mock.patch.dict(os.environ, {PROFILE_ENVIRONMENT_VARIABLE: "1"}):
+            self.assertIsNotNone(AutocontourKnee().profiler)
+            self.assertIsNone(AutocontourKnee(profile=False).profiler)
+        with mock.patch.dict(os.environ, {PROFILE_ENVIRONMENT_VARIABLE: "0"}):
+            self.assertIsNone(AutocontourKnee().profiler)
+        self.assertIsNotNone(AutocontourKnee(profile=True).profiler)
+
+
+if __name__ == "__main__":
+    unittest.main()
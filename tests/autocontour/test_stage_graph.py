@@ -0,0 +1,199 @@
+"""
+test_stage_graph.py
+
+Description: Test that the stage graph runs its stages in order, releases
+             every value after its last use, stores binary images as
+             sitkUInt8, and only runs the stages whose inputs or settings
+             changed when it memoizes their outputs.
+"""
+
+import gc
+import weakref
+import unittest
+import SimpleITK as sitk
+
+from ormir_xct.autocontour.stage_graph import (
+    StageGraph,
+    StageCache,
+    image_nbytes,
+    value_key,
+)
+
+
+class Value:
+    """
+    A value that can be referenced weakly, to check when it is released.
+    """
+
+    def __init__(self, number):
+        self.number = number
+
+
+class TestStageGraph(unittest.TestCase):
+    def test_run_and_release(self):
+        graph = StageGraph()
+        references = {}
+
+        def stage(name):
+            def function(*inputs):
+                # every input is still alive while it is read
+                value = Value(sum(i.number for i in inputs) + 1)
+                references[name] = weakref.ref(value)
+                alive = {n for n, r in references.items() if r() is not None}
+                released.append((name, alive))
+                return value
+
+            return function
+
+        released = []
+        graph.add_stage("a", stage("a"), ["x"])
+        graph.add_stage("b", stage("b"), ["a"])
+        graph.add_stage("c", stage("c"), ["a", "b"])
+        graph.add_stage("d", stage("d"), ["c"])
+        (d,) = graph.run({"x": Value(0)}, ["d"])
+        gc.collect()
+
+        self.assertEqual(d.number, 5)
+        self.assertEqual([name for name, _ in released], ["a", "b", "c", "d"])
+        # a and b are released after c, and c after d
+        self.assertEqual(released[3][1], {"c", "d"})
+        self.assertIsNone(references["a"]())
+        self.assertIsNone(references["c"]())
+        self.assertEqual([entry["stage"] for entry in graph.report], list("abcd"))
+        self.assertIsNone(graph.peak_rss())
+
+    def test_outputs_are_kept(self):
+        graph = StageGraph()
+        graph.add_stage("a", lambda x: x + 1, ["x"])
+        graph.add_stage("b", lambda a: a * 2, ["a"])
+        self.assertEqual(graph.run({"x": 1}, ["a", "b", "x"]), [2, 4, 1])
+
+    def test_binary_images_are_uint8(self):
+        image = sitk.Image([4, 5, 6], sitk.sitkFloat32)
+        graph = StageGraph()
+        graph.add_stage("gray", lambda x: x + 1.0, ["x"])
+        graph.add_stage(
+            "binary",
+            lambda gray: sitk.Cast(gray > 0.5, sitk.sitkFloat32),
+            ["gray"],
+            binary=True,
+        )
+        gray, binary = graph.run({"x": image}, ["gray", "binary"])
+        self.assertEqual(sitk.GetArrayViewFromImage(binary).min(), 1)
+        self.assertEqual(gray.GetPixelID(), sitk.sitkFloat32)
+        self.assertEqual(binary.GetPixelID(), sitk.sitkUInt8)
+        self.assertEqual(image_nbytes(binary), 4 * 5 * 6)
+        self.assertEqual(graph.report[-1]["held_bytes"], 4 * 5 * 6 * 5)
+
+    def test_record_memory(self):
+        graph = StageGraph()
+        graph.add_stage("a", lambda x: x + 1, ["x"])
+        graph.run({"x": 1}, ["a"], record_memory=True)
+        self.assertGreater(graph.report[0]["peak_rss"], 0)
+        self.assertEqual(graph.peak_rss(), graph.report[0]["peak_rss"])
+
+    def test_invalid_graphs(self):
+        graph = StageGraph()
+        graph.add_stage("a", lambda x: x, ["x"])
+        with self.assertRaises(ValueError):
+            graph.add_stage("a", lambda x: x, ["x"])
+        with self.assertRaises(ValueError):
+            graph.run({}, ["a"])
+        with self.assertRaises(ValueError):
+            graph.run({"x": 1}, ["b"])
+
+    def counting_graph(self, calls, scale, offset):
+        def stage(name, function):
+            def counted(*args):
+                calls.append(name)
+                return function(*args)
+
+            return counted
+
+        graph = StageGraph()
+        graph.add_stage(
+            "scaled", stage("scaled", lambda x: x * scale), ["x"], settings={"s": scale}
+        )
+        graph.add_stage(
+            "size",
+            stage("size", lambda x: x.GetSize()[0] // 2),
+            ["x"],
+            settings={"o": offset},
+        )
+        graph.add_stage(
+            "shifted",
+            stage("shifted", lambda scaled, size: scaled + size),
+            ["scaled", "size"],
+        )
+        return graph
+
+    def test_cache(self):
+        image = sitk.Image([4, 4, 4], sitk.sitkFloat32) + 1.0
+        cache = StageCache()
+        calls = []
+
+        def run(scale, offset, image=image):
+            graph = self.counting_graph(calls, scale, offset)
+            (shifted,) = graph.run({"x": image}, ["shifted"], cache=cache)
+            return sitk.GetArrayViewFromImage(shifted)[0, 0, 0], graph.report
+
+        self.assertEqual(run(2, 0)[0], 4)
+        self.assertEqual(calls, ["scaled", "size", "shifted"])
+
+        # nothing changed
+        calls.clear()
+        value, report = run(2, 0)
+        self.assertEqual(value, 4)
+        self.assertEqual(calls, [])
+        self.assertTrue(all(entry["cached"] for entry in report))
+
+        # the settings of the first stage changed
+        calls.clear()
+        self.assertEqual(run(3, 0)[0], 5)
+        self.assertEqual(calls, ["scaled", "shifted"])
+
+        # the size stage runs again, but its output is the same
+        calls.clear()
+        self.assertEqual(run(3, 1)[0], 5)
+        self.assertEqual(calls, ["size"])
+
+        # the input changed
+        calls.clear()
+        self.assertEqual(run(3, 1, image + 1.0)[0], 8)
+        self.assertEqual(calls, ["scaled", "size", "shifted"])
+        self.assertEqual(cache.misses, 9)
+        self.assertEqual(cache.hits, 6)
+
+    def test_cache_size(self):
+        cache = StageCache(max_bytes=2 * 64)
+        images = [sitk.Image([4, 4, 4], sitk.sitkUInt8) + i for i in range(3)]
+        for i, image in enumerate(images):
+            cache.put(i, image)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 128)
+        self.assertNotIn(0, cache)
+
+        # the least recently used image is dropped
+        cache.get(1)
+        cache.put(3, images[0])
+        self.assertIn(1, cache)
+        self.assertNotIn(2, cache)
+
+        # too large to store
+        cache.put(4, sitk.Image([8, 8, 8], sitk.sitkUInt8))
+        self.assertNotIn(4, cache)
+        cache.clear()
+        self.assertEqual((len(cache), cache.nbytes), (0, 0))
+
+    def test_value_key(self):
+        image = sitk.Image([4, 5, 6], sitk.sitkFloat32)
+        self.assertEqual(value_key(image), value_key(sitk.Image(image)))
+        self.assertNotEqual(value_key(image), value_key(image + 1.0))
+        moved = sitk.Image(image)
+        moved.SetOrigin([1.0, 0.0, 0.0])
+        self.assertNotEqual(value_key(image), value_key(moved))
+        self.assertEqual(value_key((1, 2)), value_key((1, 2)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,7 @@ import os
 import shutil
 import tempfile
 import unittest
+import warnings
 import numpy as np
 import SimpleITK as sitk
 
@@ -173,8 +174,50 @@ class TestJointSpaceWidthMorphometry(unittest.TestCase):
             skel=False,
             minimum=0.0,
         )
+        cropped_img, cropped_params = jsw_parameters(
+            pad,
+            dilated_js_mask,
+            test_csv,
+            test_dir,
+            js_mask=js_mask,
+            voxel_size=1,
+            oversamp=False,
+            skel=False,
+            minimum=0.0,
+            output_dtype=np.float32,
+            output_format="bbox",
+        )
+        sparse, sparse_params = jsw_parameters(
+            pad,
+            dilated_js_mask,
+            test_csv,
+            test_dir,
+            js_mask=js_mask,
+            voxel_size=1,
+            oversamp=False,
+            skel=False,
+            minimum=0.0,
+            output_format="indices",
+        )
         shutil.rmtree(test_dir)
 
+        # the sparse thickness map holds the nonzero voxels of the full map
+        np.testing.assert_array_equal(sparse.toarray(), sitk.GetArrayFromImage(dt_img))
+        np.testing.assert_array_equal(sparse_params[0][2:], jsw_params[0][2:])
+
+        # the cropped thickness map is the joint space part of the full map
+        self.assertEqual(cropped_img.GetPixelID(), sitk.sitkFloat32)
+        self.assertLess(np.prod(cropped_img.GetSize()), np.prod(dt_img.GetSize()))
+        dt_img.CopyInformation(dilated_js_mask)
+        resampled = sitk.Resample(
+            cropped_img, dt_img, sitk.Transform(), sitk.sitkNearestNeighbor
+        )
+        np.testing.assert_array_equal(
+            sitk.GetArrayFromImage(resampled),
+            sitk.GetArrayFromImage(dt_img).astype(np.float32),
+        )
+        np.testing.assert_array_equal(cropped_params[0][2:], jsw_params[0][2:])
+
         space = js_mask.GetSpacing()
         voxel = np.prod(space)
         img = sitk.GetArrayFromImage(js_mask)
@@ -186,3 +229,35 @@ class TestJointSpaceWidthMorphometry(unittest.TestCase):
         self.assertAlmostEqual(jsw_params[0][5], radius, 8)
         self.assertAlmostEqual(jsw_params[0][7], radius, 8)
         self.assertAlmostEqual(jsw_params[0][8], radius / radius, 8)
+
+    def test_jsw_parameters_empty_joint_space(self):
+        plate_image = sitk.GetImageFromArray(
+            1 - create_plate_mask((100, 100, 100), (1, 1, 1), 10).astype(int)
+        )
+        pad = jsw_pad(plate_image)
+        erode, js_mask, dilated_js_mask = jsw_erode(jsw_dilate(pad), pad)
+        empty_js_mask = sitk.Image(js_mask.GetSize(), js_mask.GetPixelID())
+        empty_js_mask.CopyInformation(js_mask)
+
+        test_dir = tempfile.mkdtemp()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            cropped_img, jsw_params = jsw_parameters(
+                pad,
+                dilated_js_mask,
+                os.path.join(test_dir, "jsw_params.csv"),
+                test_dir,
+                js_mask=empty_js_mask,
+                voxel_size=1,
+                oversamp=False,
+                skel=False,
+                output_format="bbox",
+            )
+        shutil.rmtree(test_dir)
+
+        # a single zero voxel at the origin of the dilated joint space mask
+        self.assertEqual(cropped_img.GetSize(), (1, 1, 1))
+        self.assertEqual(sitk.GetArrayFromImage(cropped_img).item(), 0)
+        self.position_check(cropped_img, dilated_js_mask)
+        self.assertEqual(jsw_params[0][2], 0)
+        self.assertIsNone(jsw_params[0][3])
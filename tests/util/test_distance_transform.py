@@ -0,0 +1,128 @@
+import unittest
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt, gaussian_filter
+from ormir_xct.util.distance_transform import (
+    euclidean_distance_transform,
+    label_distance_transform,
+)
+
+
+def create_random_mask(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    return gaussian_filter(rng.random(shape), 2) > 0.5
+
+
+class TestEuclideanDistanceTransform(unittest.TestCase):
+    def test_matches_scipy(self):
+        for shape, voxel_width in [
+            ((50,), (0.7,)),
+            ((30, 25), (1.0, 1.3)),
+            ((25, 20, 15), (1.0, 1.0, 1.0)),
+            ((25, 20, 15), (0.7, 1.3, 1.3)),
+            ((25, 20, 15), (0.5, 0.7, 0.9)),
+            ((25, 20, 15), (0.0607, 0.0607, 0.0607)),
+        ]:
+            mask = create_random_mask(shape)
+            dist, indices = euclidean_distance_transform(
+                mask, voxel_width, return_indices=True
+            )
+            expected, expected_indices = distance_transform_edt(
+                mask, voxel_width, return_indices=True
+            )
+            # ties between equidistant background voxels are broken like
+            # scipy does, so the results are the same bit for bit
+            np.testing.assert_array_equal(dist, expected)
+            np.testing.assert_array_equal(indices, expected_indices)
+
+    def test_indices(self):
+        mask = create_random_mask((25, 20, 15))
+        voxel_width = np.array([0.7, 1.0, 1.3])
+        dist, indices = euclidean_distance_transform(
+            mask, voxel_width, return_indices=True
+        )
+        self.assertEqual(indices.shape, (3,) + mask.shape)
+        # every voxel points to a background voxel at the right distance
+        self.assertFalse(mask[tuple(indices)].any())
+        offsets = (indices - np.indices(mask.shape)) * voxel_width[:, None, None, None]
+        np.testing.assert_allclose(np.sqrt((offsets**2).sum(axis=0)), dist)
+
+    def test_squared_and_float32(self):
+        mask = create_random_mask((25, 20, 15))
+        dist = euclidean_distance_transform(mask, 0.5)
+        squared = euclidean_distance_transform(mask, 0.5, squared=True)
+        np.testing.assert_allclose(squared, dist**2)
+
+        single = euclidean_distance_transform(mask, 0.5, dtype=np.float32)
+        self.assertEqual(single.dtype, np.float32)
+        np.testing.assert_allclose(single, dist, rtol=1e-6)
+
+    def test_n_threads(self):
+        mask = create_random_mask((25, 20, 15))
+        np.testing.assert_array_equal(
+            euclidean_distance_transform(mask, n_threads=1),
+            euclidean_distance_transform(mask, n_threads=2),
+        )
+
+    def test_no_background(self):
+        for shape, voxel_width in [
+            ((7,), (0.7,)),
+            ((4, 5), (1.0, 1.0)),
+            ((4, 5, 6), (0.5, 0.7, 0.9)),
+        ]:
+            mask = np.ones(shape)
+            dist, indices = euclidean_distance_transform(
+                mask, voxel_width, return_indices=True
+            )
+            expected, expected_indices = distance_transform_edt(
+                mask, voxel_width, return_indices=True
+            )
+            np.testing.assert_array_equal(dist, expected)
+            np.testing.assert_array_equal(indices, expected_indices)
+
+    def test_invalid_arguments(self):
+        mask = create_random_mask((10, 10, 10))
+        with self.assertRaises(ValueError):
+            euclidean_distance_transform(mask, (1.0, 1.0))
+        with self.assertRaises(ValueError):
+            euclidean_distance_transform(mask, dtype=np.int32)
+        with self.assertRaises(ValueError):
+            euclidean_distance_transform(mask, n_threads=0)
+
+
+class TestLabelDistanceTransform(unittest.TestCase):
+    def test_matches_euclidean_distance_transform(self):
+        rng = np.random.default_rng(0)
+        for shape, voxel_width in [
+            ((30, 25), (1.0, 1.3)),
+            ((25, 20, 15), (1.0, 1.0, 1.0)),
+            ((25, 20, 15), (0.7, 1.3, 1.3)),
+        ]:
+            smooth = gaussian_filter(rng.random(shape), 2)
+            labels = np.digitize(smooth, [0.47, 0.5, 0.53]).astype(np.uint8)
+            dist = label_distance_transform(labels, voxel_width)
+            self.assertTrue((dist[labels == 0] == 0).all())
+            for label in range(1, 4):
+                np.testing.assert_array_equal(
+                    dist[labels == label],
+                    euclidean_distance_transform(labels == label, voxel_width)[
+                        labels == label
+                    ],
+                )
+
+    def test_single_label(self):
+        labels = np.full((4, 5, 6), 2, dtype=np.uint8)
+        np.testing.assert_array_equal(
+            label_distance_transform(labels, (0.5, 0.7, 0.9)),
+            distance_transform_edt(labels, (0.5, 0.7, 0.9)),
+        )
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            label_distance_transform(np.ones((4, 4)) * 0.5)
+        with self.assertRaises(ValueError):
+            label_distance_transform(-np.ones((4, 4), dtype=int))
+
+
+if __name__ == "__main__":
+    unittest.main()
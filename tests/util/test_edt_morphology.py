@@ -0,0 +1,97 @@
+"""
+test_edt_morphology.py
+
+Description: Test that the distance transform based binary morphology gives
+             the same masks as the SimpleITK filters with a ball kernel.
+"""
+
+import unittest
+import numpy as np
+import SimpleITK as sitk
+
+from ormir_xct.util.distance_transform import euclidean_distance_transform
+from ormir_xct.util.edt_morphology import (
+    _squared_distances,
+    ball_radius_squared,
+    binary_closing,
+    binary_dilation,
+    binary_erosion,
+    binary_opening,
+)
+
+
+def random_blobs(shape, seed):
+    """
+    Union of balls with random centers and radii, some touching the edges.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.random(shape) < 0.002
+    return euclidean_distance_transform(~centers, squared=True) <= rng.integers(4, 30)
+
+
+class TestEdtMorphology(unittest.TestCase):
+    def check(self, operation, sitk_operation, *args):
+        for seed, radius in enumerate([1, 3, 6]):
+            mask = random_blobs((30, 40, 50), seed)
+            image = sitk.GetImageFromArray(mask.astype(np.uint8))
+            expected = sitk.GetArrayFromImage(
+                sitk_operation(image, [radius] * 3, sitk.sitkBall, *args)
+            )
+            result = operation(mask, radius)
+            self.assertEqual(result.dtype, bool)
+            np.testing.assert_array_equal(result, expected == 1)
+
+    def test_ball(self):
+        for radius in [0, 1, 2, 5, 16]:
+            size = 2 * radius + 3
+            point = np.zeros((size,) * 3, dtype=np.uint8)
+            point[(size // 2,) * 3] = 1
+            ball = sitk.BinaryDilate(
+                sitk.GetImageFromArray(point), [radius] * 3, sitk.sitkBall
+            )
+            offsets = np.indices(point.shape) - size // 2
+            np.testing.assert_array_equal(
+                (offsets**2).sum(axis=0) <= ball_radius_squared(radius),
+                sitk.GetArrayFromImage(ball) == 1,
+            )
+        with self.assertRaises(ValueError):
+            ball_radius_squared(-1)
+
+    def test_dilation(self):
+        self.check(binary_dilation, sitk.BinaryDilate, 0, 1)
+
+    def test_erosion(self):
+        self.check(binary_erosion, sitk.BinaryErode, 0, 1)
+
+    def test_opening(self):
+        self.check(binary_opening, sitk.BinaryMorphologicalOpening, 0, 1)
+
+    def test_closing(self):
+        self.check(binary_closing, sitk.BinaryMorphologicalClosing, 1)
+
+    def test_empty_and_full(self):
+        for mask in [np.zeros((5, 6, 7), bool), np.ones((5, 6, 7), bool)]:
+            for operation in [
+                binary_dilation,
+                binary_erosion,
+                binary_opening,
+                binary_closing,
+            ]:
+                np.testing.assert_array_equal(operation(mask, 2), mask)
+
+    def test_squared_distances(self):
+        for shape in [(50,), (30, 40), (30, 40, 50)]:
+            mask = random_blobs(shape, 3)
+            with self.subTest(shape=shape):
+                result = _squared_distances(mask, None)
+                self.assertEqual(result.dtype, np.float32)
+                np.testing.assert_array_equal(
+                    result, euclidean_distance_transform(mask, squared=True)
+                )
+        np.testing.assert_array_equal(
+            _squared_distances(np.ones((3, 4, 5), bool), 1), np.inf
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
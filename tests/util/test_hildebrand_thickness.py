@@ -1,10 +1,35 @@
+import os
+import pickle
+import tempfile
 import unittest
+import tracemalloc
 
 import numpy as np
+from scipy.ndimage import (
+    binary_dilation,
+    binary_erosion,
+    distance_transform_edt,
+    gaussian_filter,
+)
+from scipy.stats import kurtosis, skew
 from ormir_xct.util.hildebrand_thickness import (
+    DISTANCE_BYTES_PER_VOXEL,
+    FILL_BYTES_PER_VOXEL,
+    CroppedThickness,
+    SparseThickness,
+    ThicknessAccumulator,
+    build_sphere_stencils,
     compute_local_thickness_from_sorted_distances,
+    compute_local_thickness_from_sorted_distances_parallel,
     compute_local_thickness_from_mask,
+    compute_local_thickness_chunked,
     calc_structure_thickness_statistics,
+    calc_thickness_and_separation,
+    hildebrand_distance_ridge,
+    local_maximum_ridge,
+    oversampling_distance_transform,
+    sorted_distance_ridge,
+    warmup_kernels,
 )
 
 
@@ -25,6 +50,334 @@ def create_sphere_mask(shape, voxel_width, radius):
     return mask
 
 
+def create_random_mask(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    return gaussian_filter(rng.random(shape), 3) > 0.5
+
+
+def reference_oversampling_distance_transform(mask, voxel_width):
+    # distance transform of the explicitly upsampled, dilated and eroded mask
+    upsampled_mask = np.zeros([2 * s - 1 for s in mask.shape], dtype=bool)
+    upsampled_mask[::2, ::2, ::2] = mask
+    upsampled_mask = binary_dilation(upsampled_mask, structure=np.ones((3, 3, 3)))
+    upsampled_mask = binary_erosion(
+        np.pad(upsampled_mask, 1, mode="edge"), structure=np.ones((3, 3, 3))
+    )[1:-1, 1:-1, 1:-1]
+    dt = upsampled_mask * distance_transform_edt(upsampled_mask, voxel_width / 2)
+    return dt[::2, ::2, ::2]
+
+
+def reference_local_thickness(mask, voxel_width, oversample):
+    # full-mask local thickness using the original serial cube-scanning kernel
+    voxel_width = np.array(voxel_width, dtype=float)
+    if oversample:
+        mask_dist = oversampling_distance_transform(mask, voxel_width)
+    else:
+        mask_dist = mask * distance_transform_edt(mask, voxel_width)
+    sorted_dists = sorted(
+        (mask_dist[i, j, k], i, j, k) for (i, j, k) in zip(*mask_dist.nonzero())
+    )
+    sorted_dists = np.asarray(sorted_dists, dtype=float)
+    return mask * compute_local_thickness_from_sorted_distances(
+        np.zeros(mask.shape, dtype=float),
+        sorted_dists[:, 0],
+        sorted_dists[:, 1:].astype(int),
+        voxel_width,
+        0.5 if oversample else 0,
+    )
+
+
+class TestSortedDistanceRidge(unittest.TestCase):
+    def test_matches_tuple_sort(self):
+        mask = create_random_mask((30, 25, 20))
+        mask_dist = mask * distance_transform_edt(mask)
+        sorted_dists = sorted(
+            (mask_dist[i, j, k], i, j, k) for (i, j, k) in zip(*mask_dist.nonzero())
+        )
+        sorted_dists = np.asarray(sorted_dists, dtype=float)
+
+        dists, indices = sorted_distance_ridge(mask_dist)
+        self.assertEqual(indices.dtype, np.int32)
+        np.testing.assert_array_equal(dists, sorted_dists[:, 0])
+        np.testing.assert_array_equal(indices, sorted_dists[:, 1:])
+
+    def test_keeps_distance_dtype(self):
+        mask_dist = np.zeros((5, 5, 5), dtype=np.float32)
+        mask_dist[2, 2, 2] = 1.5
+        dists, indices = sorted_distance_ridge(mask_dist)
+        self.assertEqual(dists.dtype, np.float32)
+        np.testing.assert_array_equal(indices, [[2, 2, 2]])
+
+    def test_memory_usage(self):
+        mask = np.ones((64, 64, 64), dtype=bool)
+        mask_dist = np.random.default_rng(0).random(mask.shape) + 1
+        tracemalloc.start()
+        try:
+            sorted_distance_ridge(mask_dist)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # 8 bytes per distance, 12 bytes per index triple and a couple of
+        # 8 byte temporaries along the way
+        self.assertLess(peak / mask.size, 48)
+
+
+class TestOversamplingDistanceTransform(unittest.TestCase):
+    def test_matches_upsampled_grid(self):
+        masks = [create_random_mask((30, 25, 20)), create_random_mask((9, 40, 17), 1)]
+        for mask in masks:
+            for voxel_width in [(1, 1, 1), (1.0, 0.7, 1.3), (0.0607, 0.0607, 0.0607)]:
+                voxel_width = np.array(voxel_width, dtype=float)
+                # equidistant background voxels can give results that differ
+                # in the last bit
+                np.testing.assert_allclose(
+                    oversampling_distance_transform(mask, voxel_width),
+                    reference_oversampling_distance_transform(mask, voxel_width),
+                    rtol=1e-14,
+                )
+
+    def test_no_background(self):
+        # scipy's distances of a mask without background are kept as they are
+        mask = np.ones((6, 7, 8), dtype=bool)
+        for voxel_width in [(1, 1, 1), (1.0, 0.7, 1.3)]:
+            voxel_width = np.array(voxel_width, dtype=float)
+            np.testing.assert_array_equal(
+                oversampling_distance_transform(mask, voxel_width),
+                reference_oversampling_distance_transform(mask, voxel_width),
+            )
+        s = calc_structure_thickness_statistics(mask, 1.0, 0.0)
+        self.assertAlmostEqual(s[0], 21.47091055358388, places=10)
+
+    def test_memory_usage(self):
+        mask = create_random_mask((64, 64, 64))
+        voxel_width = np.array([1.0, 1.0, 1.0])
+        oversampling_distance_transform(mask, voxel_width)  # compile
+        tracemalloc.start()
+        try:
+            oversampling_distance_transform(mask, voxel_width)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # the float output plus two small integer offsets per voxel and
+        # oversampled plane
+        self.assertLess(peak / mask.size, 24)
+
+
+class TestComputeLocalThickness(unittest.TestCase):
+    def test_parallel_matches_serial(self):
+        mask = create_random_mask((40, 35, 30))
+        for voxel_width in [
+            (1, 1, 1),
+            (1.0, 0.7, 1.3),
+            (0.5, 0.7, 0.9),
+            (0.0607, 0.0607, 0.0607),
+        ]:
+            for oversample in [False, True]:
+                serial = reference_local_thickness(mask, voxel_width, oversample)
+                for n_threads in [1, 2]:
+                    parallel = compute_local_thickness_from_mask(
+                        mask,
+                        voxel_width,
+                        oversample,
+                        skeletonize=False,
+                        n_threads=n_threads,
+                    )
+                    np.testing.assert_array_equal(serial, parallel)
+
+    def test_parallel_kernel_small_tiles(self):
+        voxel_width = np.array([1.0, 1.0, 1.0])
+        sorted_dists = np.array([1.0, 2.5, 2.5, 4.0])
+        sorted_dists_indices = np.array(
+            [[5, 5, 5], [10, 12, 9], [1, 18, 2], [14, 14, 14]]
+        )
+        serial = compute_local_thickness_from_sorted_distances(
+            np.zeros((20, 20, 20)), sorted_dists, sorted_dists_indices, voxel_width, 0
+        )
+        parallel = compute_local_thickness_from_sorted_distances_parallel(
+            np.zeros((20, 20, 20)),
+            sorted_dists,
+            sorted_dists_indices,
+            voxel_width,
+            *build_sphere_stencils(sorted_dists, voxel_width, 0),
+            tile_size=3,
+        )
+        np.testing.assert_array_equal(serial, parallel)
+
+    def test_sphere_stencils(self):
+        voxel_width = np.array([1.0, 1.0, 1.0])
+        stencil_ids, stencil_ptr, stencil_rows = build_sphere_stencils(
+            np.array([1.0, 1.0, 2.0]), voxel_width, 0
+        )
+        np.testing.assert_array_equal(stencil_ids, [0, 0, 1])
+        self.assertEqual(len(stencil_ptr), 3)
+        # a sphere of radius 1 only contains its centre voxel
+        np.testing.assert_array_equal(
+            stencil_rows[stencil_ptr[0] : stencil_ptr[1]], [[0, 0, 0]]
+        )
+        # and a sphere of radius 2 contains the 27 voxels of the 3x3x3 cube
+        radius_2 = stencil_rows[stencil_ptr[1] : stencil_ptr[2]]
+        self.assertEqual((2 * radius_2[:, 2] + 1).sum(), 27)
+
+    def test_hildebrand_ridge_matches_mask(self):
+        random_mask = create_random_mask((40, 35, 30))
+        plate = np.zeros((30, 30, 30), dtype=bool)
+        plate[:, 10:20, :] = True
+        for mask in [random_mask, plate]:
+            for voxel_width in [(1, 1, 1), (1.0, 0.7, 1.3)]:
+                for oversample in [False, True]:
+                    full = compute_local_thickness_from_mask(
+                        mask, voxel_width, oversample, ridge="mask"
+                    )
+                    pruned = compute_local_thickness_from_mask(
+                        mask, voxel_width, oversample, ridge="hildebrand"
+                    )
+                    np.testing.assert_array_equal(full, pruned)
+
+    def test_hildebrand_ridge_of_plate(self):
+        voxel_width = np.array([1.0, 1.0, 1.0])
+        plate = np.zeros((30, 30, 30), dtype=bool)
+        plate[:, 10:19, :] = True
+        ridge = hildebrand_distance_ridge(
+            plate * distance_transform_edt(plate, voxel_width), voxel_width
+        )
+        # only the middle layer of the plate is left
+        self.assertEqual(ridge.sum(), 30 * 30)
+        self.assertTrue(ridge[:, 14, :].all())
+
+    def test_local_maximum_ridge_of_plate(self):
+        plate = np.zeros((30, 30, 30), dtype=bool)
+        plate[:, 10:19, :] = True
+        ridge = local_maximum_ridge(plate * distance_transform_edt(plate))
+        self.assertEqual(ridge.sum(), 30 * 30)
+        self.assertTrue(ridge[:, 14, :].all())
+
+    def test_local_maximum_ridge_matches_mask(self):
+        voxel_width = (1, 1, 1)
+        sphere = create_sphere_mask((40, 40, 40), voxel_width, 15)
+        for mask in [sphere, create_random_mask((40, 35, 30))]:
+            full = compute_local_thickness_from_mask(mask, voxel_width, ridge="mask")
+            local_max = compute_local_thickness_from_mask(
+                mask, voxel_width, ridge="local_max"
+            )
+            # a subset of the spheres can only give smaller thicknesses, but
+            # the local maxima are (almost) never inside other spheres
+            self.assertTrue((local_max <= full).all())
+            self.assertAlmostEqual(local_max[mask].mean(), full[mask].mean(), places=2)
+
+    def test_invalid_ridge(self):
+        mask = create_random_mask((20, 20, 20))
+        with self.assertRaises(ValueError):
+            compute_local_thickness_from_mask(mask, 1, ridge="medial_axis")
+
+    def test_invalid_n_threads(self):
+        mask = create_random_mask((20, 20, 20))
+        with self.assertRaises(ValueError):
+            compute_local_thickness_from_mask(mask, 1, n_threads=0)
+
+    def test_output_dtype_and_format(self):
+        mask = np.zeros((40, 40, 40), dtype=bool)
+        mask[5:20, 10:30, 12:33] = create_random_mask((15, 20, 21), seed=1)
+        dense = compute_local_thickness_from_mask(mask, 0.5, ridge="hildebrand")
+
+        for dtype in [np.float32, np.float16]:
+            field = compute_local_thickness_from_mask(
+                mask, 0.5, ridge="hildebrand", output_dtype=dtype
+            )
+            self.assertEqual(field.dtype, dtype)
+            np.testing.assert_array_equal(field, dense.astype(dtype))
+
+        sparse = compute_local_thickness_from_mask(
+            mask, 0.5, ridge="hildebrand", output_format="indices"
+        )
+        self.assertIsInstance(sparse, SparseThickness)
+        self.assertEqual(sparse.values.size, np.count_nonzero(dense))
+        np.testing.assert_array_equal(sparse.toarray(), dense)
+
+        cropped = compute_local_thickness_from_mask(
+            mask, 0.5, ridge="hildebrand", output_format="bbox", output_dtype=np.float32
+        )
+        self.assertIsInstance(cropped, CroppedThickness)
+        nonzero = np.argwhere(dense)
+        self.assertEqual(cropped.offset, tuple(nonzero.min(axis=0)))
+        self.assertEqual(
+            cropped.array.shape, tuple(nonzero.max(axis=0) - nonzero.min(axis=0) + 1)
+        )
+        np.testing.assert_array_equal(cropped.toarray(), dense.astype(np.float32))
+
+        with self.assertRaises(ValueError):
+            compute_local_thickness_from_mask(mask, 1, output_dtype=np.int32)
+        with self.assertRaises(ValueError):
+            compute_local_thickness_from_mask(mask, 1, output_format="sparse")
+
+
+class TestComputeLocalThicknessChunked(unittest.TestCase):
+    def test_matches_in_memory(self):
+        mask = create_random_mask((60, 30, 25))
+        voxel_width = (1.0, 0.7, 1.3)
+        for oversample in [False, True]:
+            for ridge in ["mask", "hildebrand"]:
+                in_memory = compute_local_thickness_from_mask(
+                    mask, voxel_width, oversample, ridge=ridge
+                )
+                # a budget for 40 slices of the distance transform, so that
+                # both passes work on several slabs
+                budget = (
+                    40 * 30 * 25 * max(DISTANCE_BYTES_PER_VOXEL, FILL_BYTES_PER_VOXEL)
+                )
+                chunked = compute_local_thickness_chunked(
+                    mask, voxel_width, budget, oversample, ridge
+                )
+                np.testing.assert_array_equal(in_memory, chunked)
+
+    def test_output_path(self):
+        mask = create_random_mask((40, 20, 20))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "thickness.npy")
+            chunked = compute_local_thickness_chunked(
+                mask, 1, 2**20, oversample=False, output_path=path, scratch_dir=tmp
+            )
+            np.testing.assert_array_equal(np.load(path), chunked)
+
+    def test_memory_budget(self):
+        mask = create_random_mask((120, 40, 40))
+        budget = 40 * 40 * 40 * FILL_BYTES_PER_VOXEL
+        compute_local_thickness_chunked(mask, 1, budget)  # compile
+        tracemalloc.start()
+        try:
+            compute_local_thickness_chunked(mask, 1, budget)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, budget)
+
+    def test_budget_too_small(self):
+        mask = create_random_mask((40, 20, 20))
+        with self.assertRaises(MemoryError):
+            compute_local_thickness_chunked(mask, 1, 20 * 20 * 64)
+
+    def test_local_max_ridge(self):
+        mask = create_random_mask((60, 30, 25))
+        in_memory = compute_local_thickness_from_mask(mask, 1, ridge="local_max")
+        chunked = compute_local_thickness_chunked(
+            mask, 1, 40 * 30 * 25 * FILL_BYTES_PER_VOXEL, ridge="local_max"
+        )
+        np.testing.assert_array_equal(in_memory, chunked)
+
+    def test_skeleton_ridge(self):
+        mask = create_random_mask((20, 20, 20))
+        with self.assertRaises(ValueError):
+            compute_local_thickness_chunked(mask, 1, 2**20, ridge="skeleton")
+
+    def test_output_dtype(self):
+        mask = create_random_mask((40, 30, 25))
+        in_memory = compute_local_thickness_from_mask(mask, 1, ridge="hildebrand")
+        chunked = compute_local_thickness_chunked(
+            mask, 1, 2**22, output_dtype=np.float32
+        )
+        self.assertEqual(chunked.dtype, np.float32)
+        np.testing.assert_array_equal(chunked, in_memory.astype(np.float32))
+
+
 class TestCalcStructureThicknessStatistics(unittest.TestCase):
     def test_get_sphere_thickness(self):
         voxel_width = (1, 1, 1)
@@ -37,6 +390,246 @@ class TestCalcStructureThicknessStatistics(unittest.TestCase):
         )
         self.assertAlmostEqual(2 * radius, s[0], places=1)
 
+    def test_no_background(self):
+        # without oversampling, scipy's distances of a mask without background
+        # are kept as well
+        s = calc_structure_thickness_statistics(
+            np.ones((6, 7, 8)), 1.0, 0.0, oversample=False
+        )
+        self.assertEqual(s[0], 22.0)
+
+    def test_n_threads(self):
+        voxel_width = (1, 1, 1)
+        sphere = create_sphere_mask((30, 30, 30), voxel_width, 10)
+        s1 = calc_structure_thickness_statistics(
+            sphere, voxel_width, 0, oversample=False, n_threads=1
+        )
+        s2 = calc_structure_thickness_statistics(
+            sphere, voxel_width, 0, oversample=False, n_threads=2
+        )
+        self.assertEqual(s1[0], s2[0])
+        np.testing.assert_array_equal(s1[4], s2[4])
+
+    def test_memory_budget(self):
+        voxel_width = (1, 1, 1)
+        mask = create_random_mask((60, 30, 30))
+        sub_mask = np.zeros_like(mask)
+        sub_mask[10:50] = True
+        s1 = calc_structure_thickness_statistics(
+            mask, voxel_width, 1, sub_mask, oversample=False, ridge="hildebrand"
+        )
+        s2 = calc_structure_thickness_statistics(
+            mask,
+            voxel_width,
+            1,
+            sub_mask,
+            oversample=False,
+            ridge="hildebrand",
+            memory_budget=30 * 30 * 30 * 72,
+        )
+        for a, b in zip(s1[:4], s2[:4]):
+            self.assertAlmostEqual(a, b)
+        np.testing.assert_array_equal(s1[4], s2[4])
+
+    def test_memory_budget_skeleton_warns(self):
+        mask = create_random_mask((60, 30, 30))
+        with self.assertWarns(UserWarning):
+            s1 = calc_structure_thickness_statistics(
+                mask, (1, 1, 1), 1, oversample=False, memory_budget=30 * 30 * 30 * 72
+            )
+        s2 = calc_structure_thickness_statistics(
+            mask, (1, 1, 1), 1, oversample=False, ridge="hildebrand"
+        )
+        np.testing.assert_array_equal(s1[4], s2[4])
+
+    def test_moments_and_histogram(self):
+        mask = create_random_mask((40, 30, 30))
+        sub_mask = np.zeros_like(mask)
+        sub_mask[5:35] = True
+        s = calc_structure_thickness_statistics(
+            mask, (0.5, 0.5, 0.5), 2, sub_mask, ridge="hildebrand", bin_width=0.25
+        )
+        values = np.maximum(s.local_thickness[s.local_thickness > 0], 2)
+        self.assertEqual(s.count, values.size)
+        self.assertAlmostEqual(s.mean, values.mean())
+        self.assertAlmostEqual(s.std, values.std())
+        self.assertEqual(s.min, values.min())
+        self.assertEqual(s.max, values.max())
+        self.assertAlmostEqual(s.skewness, skew(values))
+        self.assertAlmostEqual(s.kurtosis, kurtosis(values))
+        histogram, _ = np.histogram(values, s.bin_edges)
+        np.testing.assert_array_equal(s.histogram, histogram)
+        self.assertEqual(s.bin_edges[-2], 0.25 * int(values.max() / 0.25))
+
+    def test_unpacking(self):
+        mask = create_random_mask((40, 30, 30))
+        s = calc_structure_thickness_statistics(mask, 1, 0, ridge="hildebrand")
+        # unpacks like the 5-tuple that used to be returned
+        mean, std, mn, mx, local_thickness = s
+        self.assertEqual((mean, std, mn, mx), (s.mean, s.std, s.min, s.max))
+        self.assertIs(local_thickness, s.local_thickness)
+        self.assertEqual(len(s), 5)
+        self.assertEqual(s.count, np.count_nonzero(local_thickness))
+        copy = pickle.loads(pickle.dumps(s))
+        self.assertEqual(copy.skewness, s.skewness)
+        np.testing.assert_array_equal(copy.histogram, s.histogram)
+
+    def test_output_format(self):
+        mask = create_random_mask((40, 30, 30))
+        s1 = calc_structure_thickness_statistics(mask, 1, 0, ridge="hildebrand")
+        s2 = calc_structure_thickness_statistics(
+            mask,
+            1,
+            0,
+            ridge="hildebrand",
+            output_dtype=np.float16,
+            output_format="bbox",
+        )
+        self.assertEqual(s1[:4], s2[:4])
+        self.assertEqual(s2.local_thickness.array.dtype, np.float16)
+        np.testing.assert_array_equal(
+            s2.local_thickness.toarray(), s1.local_thickness.astype(np.float16)
+        )
+
+    def test_crop(self):
+        mask = np.zeros((60, 50, 40), dtype=bool)
+        mask[10:35, 20:45, 5:30] = create_random_mask((25, 25, 25), seed=2)
+        for oversample, ridge in [
+            (False, "skeleton"),
+            (True, "hildebrand"),
+            (True, "local_max"),
+        ]:
+            s1 = calc_structure_thickness_statistics(
+                mask, 0.5, 0, oversample=oversample, ridge=ridge, crop=False
+            )
+            s2 = calc_structure_thickness_statistics(
+                mask, 0.5, 0, oversample=oversample, ridge=ridge
+            )
+            np.testing.assert_array_equal(s1.local_thickness, s2.local_thickness)
+            for a, b in zip(s1[:4], s2[:4]):
+                self.assertAlmostEqual(a, b)
+
+            s3 = calc_structure_thickness_statistics(
+                mask,
+                0.5,
+                0,
+                oversample=oversample,
+                ridge=ridge,
+                output_format="indices",
+            )
+            np.testing.assert_array_equal(
+                s3.local_thickness.toarray(), s1.local_thickness
+            )
+
+    def test_pad_amount(self):
+        # a structure that intersects two faces of the image
+        mask = create_random_mask((40, 40, 40), seed=3)
+        mask[:, :, 20:] = False
+        sub_mask = np.zeros_like(mask)
+        sub_mask[5:30] = True
+        padded = compute_local_thickness_from_mask(
+            np.pad(mask, 4, mode="edge"), 1, oversample=False, ridge="hildebrand"
+        )
+        expected = padded[4:-4, 4:-4, 4:-4] * sub_mask
+        for crop in [False, True]:
+            s = calc_structure_thickness_statistics(
+                mask,
+                1,
+                0,
+                sub_mask,
+                pad_amount=4,
+                oversample=False,
+                ridge="hildebrand",
+                crop=crop,
+            )
+            np.testing.assert_array_equal(s.local_thickness, expected)
+
+
+class TestCalcThicknessAndSeparation(unittest.TestCase):
+    def test_matches_separate_calls(self):
+        mask = create_random_mask((40, 36, 32))
+        z, y, x = np.indices(mask.shape)
+        roi_mask = ((y - 18) ** 2 + (x - 16) ** 2 < 14**2) & (z > 3) & (z < 37)
+        for oversample, ridge in [
+            (False, "skeleton"),
+            (False, "mask"),
+            (True, "hildebrand"),
+        ]:
+            thickness, separation = calc_thickness_and_separation(
+                mask, roi_mask, 0.5, 1, 1.5, oversample=oversample, ridge=ridge
+            )
+            for s1, phase, minimum in [
+                (thickness, mask & roi_mask, 1),
+                (separation, roi_mask & ~mask, 1.5),
+            ]:
+                s2 = calc_structure_thickness_statistics(
+                    phase, 0.5, minimum, oversample=oversample, ridge=ridge
+                )
+                np.testing.assert_array_equal(s1.local_thickness, s2.local_thickness)
+                for a, b in zip(s1[:4], s2[:4]):
+                    self.assertAlmostEqual(a, b)
+
+    def test_memory_usage(self):
+        mask = create_random_mask((64, 64, 64))
+        roi_mask = np.ones_like(mask)
+        calc_thickness_and_separation(mask, roi_mask, 1, oversample=False)  # compile
+        tracemalloc.start()
+        try:
+            calc_thickness_and_separation(mask, roi_mask, 1, oversample=False)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # the distance map, the buffer the phases share and the output of the
+        # first phase, plus the labels, masks and ridge of one phase
+        self.assertLess(peak / mask.size, 36)
+
+    def test_empty_phase(self):
+        roi_mask = create_sphere_mask((20, 20, 20), (1, 1, 1), 6)
+        with self.assertWarns(UserWarning):
+            thickness, separation = calc_thickness_and_separation(
+                np.zeros_like(roi_mask), roi_mask, 1, output_format="indices"
+            )
+        self.assertIsNone(thickness.mean)
+        self.assertEqual(thickness.local_thickness.values.size, 0)
+        self.assertEqual(
+            separation.mean, calc_structure_thickness_statistics(roi_mask, 1, 0).mean
+        )
+
+
+class TestThicknessAccumulator(unittest.TestCase):
+    def test_chunks_merge(self):
+        rng = np.random.default_rng(0)
+        values = rng.gamma(2, 1.5, (20, 10, 10)) * (rng.random((20, 10, 10)) > 0.3)
+        whole = ThicknessAccumulator(0.5, 0.1).update(values).statistics(values)
+
+        first = ThicknessAccumulator(0.5, 0.1).update(values[:7])
+        second = ThicknessAccumulator(0.5, 0.1)
+        for chunk in np.array_split(values[7:], 3):
+            second.update(chunk)
+        merged = first.merge(second).statistics(values)
+
+        for a, b in zip(whole[:4] + whole[5:7], merged[:4] + merged[5:7]):
+            self.assertAlmostEqual(a, b)
+        np.testing.assert_array_equal(whole.histogram, merged.histogram)
+        self.assertEqual(whole.count, merged.count)
+
+    def test_constant_and_empty(self):
+        values = np.full((5, 5), 3.0)
+        s = ThicknessAccumulator().update(values, values < 0).statistics(values)
+        self.assertIsNone(s.mean)
+        s = ThicknessAccumulator().update(values).statistics(values)
+        self.assertEqual((s.mean, s.std, s.skewness, s.kurtosis), (3, 0, 0, 0))
+        np.testing.assert_array_equal(s.histogram, [0, 0, 0, 25])
+
+
+class TestWarmupKernels(unittest.TestCase):
+    def test_warmup_kernels(self):
+        warmup_kernels()
+        # the kernels are compiled for both index types
+        self.assertGreaterEqual(
+            len(compute_local_thickness_from_sorted_distances.signatures), 4
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
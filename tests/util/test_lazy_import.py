@@ -0,0 +1,66 @@
+"""
+test_lazy_import.py
+
+Description: Test the lazy loading of modules and that importing the entry
+             points does not load the heavy backends.
+"""
+
+import sys
+import unittest
+import subprocess
+
+from ormir_xct.util.lazy_import import LazyModule, lazy_import
+
+HEAVY_BACKENDS = ["itk", "vtk", "numba", "skimage", "scipy.ndimage"]
+
+ENTRY_POINTS = [
+    "ormir_xct.util.file_reader",
+    "ormir_xct.util.file_converter",
+    "ormir_xct.util.sitk_vtk",
+    "ormir_xct.util.segmentation_evaluation",
+    "ormir_xct.bone_mineral_density.bmd_masked",
+    "ormir_xct.joint_space_analysis.jsw_morphometry",
+]
+
+
+class TestLazyImport(unittest.TestCase):
+    def test_loaded_module_is_returned(self):
+        self.assertIs(lazy_import("unittest"), unittest)
+
+    def test_missing_module(self):
+        with self.assertRaises(ModuleNotFoundError):
+            lazy_import("ormir_xct_missing_module")
+
+    def test_load_on_attribute_access(self):
+        code = (
+            "import sys\n"
+            "from ormir_xct.util.lazy_import import lazy_import\n"
+            "wave = lazy_import('wave')\n"
+            "assert 'wave' not in sys.modules\n"
+            "assert wave.Wave_read is sys.modules['wave'].Wave_read\n"
+        )
+        subprocess.run([sys.executable, "-c", code], check=True)
+
+    def test_proxy(self):
+        module = LazyModule("json")
+        self.assertEqual(module.dumps([1]), "[1]")
+        self.assertIn("dumps", dir(module))
+
+    def test_entry_points_do_not_load_backends(self):
+        for entry_point in ENTRY_POINTS:
+            with self.subTest(entry_point=entry_point):
+                code = (
+                    f"import sys, {entry_point}\n"
+                    f"print([m for m in {HEAVY_BACKENDS} if m in sys.modules])\n"
+                )
+                output = subprocess.run(
+                    [sys.executable, "-c", code],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout
+                self.assertEqual(output.strip(), "[]")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -38,18 +38,44 @@ class TestSegmentationEvaluation(unittest.TestCase):
 
         np.testing.assert_array_equal(expected_image, result_image)
 
-    @unittest.skip("unimplemented")
     def test_get_distance_map_and_surface(self):
-        pass
+        rng = np.random.default_rng(0)
+        mask = sitk.GetImageFromArray((rng.random((12, 10, 8)) > 0.3).astype(np.int64))
+        mask.SetSpacing((0.7, 1.0, 1.3))
+
+        dist_map, surface, surface_num_pix = get_distance_map_and_surface(mask)
+
+        expected = sitk.Abs(
+            sitk.SignedMaurerDistanceMap(
+                mask, squaredDistance=False, useImageSpacing=True
+            )
+        )
+        np.testing.assert_allclose(
+            sitk.GetArrayFromImage(dist_map),
+            sitk.GetArrayFromImage(expected),
+            rtol=1e-6,
+            atol=1e-6,
+        )
+        self.assertEqual(dist_map.GetSpacing(), mask.GetSpacing())
+        self.assertEqual(surface_num_pix, int(sitk.GetArrayFromImage(surface).sum()))
 
-    @unittest.skip("unimplemented")
     def test_get_surface_to_surface_distances_list(self):
-        pass
+        dist_map = sitk.GetImageFromArray(np.array([[0.0, 1.5], [0.0, 2.0]]))
+
+        # the surface voxels without a distance are added as zeros
+        result = get_surface_to_surface_distances_list(dist_map, 4)
+
+        self.assertEqual(sorted(result), [0.0, 0.0, 1.5, 2.0])
 
     @unittest.skip("unimplemented")
     def test_calculate_dice_and_jaccard(self):
         pass
 
-    @unittest.skip("unimplemented")
     def test_calculate_surface_distance_measures(self):
-        pass
+        mask = np.zeros((12, 12, 12), dtype=int)
+        mask[3:9, 3:9, 3:9] = 1
+
+        # identical masks have no surface distance
+        measures = calculate_surface_distance_measures(mask, mask, (1.0, 1.0, 1.0))
+
+        self.assertEqual(measures, {"max": 0, "median": 0, "mean": 0, "std": 0})
@@ -0,0 +1,161 @@
+"""
+test_slab_streaming.py
+
+Description: Test that the slab by slab filtering and connected component
+             labelling give the same results as SimpleITK on the whole image,
+             and that slabs and regions of image files are read correctly.
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+from scipy.ndimage import gaussian_filter
+from ormir_xct.util.slab_streaming import (
+    SlabLabels,
+    blank_image,
+    gaussian_radius,
+    largest_connected_component,
+    map_slabs,
+    read_region,
+    read_slab,
+    slab_ranges,
+)
+
+
+def create_random_mask(shape, seed=0, sigma=1.2):
+    rng = np.random.default_rng(seed)
+    mask = gaussian_filter(rng.random(shape), sigma) > 0.5
+    return sitk.GetImageFromArray(127 * mask.astype(np.uint8))
+
+
+class TestSlabStreaming(unittest.TestCase):
+    def test_slab_ranges(self):
+        self.assertEqual(
+            slab_ranges(10, 4, 3), [(0, 4, 0, 7), (4, 8, 1, 10), (8, 10, 5, 10)]
+        )
+        self.assertEqual(slab_ranges(10, None), [(0, 10, 0, 10)])
+
+    def test_labels_match_sitk(self):
+        for seed in range(5):
+            image = create_random_mask((13, 20, 17), seed)
+            for fully_connected in [True, False]:
+                expected = sitk.GetArrayFromImage(
+                    sitk.ConnectedComponent(image, fully_connected)
+                )
+                for slab_size in [None, 1, 2, 5, 13]:
+                    with self.subTest(
+                        seed=seed,
+                        fully_connected=fully_connected,
+                        slab_size=slab_size,
+                    ):
+                        labels = SlabLabels(image, slab_size, fully_connected)
+                        values = np.arange(labels.sizes.size, dtype=np.uint32)
+                        np.testing.assert_array_equal(
+                            sitk.GetArrayFromImage(labels.map(values)), expected
+                        )
+                        np.testing.assert_array_equal(
+                            labels.sizes, np.bincount(expected.ravel())
+                        )
+                        for label in range(1, labels.sizes.size):
+                            self.assertEqual(
+                                labels.first_voxel(label),
+                                np.unravel_index(
+                                    np.argmax(expected == label), expected.shape
+                                ),
+                            )
+                        for axis in range(3):
+                            for side in [0, -1]:
+                                face = set(np.unique(expected.take(side, axis=axis)))
+                                self.assertEqual(labels.faces[axis, side], face - {0})
+
+    def test_empty_image(self):
+        labels = SlabLabels(sitk.Image([4, 5, 6], sitk.sitkUInt8), 2)
+        np.testing.assert_array_equal(labels.sizes, [120])
+        self.assertEqual(labels.faces[0, 0], set())
+        image = labels.map(np.array([7], dtype=np.uint8))
+        self.assertTrue((sitk.GetArrayViewFromImage(image) == 7).all())
+
+    def test_largest_connected_component(self):
+        for seed in range(3):
+            image = create_random_mask((13, 20, 17), seed)
+            relabelled = sitk.RelabelComponent(sitk.ConnectedComponent(image, True))
+            expected = 5 * (sitk.GetArrayFromImage(relabelled) == 1)
+            for slab_size in [None, 1, 4]:
+                with self.subTest(seed=seed, slab_size=slab_size):
+                    result = largest_connected_component(image, slab_size, value=5)
+                    self.assertEqual(result.GetPixelID(), sitk.sitkUInt8)
+                    np.testing.assert_array_equal(
+                        sitk.GetArrayFromImage(result), expected
+                    )
+
+    def test_map_slabs(self):
+        rng = np.random.default_rng(0)
+        image = sitk.GetImageFromArray(rng.normal(size=(30, 12, 14)).astype(np.float32))
+        image.SetOrigin([1, 2, 3])
+        for variance, width in [(1.5, 1), (2, 3), (4, 10)]:
+            halo = gaussian_radius(variance, width, 0.01, False, 1.0)
+
+            def smooth(img):
+                sitk.ProcessObject_SetGlobalWarningDisplay(False)
+                img = sitk.DiscreteGaussian(img, variance, width, 0.01, False)
+                sitk.ProcessObject_SetGlobalWarningDisplay(True)
+                return img
+
+            expected = sitk.GetArrayFromImage(smooth(image))
+            result = map_slabs(smooth, [image], 4, halo)
+            self.assertEqual(result.GetOrigin(), image.GetOrigin())
+            np.testing.assert_array_equal(sitk.GetArrayFromImage(result), expected)
+            # the halo is just enough
+            result = map_slabs(smooth, [image], 4, halo - 1)
+            self.assertFalse(np.array_equal(sitk.GetArrayFromImage(result), expected))
+
+        mask = create_random_mask((30, 12, 14))
+        for radius in [1, 3]:
+            expected = sitk.BinaryMorphologicalClosing(
+                mask, [radius] * 3, sitk.sitkBall
+            )
+            result = map_slabs(
+                lambda img: sitk.BinaryMorphologicalClosing(
+                    img, [radius] * 3, sitk.sitkBall
+                ),
+                [mask],
+                5,
+                2 * radius,
+            )
+            np.testing.assert_array_equal(
+                sitk.GetArrayFromImage(result), sitk.GetArrayFromImage(expected)
+            )
+
+    def test_read_from_file(self):
+        rng = np.random.default_rng(0)
+        image = sitk.GetImageFromArray(rng.normal(size=(9, 8, 7)).astype(np.float32))
+        image.SetSpacing([0.5, 0.6, 0.7])
+        image.SetOrigin([1, 2, 3])
+        with tempfile.TemporaryDirectory() as directory:
+            fn = os.path.join(directory, "image.nii")
+            sitk.WriteImage(image, fn)
+
+            for region, expected in [
+                (read_slab(fn, 2, 5), image[:, :, 2:5]),
+                (read_region(fn, [1, 2, 3], [4, 5, 6]), image[1:5, 2:7, 3:9]),
+                (read_region(fn), image),
+            ]:
+                self.assertEqual(region.GetPixelID(), sitk.sitkFloat32)
+                self.assertEqual(region.GetSize(), expected.GetSize())
+                np.testing.assert_allclose(region.GetOrigin(), expected.GetOrigin())
+                np.testing.assert_array_equal(
+                    sitk.GetArrayFromImage(region), sitk.GetArrayFromImage(expected)
+                )
+
+            blank = blank_image(fn)
+            self.assertEqual(blank.GetSize(), image.GetSize())
+            self.assertEqual(blank.GetPixelID(), sitk.sitkUInt8)
+            np.testing.assert_allclose(blank.GetSpacing(), image.GetSpacing())
+            self.assertEqual(sitk.GetArrayViewFromImage(blank).max(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+test_slice_connected_components.py
+
+Description: Test that the slice-wise connected component labelling gives
+             the same labels as SimpleITK applied to every slice.
+"""
+
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+from scipy.ndimage import gaussian_filter
+from ormir_xct.util.slice_connected_components import (
+    label_slices,
+    filter_slice_components,
+    union_pairs,
+)
+
+
+def create_random_mask(shape, seed=0, sigma=1.5):
+    rng = np.random.default_rng(seed)
+    return gaussian_filter(rng.random(shape), sigma) > 0.5
+
+
+def sitk_slice_labels(mask, fully_connected):
+    labels = np.zeros(mask.shape, dtype=np.int32)
+    for k, mask_slice in enumerate(mask):
+        labels[k] = sitk.GetArrayFromImage(
+            sitk.ConnectedComponent(
+                sitk.GetImageFromArray(mask_slice.astype(np.uint8)), fully_connected
+            )
+        )
+    return labels
+
+
+class TestSliceConnectedComponents(unittest.TestCase):
+    def test_union_pairs(self):
+        parent = np.arange(8)
+        union_pairs(parent, np.array([[5, 3], [7, 5], [2, 6], [6, 1]]))
+        np.testing.assert_array_equal(parent, [0, 1, 1, 3, 4, 3, 1, 3])
+
+    def test_labels_match_sitk(self):
+        for seed in range(3):
+            mask = create_random_mask((6, 40, 35), seed)
+            # an empty and a full slice
+            mask[0] = False
+            mask[-1] = True
+            for fully_connected in [False, True]:
+                with self.subTest(seed=seed, fully_connected=fully_connected):
+                    expected = sitk_slice_labels(mask, fully_connected)
+                    labels, counts = label_slices(mask, fully_connected=fully_connected)
+                    self.assertEqual(labels.dtype, np.int32)
+                    np.testing.assert_array_equal(labels, expected)
+                    np.testing.assert_array_equal(counts, expected.max(axis=(1, 2)))
+
+    def test_axis(self):
+        mask = create_random_mask((20, 25, 30))
+        labels, counts = label_slices(mask, axis=1)
+        self.assertEqual(labels.shape, mask.shape)
+        self.assertEqual(counts.shape, (25,))
+        expected = sitk_slice_labels(np.moveaxis(mask, 1, 0), False)
+        np.testing.assert_array_equal(np.moveaxis(labels, 1, 0), expected)
+
+    def test_largest_component(self):
+        mask = create_random_mask((8, 40, 35), seed=1)
+        mask[0] = False
+        for fully_connected in [False, True]:
+            with self.subTest(fully_connected=fully_connected):
+                result = filter_slice_components(mask, fully_connected=fully_connected)
+                self.assertEqual(result.dtype, bool)
+                self.assertFalse(result[0].any())
+                for k in range(1, mask.shape[0]):
+                    labels = sitk.ConnectedComponent(
+                        sitk.GetImageFromArray(mask[k].astype(np.uint8)),
+                        fully_connected,
+                    )
+                    largest = sitk.RelabelComponent(labels, sortByObjectSize=True) == 1
+                    np.testing.assert_array_equal(
+                        result[k], sitk.GetArrayFromImage(largest) > 0
+                    )
+
+    def test_largest_component_ties(self):
+        # two components of the same size, the first one is kept
+        mask = np.zeros((1, 5, 7), dtype=bool)
+        mask[0, 3, 1:3] = True
+        mask[0, 1, 4:6] = True
+        result = filter_slice_components(mask)
+        np.testing.assert_array_equal(result, mask & (np.arange(5)[:, None] == 1))
+
+    def test_min_size(self):
+        mask = create_random_mask((5, 40, 35), seed=2)
+        labels, counts = label_slices(mask)
+        result = filter_slice_components(mask, min_size=10)
+        for k in range(mask.shape[0]):
+            sizes = np.bincount(labels[k].ravel(), minlength=counts[k] + 1)
+            sizes[0] = 0
+            np.testing.assert_array_equal(result[k], sizes[labels[k]] >= 10)
+        np.testing.assert_array_equal(filter_slice_components(mask, min_size=0), mask)
+        with self.assertRaises(ValueError):
+            filter_slice_components(mask, min_size=-1)
+
+    def test_n_threads(self):
+        mask = create_random_mask((10, 30, 30))
+        np.testing.assert_array_equal(
+            filter_slice_components(mask, n_threads=1),
+            filter_slice_components(mask, n_threads=2),
+        )
+
+    def test_not_3d(self):
+        with self.assertRaises(ValueError):
+            label_slices(np.ones((4, 4), dtype=bool))
+
+
+if __name__ == "__main__":
+    unittest.main()